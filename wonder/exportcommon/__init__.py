@@ -0,0 +1,3 @@
+# __init__.py
+# 订单 / 旧订单 / 退款导出工具共用的模块: 输出写入、行映射、指标、只读副本、预检、结果归档、重试与死信、时间片和断点续传
+# 镜像构建时与工具代码一起复制到 /app/exportcommon, 见各工具的 dockerfile
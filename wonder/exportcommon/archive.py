@@ -0,0 +1,87 @@
+# archive.py
+import io
+import json
+import logging
+import os
+import tarfile
+import threading
+from datetime import datetime, timezone
+
+from .writers import file_sha256
+
+
+def check_archive_path(path, output_dir):
+    """
+    job 模式的归档路径必须显式指定, 且不能在 OUTPUT_DIR 下: OUTPUT_DIR 通常是 emptyDir, pod 退出时连同归档一起删除,
+    分片也会在同一块盘上存两份; 归档应写到单独挂载的持久卷上 (见各工具的 *Job.yml)
+    """
+    if not path:
+        raise ValueError("RUN_MODE=job 需要设置 ARCHIVE_PATH (单独挂载的持久卷上的路径)")
+    archive_dir = os.path.dirname(os.path.realpath(path))
+    output_dir = os.path.realpath(output_dir)
+    if os.path.commonpath([archive_dir, output_dir]) == output_dir:
+        raise ValueError(f"ARCHIVE_PATH 不能在 OUTPUT_DIR ({output_dir}) 下: {path}")
+    return path
+
+
+class ResultArchive:
+    """
+    job 模式的结果归档: 导出过程中每完成一天就把当天的分片和分片清单追加进同一个 tar (不再压缩, 分片本身已按
+    OUTPUT_COMPRESSION 压缩), 导出结束后不必再 kubectl exec tar
+    tar 只顺序追加, 可以用 tar -x 或上传工具流式读取; 写入期间文件名为 <path>.partial, seal() 追加 archive.json
+    (全部成员的字节数 / sha256 和运行结果) 后改名为 path, 没有 .partial 后缀即表示归档已封口
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.partial_path = f"{path}.partial"
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.members = []
+        self._names = set()
+        self._lock = threading.Lock()
+        self._tar = tarfile.open(self.partial_path, 'w|', format=tarfile.PAX_FORMAT)
+
+    def add(self, filepath, sha256=None):
+        """按文件名加入归档, 同名文件只加一次"""
+        name = os.path.basename(filepath)
+        with self._lock:
+            if name in self._names:
+                return
+            self._tar.add(filepath, arcname=name, recursive=False)
+            self._names.add(name)
+            self.members.append({
+                'file': name,
+                'bytes': os.path.getsize(filepath),
+                'sha256': sha256 or file_sha256(filepath),
+            })
+
+    def add_shards(self, base_path):
+        """<base_path>.manifest.json 中的全部分片, 之后是清单本身; 没有清单 (当天无数据) 时返回 False"""
+        manifest_path = f"{base_path}.manifest.json"
+        if not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path, encoding='utf-8') as f:
+            shards = json.load(f)['shards']
+        for shard in shards:
+            self.add(os.path.join(os.path.dirname(manifest_path), shard['file']), shard.get('sha256'))
+        self.add(manifest_path)
+        return True
+
+    def seal(self, summary):
+        """追加 archive.json 并封口; summary 为运行结果 (成功 / 失败天数等), 原样写入"""
+        with self._lock:
+            index = json.dumps({
+                'sealed_at': datetime.now(timezone.utc).isoformat(),
+                'summary': summary,
+                'members': self.members,
+            }, ensure_ascii=False, indent=1).encode('utf-8')
+            info = tarfile.TarInfo('archive.json')
+            info.size = len(index)
+            info.mtime = int(datetime.now(timezone.utc).timestamp())
+            self._tar.addfile(info, io.BytesIO(index))
+            self._tar.close()
+        os.replace(self.partial_path, self.path)
+        logging.info(f"结果归档已封口: {self.path}, {len(self.members)} 个文件, {os.path.getsize(self.path)} 字节")
+        return self.path
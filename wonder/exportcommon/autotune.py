@@ -0,0 +1,106 @@
+# autotune.py
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+probe_levels = (1, 2, 4, 8, 16, 32)
+# mysql.connector 连接池的上限
+max_pool_size = 32
+
+
+def probe_level(connect, run_query, concurrency, duration_seconds):
+    """concurrency 条连接各自循环执行 run_query(conn) duration_seconds 秒, 返回吞吐和延迟"""
+    connections = [connect() for _ in range(concurrency)]
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration_seconds
+
+    def worker(conn):
+        local = []
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            run_query(conn)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    try:
+        threads = [threading.Thread(target=worker, args=(conn,), daemon=True) for conn in connections]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for conn in connections:
+            conn.close()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'qps': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else 0,
+        'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2) if latencies else 0,
+    }
+
+
+def pick_knee(results, min_gain=0.15, max_latency_factor=3.0):
+    """
+    拐点: 并发翻倍后吞吐提升不足 min_gain, 或 p95 延迟超过单连接的 max_latency_factor 倍时, 取前一级的并发
+    """
+    for previous, current in zip(results, results[1:]):
+        if current['qps'] < previous['qps'] * (1 + min_gain):
+            return previous['concurrency']
+        if current['p95_ms'] > results[0]['p95_ms'] * max_latency_factor:
+            return previous['concurrency']
+    return results[-1]['concurrency']
+
+
+def probe_concurrency(connect, run_query, duration_seconds, levels=probe_levels):
+    """按 levels 逐级加并发探测, 过了拐点就停止, 返回 (拐点并发, 各级结果)"""
+    results = []
+    for concurrency in levels:
+        results.append(probe_level(connect, run_query, concurrency, duration_seconds))
+        logging.info(f"校准: 并发 {concurrency} - {results[-1]['qps']} 查询/秒, "
+                     f"p50 {results[-1]['p50_ms']} ms, p95 {results[-1]['p95_ms']} ms")
+        if len(results) >= 2 and pick_knee(results) < concurrency:
+            break
+    return pick_knee(results), results
+
+
+def calibrate(path, mode, host, max_age_hours, connect, run_query, duration_seconds):
+    """
+    返回 {'concurrency': 拐点并发, ...}, mode 为 off 或探测失败时返回 None
+    auto: 复用 path 中 max_age_hours 内、同一数据库的结果, 否则重新探测; force: 总是探测
+    """
+    if mode == 'off':
+        return None
+    if mode == 'auto' and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            saved = json.load(f)
+        age_hours = (datetime.now(timezone.utc) - datetime.fromisoformat(saved['calibrated_at'])).total_seconds() / 3600
+        if saved.get('host') == host and age_hours < max_age_hours:
+            logging.info(f"校准: 沿用 {saved['calibrated_at']} 的结果, 并发 {saved['concurrency']}")
+            return saved
+
+    try:
+        concurrency, results = probe_concurrency(connect, run_query, duration_seconds)
+    except Exception as e:
+        logging.info(f"校准失败, 使用默认配置: {e}")
+        return None
+
+    calibration = {
+        'host': host,
+        'calibrated_at': datetime.now(timezone.utc).isoformat(),
+        'concurrency': concurrency,
+        'levels': results,
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(calibration, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+    return calibration
@@ -0,0 +1,125 @@
+# checkpoint.py
+import json
+import os
+import threading
+from datetime import datetime
+
+from .slice_planner import ExportSlice
+
+
+class CheckpointManifest:
+    """
+    OUTPUT_DIR 下的 manifest.json: 每天的时间片划分, 已完成的时间片 / 日期及行数, 时间片内已提交的分段和续读位置
+    每次更新都写临时文件再原子替换, 进程随时被杀也不会留下半个 manifest
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.days = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.days = json.load(f).get('days', {})
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'days': self.days}, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def plan_day(self, current_date, slices):
+        """
+        第一次处理某天时记录它的时间片划分; 重启后沿用记录的划分, 保证时间片序号和已提交的进度对得上
+        """
+        day = current_date.strftime('%Y-%m-%d')
+        with self._lock:
+            if day not in self.days:
+                self.days[day] = {
+                    'done': False,
+                    'rows': 0,
+                    'files': [],
+                    'slices': [{
+                        'start_utc': export_slice.start_utc.isoformat(),
+                        'end_utc': export_slice.end_utc.isoformat(),
+                        'order_count': export_slice.order_count,
+                        'done': False,
+                        'rows': 0,
+                        'segments': [],
+                        'last_key': None,
+                    } for export_slice in slices]
+                }
+                self._save()
+            return [
+                ExportSlice(current_date, datetime.fromisoformat(state['start_utc']),
+                            datetime.fromisoformat(state['end_utc']), state['order_count'])
+                for state in self.days[day]['slices']
+            ]
+
+    def day_state(self, day):
+        with self._lock:
+            return json.loads(json.dumps(self.days.get(day)))
+
+    def slice_state(self, day, index):
+        with self._lock:
+            return json.loads(json.dumps(self.days[day]['slices'][index]))
+
+    def commit_segment(self, day, index, path, rows, last_key, shard=None):
+        """
+        分段文件已落盘, 记录它和续读位置 (最后一个订单的 (created_time, id))
+        shard: 分片清单需要的信息 (首末 orderId 等), 一并记在分段上
+        """
+        self.commit_segments(day, index, [{'path': path, 'rows': rows, **(shard or {})}], last_key)
+
+    def commit_segments(self, day, index, segments, last_key):
+        """一次登记多个分段 (同一批页按分片阈值切开的多个文件) 和它们之后的续读位置, segments 中每项含 path / rows"""
+        with self._lock:
+            state = self.days[day]['slices'][index]
+            state['segments'].extend(segments)
+            state['rows'] += sum(segment['rows'] for segment in segments)
+            if last_key is not None:
+                last_created_time, last_id = last_key
+                state['last_key'] = [last_created_time.isoformat(), last_id]
+            self._save()
+
+    def finish_slice(self, day, index):
+        with self._lock:
+            self.days[day]['slices'][index]['done'] = True
+            self._save()
+
+    def reset_slice(self, day, index):
+        """放弃时间片未完成的进度, 返回需要清理的文件"""
+        with self._lock:
+            state = self.days[day]['slices'][index]
+            paths = [segment['path'] for segment in state['segments']]
+            state.update(done=False, rows=0, segments=[], last_key=None)
+            self._save()
+            return paths
+
+    def finish_day(self, day, files, rows):
+        with self._lock:
+            entry = self.days[day]
+            entry.update(done=True, files=files, rows=rows)
+            self._save()
+
+
+def resume_key(state):
+    """slice_state 中记录的续读位置还原为 (created_time, id)"""
+    if not state['last_key']:
+        return None
+    last_created_time, last_id = state['last_key']
+    return datetime.fromisoformat(last_created_time), last_id
+
+
+def load_watermark(path):
+    """增量导出的高水位 (UTC), 文件不存在时返回 None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return datetime.fromisoformat(json.load(f)['updated_time'])
+
+
+def save_watermark(path, updated_time):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'updated_time': updated_time.isoformat()}, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,56 @@
+# dead_letters.py
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+
+class DeadLetterLog:
+    """
+    重试后仍然失败的订单, 每行一个 {"day", "order_id", "error", "at"} (JSON Lines)
+    逐条追加并 flush, 进程被杀也不会丢; 同一订单可能记录多次, entries() 按 order_id 去重, 保留最后一次
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.recorded = []
+        self._lock = threading.Lock()
+
+    def record(self, day, order_id, error):
+        entry = {
+            'day': day,
+            'order_id': order_id,
+            'error': repr(error),
+            'at': datetime.now(timezone.utc).isoformat(),
+        }
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+            self.recorded.append(entry)
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return []
+        latest = {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    latest[entry['order_id']] = entry
+        return list(latest.values())
+
+    def keep_recorded(self):
+        """重做死信后调用: 文件只保留本次运行记录的 (仍然失败的) 订单, 写临时文件再原子替换"""
+        with self._lock:
+            if not self.recorded:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for entry in self.recorded:
+                    f.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,197 @@
+# metrics.py
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# 耗时分桶上界 (秒), 0.5ms ~ 120s 大致按 2 倍递增
+bucket_bounds = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+]
+
+
+class StageHistogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(bucket_bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        for index, value in enumerate(other.counts):
+            self.counts[index] += value
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """按分桶估算分位数: 取落入的桶, 在桶内线性插值"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, value in enumerate(self.counts):
+            if value and seen + value >= rank:
+                lower = bucket_bounds[index - 1] if index > 0 else 0.0
+                upper = bucket_bounds[index] if index < len(bucket_bounds) else bucket_bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / value
+            seen += value
+        return bucket_bounds[-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': round(self.quantile(0.50), 6),
+            'p95': round(self.quantile(0.95), 6),
+            'p99': round(self.quantile(0.99), 6),
+        }
+
+
+class StageMetrics:
+    """
+    按 (阶段, 日期) 汇总各阶段耗时, 写成 Prometheus textfile (<prefix>.prom) 和 JSON 快照
+    用来区分慢的日期是卡在数据库查询还是 CPU (对象构造 / 行映射) 上
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.histograms = {}
+        # (队列, 日期) -> [最近一次深度, 最大深度, 深度累计, 采样次数]
+        self.queue_depths = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def observe(self, stage, day, seconds):
+        with self._lock:
+            histogram = self.histograms.get((stage, day))
+            if histogram is None:
+                histogram = self.histograms[(stage, day)] = StageHistogram()
+            histogram.observe(seconds)
+
+    def observe_depth(self, queue_name, day, depth):
+        with self._lock:
+            state = self.queue_depths.get((queue_name, day))
+            if state is None:
+                state = self.queue_depths[(queue_name, day)] = [0, 0, 0, 0]
+            state[0] = depth
+            state[1] = max(state[1], depth)
+            state[2] += depth
+            state[3] += 1
+
+    @contextmanager
+    def timer(self, stage, day):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, day, time.perf_counter() - start)
+
+    def timed(self, iterable, stage, day):
+        """逐个转发 iterable 的元素, 每次取下一个元素的耗时记为 stage (如分页查询的每一页)"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.observe(stage, day, time.perf_counter() - start)
+            yield item
+
+    def _copy(self):
+        with self._lock:
+            copied = {}
+            for key, histogram in self.histograms.items():
+                copied[key] = StageHistogram()
+                copied[key].merge(histogram)
+            return copied
+
+    def _copy_depths(self):
+        with self._lock:
+            return {key: list(state) for key, state in self.queue_depths.items()}
+
+    def snapshot(self):
+        """
+        {'stages': {阶段: 全部日期汇总}, 'days': {日期: {阶段: 汇总}},
+         'queues': {日期: {队列: {'last', 'max', 'avg'}}}}
+        """
+        histograms = self._copy()
+        stages = {}
+        days = {}
+        for (stage, day), histogram in sorted(histograms.items()):
+            stages.setdefault(stage, StageHistogram()).merge(histogram)
+            days.setdefault(day, {})[stage] = histogram.summary()
+        queues = {}
+        for (queue_name, day), (last, peak, total, samples) in sorted(self._copy_depths().items()):
+            queues.setdefault(day, {})[queue_name] = {
+                'last': last,
+                'max': peak,
+                'avg': round(total / samples, 2) if samples else 0,
+            }
+        return {
+            'generated_at': int(time.time()),
+            'stages': {stage: histogram.summary() for stage, histogram in stages.items()},
+            'days': days,
+            'queues': queues,
+        }
+
+    def prometheus_text(self):
+        name = f"{self.prefix}_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent per export stage and day.",
+            f"# TYPE {name} histogram",
+        ]
+        for (stage, day), histogram in sorted(self._copy().items()):
+            labels = f'stage="{stage}",day="{day}"'
+            cumulative = 0
+            for bound, value in zip(bucket_bounds, histogram.counts):
+                cumulative += value
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+        depths = sorted(self._copy_depths().items())
+        if depths:
+            for suffix, index, description in (('', 0, 'Latest'), ('_max', 1, 'Maximum')):
+                gauge = f"{self.prefix}_queue_depth{suffix}"
+                lines.append(f"# HELP {gauge} {description} pipeline queue depth per queue and day.")
+                lines.append(f"# TYPE {gauge} gauge")
+                for (queue_name, day), state in depths:
+                    lines.append(f'{gauge}{{queue="{queue_name}",day="{day}"}} {state[index]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory):
+        """写临时文件后原子替换, node_exporter 不会读到写了一半的文件"""
+        for filename, content in (
+                (f"{self.prefix}.prom", self.prometheus_text()),
+                (f"{self.prefix}.json", json.dumps(self.snapshot(), ensure_ascii=False, indent=1))):
+            path = os.path.join(directory, filename)
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(f"{path}.tmp", path)
+
+    def start_periodic_write(self, directory, interval_seconds):
+        def run():
+            while not self._stop.wait(interval_seconds):
+                try:
+                    self.write(directory)
+                except OSError as e:
+                    logging.info(f"写入指标快照失败: {e}")
+
+        threading.Thread(target=run, name='metrics-writer', daemon=True).start()
+
+    def stop(self, directory):
+        self._stop.set()
+        self.write(directory)
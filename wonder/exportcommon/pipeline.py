@@ -0,0 +1,111 @@
+# pipeline.py
+import queue
+import threading
+import time
+from collections import deque
+
+_end = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class ExportPipeline:
+    """
+    取数 -> 行映射 -> 写文件 三段并发执行, 段间用有界队列连接:
+    - 取数线程迭代 batches (分页查询 + 组装), 队列满时阻塞, 取数最多领先写文件 2 * queue_size 批
+    - 转换线程把批次提交到 transform_stage, 最多 map_workers 批同时在转换, 按提交顺序取回结果
+    - 调用线程按顺序写文件, 输出顺序与串行执行一致
+    各段在队列上阻塞 / 空等的时间记为 pipeline_*_blocked / pipeline_write_idle, 队列深度记到 metrics, 用来判断瓶颈在哪一段
+    任一段出错时其余各段停止, 异常在调用线程中抛出
+    """
+
+    def __init__(self, transform_stage, map_workers, queue_size, metrics, day):
+        self.transform_stage = transform_stage
+        self.map_workers = max(1, map_workers)
+        self.queue_size = max(1, queue_size)
+        self.metrics = metrics
+        self.day = day
+
+    def run(self, batches, map_row, encode_csv, write_result, key_index=None):
+        fetched = queue.Queue(self.queue_size)
+        mapped = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self._fetch, args=(batches, fetched, stop), name='pipeline-fetch', daemon=True),
+            threading.Thread(target=self._map, args=(fetched, mapped, map_row, encode_csv, key_index, stop),
+                             name='pipeline-map', daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = mapped.get()
+                self.metrics.observe('pipeline_write_idle', self.day, time.perf_counter() - start)
+                self.metrics.observe_depth('map_to_write', self.day, mapped.qsize())
+                if item is _end:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                write_result(item)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _fetch(self, batches, fetched, stop):
+        try:
+            for items in batches:
+                if not self._put(fetched, items, stop, 'fetch', 'fetch_to_map'):
+                    return
+            self._put(fetched, _end, stop, 'fetch', 'fetch_to_map')
+        except Exception as e:
+            self._put(fetched, _Failure(e), stop, 'fetch', 'fetch_to_map')
+
+    def _map(self, fetched, mapped, map_row, encode_csv, key_index, stop):
+        pending = deque()
+        try:
+            while True:
+                item = self._get(fetched, stop)
+                if item is None:
+                    return
+                if item is _end:
+                    break
+                if isinstance(item, _Failure):
+                    self._put(mapped, item, stop, 'map', 'map_to_write')
+                    return
+                pending.append(self.transform_stage.submit(map_row, item, encode_csv, key_index))
+                if len(pending) >= self.map_workers:
+                    if not self._put(mapped, pending.popleft().result(), stop, 'map', 'map_to_write'):
+                        return
+            while pending:
+                if not self._put(mapped, pending.popleft().result(), stop, 'map', 'map_to_write'):
+                    return
+            self._put(mapped, _end, stop, 'map', 'map_to_write')
+        except Exception as e:
+            self._put(mapped, _Failure(e), stop, 'map', 'map_to_write')
+
+    def _put(self, target, item, stop, stage, queue_name):
+        """队列满时等待下游, 下游已停止时返回 False"""
+        start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.2)
+                break
+            except queue.Full:
+                continue
+        self.metrics.observe(f"pipeline_{stage}_blocked", self.day, time.perf_counter() - start)
+        self.metrics.observe_depth(queue_name, self.day, target.qsize())
+        return not stop.is_set()
+
+    @staticmethod
+    def _get(source, stop):
+        while not stop.is_set():
+            try:
+                return source.get(timeout=0.2)
+            except queue.Empty:
+                continue
+        return None
@@ -0,0 +1,73 @@
+# preflight.py
+import logging
+from collections import namedtuple
+
+# EXPLAIN 的访问类型中表示整表 / 整个索引扫描的
+full_scan_types = {
+    'ALL': '全表扫描',
+    'index': '全索引扫描',
+}
+
+# name: 报告中的名称; unit: 估计行数的单位 (如 '天' / '单'); allow_filesort: 结果集很小的汇总查询允许 filesort
+PreflightQuery = namedtuple('PreflightQuery', ['name', 'sql', 'params', 'unit', 'allow_filesort'])
+
+
+def preflight_query(name, sql, params, unit, allow_filesort=False):
+    return PreflightQuery(name, sql, tuple(params), unit, allow_filesort)
+
+
+def explain(conn, sql, params):
+    with conn.cursor(dictionary=True) as cursor:
+        cursor.execute('EXPLAIN ' + sql, params)
+        return cursor.fetchall()
+
+
+def plan_problems(plan, allow_filesort=False):
+    problems = []
+    for row in plan:
+        access = row.get('type')
+        if access in full_scan_types:
+            problems.append(f"{row.get('table')} {full_scan_types[access]} "
+                            f"(type={access}, possible_keys={row.get('possible_keys')}, rows={row.get('rows')})")
+        if not allow_filesort and 'Using filesort' in (row.get('Extra') or ''):
+            problems.append(f"{row.get('table')} 需要 filesort")
+    return problems
+
+
+def estimated_rows(plan):
+    """主查询各表 rows 的乘积, 即嵌套循环 join 估计检查的行数; 子查询 / 派生表不计入"""
+    total = None
+    for row in plan:
+        if row.get('select_type') not in (None, 'SIMPLE', 'PRIMARY') or row.get('rows') is None:
+            continue
+        total = (total or 1) * max(int(row['rows']), 1)
+    return total or 0
+
+
+def run_preflight(conn, queries, mode, label=''):
+    """
+    对 queries 逐条 EXPLAIN, 记录每条查询用到的索引和每个单位的估计行数
+    出现全表 / 全索引扫描或 filesort 时 warn 模式只记录警告, strict 模式抛出 RuntimeError, 导出不会开始
+    返回有问题的查询 {名称: [问题]}
+    """
+    prefix = f"预检 [{label}]" if label else "预检"
+    failed = {}
+    for query in queries:
+        try:
+            plan = explain(conn, query.sql, query.params)
+        except Exception as e:
+            failed[query.name] = [f"EXPLAIN 失败: {e}"]
+            logging.warning(f"{prefix} {query.name}: EXPLAIN 失败: {e}")
+            continue
+        keys = ', '.join(f"{row.get('table')}={row.get('key') or '-'}" for row in plan)
+        logging.info(f"{prefix} {query.name}: 索引 {keys}, 估计每{query.unit} {estimated_rows(plan)} 行")
+        problems = plan_problems(plan, query.allow_filesort)
+        if problems:
+            failed[query.name] = problems
+            for problem in problems:
+                logging.warning(f"{prefix} {query.name}: {problem}")
+
+    if failed and mode == 'strict':
+        raise RuntimeError(f"{prefix} {len(failed)} 条查询的执行计划有全表扫描 / filesort: {', '.join(failed)}; "
+                           f"确认无误后可设置 PREFLIGHT=warn 继续")
+    return failed
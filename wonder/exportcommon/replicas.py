@@ -0,0 +1,180 @@
+# replicas.py
+import logging
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import mysql.connector
+
+# 副本延迟的指数移动平均系数
+latency_alpha = 0.2
+# 副本至少有这么多次延迟采样才参与摘除判断
+min_latency_samples = 5
+
+
+def parse_hosts(value, default_host):
+    """DB_HOSTS: 逗号分隔的 host 或 host:port; 为空时只用 DB_HOST"""
+    hosts = [host.strip() for host in (value or '').split(',') if host.strip()]
+    return hosts or [default_host]
+
+
+class Replica:
+    def __init__(self, index, host, pool_name):
+        self.index = index
+        address, _, port = (host or '').partition(':')
+        self.address = address or host
+        self.port = int(port) if port else 3306
+        self.host = host
+        self.pool_name = pool_name
+        # 正在该副本上执行的工作单元数 / 累计分到的工作单元数
+        self.inflight = 0
+        self.units = 0
+        # 分页查询延迟的移动平均 (秒), 没有采样时为 None
+        self.latency = None
+        self.samples = 0
+        # 摘除到期时间 (time.monotonic), 0 表示可用
+        self.ejected_until = 0.0
+
+
+class ReplicaRouter:
+    """
+    每个只读副本一个 mysql.connector 连接池, 工作单元 (日期 / 时间片) 开始时选负载最低的副本:
+    负载 = (在途单元数 + 1) * 该副本分页查询延迟的移动平均, 延迟相同时按在途单元数
+    副本延迟超过其他可用副本最低延迟的 eject_factor 倍, 或建连失败时摘除 eject_seconds 秒, 到期后清空延迟重新试用
+    最后一个可用副本不会被摘除; 只有一个副本时连接池名与原来相同
+    """
+
+    def __init__(self, hosts, pool_name, eject_factor=3.0, eject_seconds=60.0):
+        self.replicas = [
+            Replica(index, host, f"{pool_name}_{index}" if len(hosts) > 1 else pool_name)
+            for index, host in enumerate(hosts)
+        ]
+        self.eject_factor = eject_factor
+        self.eject_seconds = eject_seconds
+        # 每个副本同时承担的工作单元上限, 超过时等待, 避免连接池被借空
+        self.capacity = None
+        self._cond = threading.Condition()
+        self._connections = weakref.WeakKeyDictionary()
+
+    def create_pools(self, db_config, capacity):
+        """按 db_config 给每个副本建连接池, pool_size 为单个副本的连接数"""
+        self.capacity = capacity
+        for replica in self.replicas:
+            config = dict(db_config, host=replica.address, port=replica.port, pool_name=replica.pool_name)
+            mysql.connector.connect(**config).close()
+        if len(self.replicas) > 1:
+            logging.info(f"只读副本 {len(self.replicas)} 个: {', '.join(r.host for r in self.replicas)}, "
+                         f"每个副本连接池 {db_config['pool_size']} 条, 最多 {capacity} 个并发单元")
+
+    def acquire(self):
+        """给一个工作单元选副本; 所有可用副本都满时等待"""
+        with self._cond:
+            while True:
+                replica = self._pick()
+                if replica is not None:
+                    replica.inflight += 1
+                    replica.units += 1
+                    return replica
+                self._cond.wait(1.0)
+
+    def release(self, replica):
+        with self._cond:
+            replica.inflight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def lease(self):
+        replica = self.acquire()
+        try:
+            yield replica
+        finally:
+            self.release(replica)
+
+    def _pick(self, ignore_capacity=False):
+        now = time.monotonic()
+        for replica in self.replicas:
+            if replica.ejected_until and replica.ejected_until <= now:
+                replica.ejected_until = 0.0
+                replica.latency = None
+                replica.samples = 0
+                logging.info(f"副本 {replica.host} 摘除到期, 恢复使用")
+        candidates = [
+            replica for replica in self.replicas
+            if not replica.ejected_until and (ignore_capacity or self.capacity is None or replica.inflight < self.capacity)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda r: ((r.inflight + 1) * (r.latency or 0.0), r.inflight, r.index))
+
+    def connect(self, replica=None):
+        """从 replica 的连接池取连接, 不指定时取当前负载最低的副本 (不占工作单元名额); 建连失败的副本被摘除"""
+        if replica is None:
+            with self._cond:
+                replica = self._pick(ignore_capacity=True) or self.replicas[0]
+        try:
+            conn = mysql.connector.connect(pool_name=replica.pool_name)
+        except mysql.connector.PoolError:
+            raise
+        except mysql.connector.Error as err:
+            self.eject(replica, f"建连失败: {err}")
+            raise
+        self._connections[conn] = replica
+        return conn
+
+    def replica_of(self, conn):
+        """conn 所在的副本, 不是 connect() 取得的连接时为 None"""
+        return self._connections.get(conn)
+
+    def timed(self, conn, iterable):
+        """逐个转发 iterable 的元素, 取每个元素的耗时 (如分页查询的每一页) 记为 conn 所在副本的延迟"""
+        replica = self.replica_of(conn)
+        if replica is None:
+            return iterable
+        return self._timed(replica, iterable)
+
+    def _timed(self, replica, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(replica, time.perf_counter() - start)
+            yield item
+
+    def observe(self, replica, seconds):
+        with self._cond:
+            if replica.latency is None:
+                replica.latency = seconds
+            else:
+                replica.latency += latency_alpha * (seconds - replica.latency)
+            replica.samples += 1
+            if replica.ejected_until or replica.samples < min_latency_samples:
+                return
+            others = [r.latency for r in self.replicas
+                      if r is not replica and not r.ejected_until and r.samples >= min_latency_samples]
+            if others and replica.latency > min(others) * self.eject_factor:
+                self._eject(replica, f"延迟 {replica.latency * 1000:.1f} ms, 其他副本最低 {min(others) * 1000:.1f} ms")
+
+    def eject(self, replica, reason):
+        with self._cond:
+            self._eject(replica, reason)
+
+    def _eject(self, replica, reason):
+        if replica.ejected_until:
+            return
+        if not any(r is not replica and not r.ejected_until for r in self.replicas):
+            return
+        replica.ejected_until = time.monotonic() + self.eject_seconds
+        logging.info(f"摘除副本 {replica.host} {self.eject_seconds:g} 秒: {reason}")
+        self._cond.notify_all()
+
+    def log_summary(self):
+        if len(self.replicas) <= 1:
+            return
+        for replica in self.replicas:
+            latency = f"{replica.latency * 1000:.1f} ms" if replica.latency is not None else "-"
+            logging.info(f"副本 {replica.host}: {replica.units} 个工作单元, 分页查询延迟 {latency}"
+                         f"{' (已摘除)' if replica.ejected_until else ''}")
@@ -0,0 +1,80 @@
+# retry.py
+import logging
+import random
+import time
+
+import mysql.connector
+from mysql.connector import errorcode
+
+# 可以原样重试的 MySQL 错误: 连接断开 / 连不上 / 连接数满 / 锁等待超时 / 死锁; 连接池耗尽 (PoolError) 另外判断
+transient_errnos = {
+    errorcode.CR_CONN_HOST_ERROR,
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_SERVER_LOST_EXTENDED,
+    errorcode.ER_CON_COUNT_ERROR,
+    errorcode.ER_LOCK_WAIT_TIMEOUT,
+    errorcode.ER_LOCK_DEADLOCK,
+}
+
+
+def is_transient(err):
+    if isinstance(err, mysql.connector.PoolError):
+        return True
+    return isinstance(err, mysql.connector.Error) and err.errno in transient_errnos
+
+
+# 连接级错误: 连不上 / 连接断开 / 连接数满 / 连接池耗尽; 重试用尽说明数据库本身不可用,
+# 这时继续处理只会把剩下的订单全部记入死信, 应该让时间片 (当天) 失败, 而不是报成功
+connection_errnos = {
+    errorcode.CR_CONN_HOST_ERROR,
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_SERVER_LOST_EXTENDED,
+    errorcode.ER_CON_COUNT_ERROR,
+}
+
+
+def is_connection_error(err):
+    if isinstance(err, mysql.connector.PoolError):
+        return True
+    return isinstance(err, mysql.connector.Error) and err.errno in connection_errnos
+
+
+def reconnect(conn):
+    """连接断开后原地重连; 池化连接重连后仍属于原来的连接池, 已有的引用不用更换"""
+    conn.reconnect(attempts=1, delay=0)
+
+
+class RetryPolicy:
+    """
+    暂时性错误按指数退避重试: 第 n 次重试前等待 base_delay * 2^(n-1) 秒 (不超过 max_delay), 再乘以 0.5~1 的随机系数,
+    避免同时断开的多个时间片在同一时刻一起重试; 其他错误 (数据问题 / SQL 错误) 不重试, 直接抛出
+    """
+
+    def __init__(self, attempts, base_delay, max_delay):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    def call(self, fn, label, reset=None):
+        """
+        执行 fn(), 最多尝试 attempts 次; reset: 每次重试前调用 (如重连), 它本身出错也算一次失败
+        重试用尽后抛出最后一次的错误
+        """
+        attempt = 1
+        while True:
+            try:
+                if attempt > 1 and reset is not None:
+                    reset()
+                return fn()
+            except Exception as err:
+                if not is_transient(err) or attempt >= self.attempts:
+                    raise
+                delay = self.delay(attempt)
+                logging.info(f"{label}: 暂时性错误, {delay:.1f} 秒后第 {attempt} 次重试: {err}")
+                time.sleep(delay)
+                attempt += 1
@@ -0,0 +1,375 @@
+# row_mapper.py
+# 订单 / 旧订单导出共用的 Forter 列定义、行映射和 NDJSON 文档; OrderLine 由各工具的 models 定义, 这里只按属性名取值
+
+
+def get_final_amount(orderCharge):
+    if orderCharge is None or orderCharge.final_amount is None:
+        return "0"
+    return str(orderCharge.final_amount)
+
+
+def get_order_type(order):
+    if order.order_channel == 'BA_WEB' or order.order_channel == 'WEB':
+        return 'WEB'
+    elif order.order_channel == 'BA_APP' or order.order_channel == 'APP':
+        return 'MOBILE'
+
+    return "UNKNOWN"
+
+
+def get_historical_order_status(order, order_flags: list) -> str:
+    if order.status == 'COMPLETE':
+        return 'COMPLETE'
+
+    elif order.status == 'CANCELED':
+        for flag in order_flags:
+            if flag.created_by == 'customer-service-site':
+                return 'CANCELED_BY_MERCHANT'
+
+        return 'CANCELED_BY_CUSTOMER'
+
+    else:
+        return ''
+
+
+class PaymentInfo:
+    """每个订单只遍历一次 order_payments / stripe_payment_intents, 供所有支付列共用"""
+    __slots__ = ('google_pay_token', 'apple_pay_token', 'credit_card')
+
+    def __init__(self, order_line):
+        google_pay = apple_pay = credit_card = None
+        for payment in (order_line.order_payments or []):
+            method = payment.payment_method
+            if method == 'GOOGLE_PAY':
+                google_pay = google_pay or payment
+            elif method == 'APPLE_PAY':
+                apple_pay = apple_pay or payment
+            elif method == 'CREDIT_CARD':
+                credit_card = credit_card or payment
+
+        self.google_pay_token = find_stripe_token(order_line, google_pay.id) if google_pay else ""
+        self.apple_pay_token = find_stripe_token(order_line, apple_pay.id) if apple_pay else ""
+        self.credit_card = credit_card
+
+
+def find_stripe_token(order_line, payment_id):
+    for stripe_payment in (order_line.stripe_payment_intents or []):
+        if stripe_payment.payment_id == payment_id:
+            return stripe_payment.stripe_payment_method_id
+    return ""
+
+
+# OrderLine 中每个明细行各不相同的部分, 其余 (订单 / 客户 / 支付 / 地址 / 标记 / 订单费用) 同一订单的各行共用
+item_owners = ('order_item', 'order_charge_item')
+
+
+def per_item(get):
+    """标记取值器依赖明细行, 每行都要计算; 未标记的取值器每个订单只算一次"""
+    get.per_item = True
+    return get
+
+
+def field(attr_path):
+    """'owner.attr' 路径的取值器, owner 或值为 None 时返回空串"""
+    owner_name, attr = attr_path.split('.')
+
+    def get(order_line, payment):
+        owner = getattr(order_line, owner_name, None)
+        if owner is None:
+            return ""
+        value = getattr(owner, attr, None)
+        return "" if value is None else value
+
+    get.per_item = owner_name in item_owners
+    return get
+
+
+def text_field(attr_path):
+    get_value = field(attr_path)
+
+    def get(order_line, payment):
+        return get_value(order_line, payment) or ''
+
+    get.per_item = get_value.per_item
+    return get
+
+
+def epoch_seconds(attr_path):
+    get_value = field(attr_path)
+
+    def get(order_line, payment):
+        value = get_value(order_line, payment)
+        return str(int(value.timestamp())) if value else ""
+
+    get.per_item = get_value.per_item
+    return get
+
+
+def quantity(attr_path):
+    get_value = field(attr_path)
+
+    def get(order_line, payment):
+        value = get_value(order_line, payment)
+        return str(value) if value else ""
+
+    get.per_item = get_value.per_item
+    return get
+
+
+@per_item
+def refundable_subtotal(order_line, payment):
+    charge_item = order_line.order_charge_item
+    if not charge_item:
+        return ""
+    return str(charge_item.subtotal) if charge_item.subtotal is not None else ""
+
+
+def historical_order_status(order_line, payment):
+    return get_historical_order_status(order_line.order, order_line.order_flags)
+
+
+def order_type(order_line, payment):
+    return get_order_type(order_line.order)
+
+
+def google_pay_token(order_line, payment):
+    return payment.google_pay_token
+
+
+def apple_pay_token(order_line, payment):
+    return payment.apple_pay_token
+
+
+def credit_card_last_four(order_line, payment):
+    return payment.credit_card.account_number if payment.credit_card else ""
+
+
+def credit_card_token(order_line, payment):
+    return payment.credit_card.credit_card_id if payment.credit_card else ""
+
+
+def final_amount(order_line, payment):
+    return get_final_amount(order_line.order_charge)
+
+
+def order_line_columns(checkout_time):
+    """
+    列定义: 字符串为常量列, 函数为 (order_line, payment) -> 值 的取值器, 顺序即 CSV 列顺序
+    两个订单导出只有 checkoutTime 的来源不同, 由 checkout_time 取值器给出
+    """
+    return [
+        ('accountOwner.accountId', field('customer.user_id')),
+        ('accountOwner.created', epoch_seconds('customer.created_time')),
+        ('accountOwner.email', field('customer.email')),
+        ('accountOwner.firstName', field('customer.first_name')),
+        ('accountOwner.fullName', ""),
+        ('accountOwner.lastName', field('customer.last_name')),
+
+        ('cartItems[].basicItemData.name', field('order_item.menu_item_name')),
+        ('cartItems[].basicItemData.quantity', quantity('order_item.order_quantity')),
+        ('cartItems[].basicItemData.category', ""),
+        ('cartItems[].basicItemData.price.amountLocalCurrency', ""),
+        ('cartItems[].basicItemData.price.amountUSD', refundable_subtotal),
+        ('cartItems[].basicItemData.price.currency', ""),
+
+        ('cartItems[].beneficiaries[].personalDetails.email', ""),
+        ('cartItems[].beneficiaries[].personalDetails.firstName', ""),
+        ('cartItems[].beneficiaries[].personalDetails.fullName', ""),
+        ('cartItems[].beneficiaries[].personalDetails.lastName', ""),
+        ('cartItems[].beneficiaries[].phone[].phone', ""),
+
+        ('cartItems[].itemSpecificData.food.restaurantAddress.address1', ""),
+        ('cartItems[].itemSpecificData.food.restaurantAddress.address2', ""),
+        ('cartItems[].itemSpecificData.food.restaurantAddress.city', ""),
+        ('cartItems[].itemSpecificData.food.restaurantAddress.country', "US"),
+        ('cartItems[].itemSpecificData.food.restaurantAddress.region', ""),
+        ('cartItems[].itemSpecificData.food.restaurantAddress.zip', ""),
+        ('cartItems[].itemSpecificData.food.restaurantId', "Blue Apron"),
+        ('cartItems[].itemSpecificData.food.restaurantName', "Blue Apron"),
+
+        ('checkoutTime', checkout_time),
+        ('connectionInformation.customerIP', '127.0.0.1'),
+        ('historicalData.fraud', ""),
+        ('historicalData.orderStatus', historical_order_status),
+        ('orderId', field('order.id')),
+        ('orderType', order_type),
+
+        # Android Pay (Google Pay)
+        ('payment[].androidPay.bin', ""),
+        ('payment[].androidPay.expirationMonth', ""),
+        ('payment[].androidPay.expirationYear', ""),
+        ('payment[].androidPay.lastFourDigits', ""),
+        ('payment[].androidPay.nameOnCard', ""),
+        ('payment[].androidPay.token', google_pay_token),
+
+        # Apple Pay
+        ('payment[].applePay.bin', ""),
+        ('payment[].applePay.expirationMonth', ""),
+        ('payment[].applePay.expirationYear', ""),
+        ('payment[].applePay.lastFourDigits', ""),
+        ('payment[].applePay.nameOnCard', ""),
+        ('payment[].applePay.token', apple_pay_token),
+
+        # Billing Details
+        ('payment[].billingDetails.address.address1', ""),
+        ('payment[].billingDetails.address.address2', ""),
+        ('payment[].billingDetails.address.city', ""),
+        ('payment[].billingDetails.address.country', ""),
+        ('payment[].billingDetails.address.region', ""),
+        ('payment[].billingDetails.address.zip', ""),
+        ('payment[].billingDetails.personalDetails.email', ""),
+        ('payment[].billingDetails.phone[].phone', ""),
+        ('payment[].billingDetails.personalDetails.fullName', ""),
+        ('payment[].billingDetails.personalDetails.firstName', ""),
+        ('payment[].billingDetails.personalDetails.lastName', ""),
+
+        # Credit Card
+        ('payment[].creditCard.bin', ""),
+        ('payment[].creditCard.expirationMonth', ""),
+        ('payment[].creditCard.expirationYear', ""),
+        ('payment[].creditCard.lastFourDigits', ""),
+        ('payment[].creditCard.nameOnCard', ""),
+        ('payment[].creditCard.verificationResults.processorResponseCode', ""),
+        ('payment[].creditCard.verificationResults.processorResponseText', ""),
+
+        # Tokenized Card
+        ('payment[].tokenizedCard.bin', ""),
+        ('payment[].tokenizedCard.expirationMonth', ""),
+        ('payment[].tokenizedCard.expirationYear', ""),
+        ('payment[].tokenizedCard.lastFourDigits', credit_card_last_four),
+        ('payment[].tokenizedCard.verificationResults.processorResponseCode', ""),
+        ('payment[].tokenizedCard.verificationResults.processorResponseText', ""),
+        ('payment[].tokenizedCard.verificationResults.eciValue', ""),
+        ('payment[].tokenizedCard.token', credit_card_token),
+
+        # Delivery Details
+        ('primaryDeliveryDetails.deliveryMethod', field('order.dining_option')),
+        ('primaryDeliveryDetails.deliveryType', "PHYSICAL"),
+
+        # Recipient Details
+        ('primaryRecipient.address.address1', text_field('order_address.address_line')),
+        ('primaryRecipient.address.address2', text_field('order_address.unit_number_or_company')),
+        ('primaryRecipient.address.city', text_field('order_address.city')),
+        ('primaryRecipient.address.zip', text_field('order_address.zip_code')),
+        ('primaryRecipient.address.country', "US"),
+        ('primaryRecipient.address.region', text_field('order_address.state')),
+        ('primaryRecipient.personalDetails.email', field('customer.email')),
+        ('primaryRecipient.phone[].phone', field('customer.phone')),
+
+        # Total Amount
+        ('totalAmount.amountLocalCurrency', ""),
+        ('totalAmount.amountUSD', final_amount),
+        ('totalAmount.currency', 'USD'),
+    ]
+
+
+def compile_row_mapper(columns):
+    """
+    根据列定义生成行映射函数: 常量列预先放入模板, 只对取值列调用取值器
+    订单级的列 (支付 / 地址 / 状态 / 类型 / 金额 / 客户) 每个订单只算一次: 同一订单的明细行共用同一个 order 对象且连续出现,
+    记住上一个订单算好的行, order 是同一个对象时只补上明细列 (per_item 的取值器)
+    返回的函数把 OrderLine 映射为按列顺序排列的 tuple
+    """
+    template = [value if not callable(value) else None for _, value in columns]
+    order_getters = [(index, value) for index, (_, value) in enumerate(columns)
+                     if callable(value) and not getattr(value, 'per_item', False)]
+    item_getters = [(index, value) for index, (_, value) in enumerate(columns)
+                    if callable(value) and getattr(value, 'per_item', False)]
+    # (order, 订单级的行); 整体替换, 多个线程同时映射时不会读到一半; 持有 order 的引用, 不会因 id 复用误判
+    last_order = [(None, None)]
+
+    def map_row(order_line):
+        order, order_row = last_order[0]
+        if order is None or order is not order_line.order:
+            payment = PaymentInfo(order_line)
+            order_row = template[:]
+            for index, get in order_getters:
+                order_row[index] = get(order_line, payment)
+            last_order[0] = (order_line.order, order_row)
+        row = order_row[:]
+        for index, get in item_getters:
+            row[index] = get(order_line, None)
+        return tuple(row)
+
+    return map_row
+
+
+# Parquet 输出的列类型, 其余列为字符串
+parquet_column_types = {
+    'accountOwner.created': 'int',
+    'cartItems[].basicItemData.quantity': 'int',
+    'cartItems[].basicItemData.price.amountUSD': 'decimal',
+    'checkoutTime': 'int',
+    'historicalData.orderStatus': 'dictionary',
+    'orderType': 'dictionary',
+    'primaryDeliveryDetails.deliveryMethod': 'dictionary',
+    'totalAmount.amountUSD': 'decimal',
+}
+
+# NDJSON 输出: 列名即 Forter 嵌套文档中的路径, 'x[]' 为数组; cartItems 每个明细行一个元素,
+# payment 中每种有值的支付方式一个元素
+item_array = 'cartItems[]'
+payment_array = 'payment[]'
+payment_methods = ('androidPay', 'applePay', 'creditCard', 'tokenizedCard')
+
+
+def put_path(target, parts, value):
+    """按路径写入嵌套 dict, 路径中的 'x[]' 取 (或建) 只有一个元素的数组"""
+    for part in parts[:-1]:
+        if part.endswith('[]'):
+            target = target.setdefault(part[:-2], [{}])[0]
+        else:
+            target = target.setdefault(part, {})
+    target[parts[-1]] = value
+
+
+def has_value(value):
+    if isinstance(value, dict):
+        return any(has_value(v) for v in value.values())
+    if isinstance(value, list):
+        return any(has_value(v) for v in value)
+    return value not in ("", None)
+
+
+def int_or_none(value):
+    return int(value) if value not in ("", None) else None
+
+
+def compile_document(columns, column_types):
+    """
+    根据列名生成 document(rows): 把同一订单的各行 (按 columns 排列的 tuple, 即行映射的结果) 合成一个嵌套文档,
+    字段与 CSV 各列相同; 订单级字段取第一行, cartItems 每行一个元素, payment 中 androidPay / applePay / creditCard /
+    tokenizedCard 有值的各成一个元素并带上 billingDetails; column_types 中为 int 的列写成数字, 空值写成 null
+    """
+    order_fields, item_fields, payment_fields = [], [], {}
+    for index, column in enumerate(columns):
+        parts = column.split('.')
+        convert = int_or_none if column_types.get(column) == 'int' else None
+        if parts[0] == item_array:
+            item_fields.append((index, parts[1:], convert))
+        elif parts[0] == payment_array:
+            payment_fields.setdefault(parts[1], []).append((index, parts[1:], convert))
+        else:
+            order_fields.append((index, parts, convert))
+    billing_fields = payment_fields.pop('billingDetails', [])
+    method_fields = [payment_fields.get(method, []) for method in payment_methods]
+
+    def fill(target, fields, row):
+        for index, parts, convert in fields:
+            value = row[index]
+            put_path(target, parts, convert(value) if convert else value)
+        return target
+
+    def document(rows):
+        first = rows[0]
+        doc = fill({}, order_fields, first)
+        doc['cartItems'] = [fill({}, item_fields, row) for row in rows]
+        doc['payment'] = []
+        for fields in method_fields:
+            entry = fill({}, fields, first)
+            if has_value(entry):
+                doc['payment'].append(fill(entry, billing_fields, first))
+        return doc
+
+    return document
+
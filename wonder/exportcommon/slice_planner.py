@@ -0,0 +1,98 @@
+# slice_planner.py
+import math
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta
+
+import pytz
+
+timezone = pytz.timezone('America/New_York')
+
+
+@dataclass
+class ExportSlice:
+    day: datetime
+    start_utc: datetime
+    end_utc: datetime  # 不含
+    order_count: int
+
+
+def day_range_utc(current_date):
+    """纽约时间一整天对应的 UTC 区间 [start, end)"""
+    start_of_day_ny = timezone.localize(datetime.combine(current_date, time.min))
+    start_of_next_day_ny = timezone.localize(datetime.combine(current_date + timedelta(days=1), time.min))
+    return start_of_day_ny.astimezone(pytz.UTC), start_of_next_day_ny.astimezone(pytz.UTC)
+
+
+def count_orders_by_hour(conn, count_sql, start_utc, end_utc):
+    """
+    count_sql 接收 (start, end) 两个参数, 返回 hour_start ('%Y-%m-%d %H:00:00') 和 order_count 两列
+    返回 {小时起点 (UTC): 订单数}
+    """
+    with conn.cursor(dictionary=True) as cursor:
+        cursor.execute(count_sql, (start_utc, end_utc))
+        rows = cursor.fetchall()
+
+    counts = {}
+    for row in rows:
+        hour_start = row['hour_start']
+        if isinstance(hour_start, (bytes, bytearray)):
+            hour_start = hour_start.decode()
+        if isinstance(hour_start, str):
+            hour_start = datetime.strptime(hour_start, '%Y-%m-%d %H:%M:%S')
+        counts[pytz.UTC.localize(hour_start)] = int(row['order_count'])
+    return counts
+
+
+def plan_day_slices(day, start_utc, end_utc, hourly_counts, target_orders):
+    """
+    按小时订单数把一天切成若干连续的时间片, 每片约 target_orders 单
+    相邻的小时合并到接近目标为止; 单个小时超过目标时按时间等分 (假设小时内分布均匀)
+    """
+    slices = []
+    pending_start = None
+    pending_count = 0
+
+    hour_start = start_utc
+    while hour_start < end_utc:
+        hour_end = min(hour_start + timedelta(hours=1), end_utc)
+        count = hourly_counts.get(hour_start, 0)
+
+        if count > target_orders:
+            if pending_start is not None:
+                slices.append(ExportSlice(day, pending_start, hour_start, pending_count))
+                pending_start = None
+                pending_count = 0
+            parts = math.ceil(count / target_orders)
+            # 边界取整到秒, 与 DATETIME 列的精度一致
+            step = timedelta(seconds=(hour_end - hour_start).total_seconds() // parts)
+            for i in range(parts):
+                part_start = hour_start + step * i
+                part_end = hour_end if i == parts - 1 else part_start + step
+                slices.append(ExportSlice(day, part_start, part_end, count // parts))
+        else:
+            if pending_start is None:
+                pending_start = hour_start
+            pending_count += count
+            if pending_count >= target_orders:
+                slices.append(ExportSlice(day, pending_start, hour_end, pending_count))
+                pending_start = None
+                pending_count = 0
+
+        hour_start = hour_end
+
+    if pending_start is not None:
+        slices.append(ExportSlice(day, pending_start, end_utc, pending_count))
+    return slices
+
+
+def plan_export_slices(conn, count_sql, dates, target_orders):
+    """每天一条按小时 COUNT 的查询, 再切分成时间片; target_orders <= 0 时每天一个时间片"""
+    slices = []
+    for current_date in dates:
+        start_utc, end_utc = day_range_utc(current_date)
+        if target_orders <= 0:
+            slices.append(ExportSlice(current_date, start_utc, end_utc, -1))
+            continue
+        hourly_counts = count_orders_by_hour(conn, count_sql, start_utc, end_utc)
+        slices.extend(plan_day_slices(current_date, start_utc, end_utc, hourly_counts, target_orders))
+    return slices
@@ -0,0 +1,111 @@
+# transform_pool.py
+import csv
+import io
+import math
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# 一批的转换结果: chunk 为行列表或 CSV 文本; first_key / last_key 为首末行 key_index 列的值, 用于分片清单
+# order_offsets: chunk 为 CSV 文本时每个订单 (key_index 列相同的连续行) 一项 (文本偏移, 行序号, key), 分片可以在订单边界处切开文本
+MappedBatch = namedtuple('MappedBatch', ['chunk', 'row_count', 'seconds', 'first_key', 'last_key', 'order_offsets'],
+                         defaults=[None])
+
+
+def container_cpu_limit():
+    """容器的 CPU 限额 (cgroup v2 cpu.max, v1 cpu.cfs_quota_us), 未设置限额时为可用的 CPU 数"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    quota = period = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = f.read().strip()
+        except OSError:
+            pass
+
+    if quota and quota not in ('max', '-1') and period:
+        cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    return cpus
+
+
+def resolve_transform_processes(value):
+    """TRANSFORM_PROCESSES: auto 按 CPU 限额, 限额不足 2 核时不启用; 0 表示在取数线程内转换"""
+    if value == 'auto':
+        processes = container_cpu_limit()
+        return processes if processes >= 2 else 0
+    return int(value)
+
+
+def map_rows(map_row, items, encode_csv, key_index=None):
+    """
+    在子进程中执行: 把一批原始数据映射成行, encode_csv 时直接编码成 CSV 文本返回, 减少回传的对象
+    返回 MappedBatch
+    """
+    start = time.perf_counter()
+    rows = [map_row(item) for item in items]
+    first_key = rows[0][key_index] if rows and key_index is not None else None
+    last_key = rows[-1][key_index] if rows and key_index is not None else None
+    if not encode_csv:
+        return MappedBatch(rows, len(rows), time.perf_counter() - start, first_key, last_key)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if key_index is None:
+        writer.writerows(rows)
+        return MappedBatch(buffer.getvalue(), len(rows), time.perf_counter() - start, first_key, last_key)
+    order_offsets = []
+    for index, row in enumerate(rows):
+        if not order_offsets or row[key_index] != order_offsets[-1][2]:
+            order_offsets.append((buffer.tell(), index, row[key_index]))
+        writer.writerow(row)
+    return MappedBatch(buffer.getvalue(), len(rows), time.perf_counter() - start, first_key, last_key, order_offsets)
+
+
+class TransformStage:
+    """
+    行映射 / CSV 编码放到进程池中执行, 绕开 GIL; 取数线程只负责查询和组装
+    processes 为 0 时在调用线程内直接转换
+    进程池在第一次提交时创建, 使用 spawn 避免 fork 带走连接池和其他线程持有的锁
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def submit(self, map_row, items, encode_csv, key_index=None):
+        if self.processes <= 0:
+            future = Future()
+            try:
+                future.set_result(map_rows(map_row, items, False, key_index))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self._get_executor().submit(map_rows, map_row, items, encode_csv, key_index)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+def write_transformed(writer, result):
+    if isinstance(result.chunk, str):
+        writer.write_encoded(result.chunk, result.row_count, result.first_key, result.last_key, result.order_offsets)
+    else:
+        writer.write_rows(result.chunk)
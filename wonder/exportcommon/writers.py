@@ -0,0 +1,646 @@
+# writers.py
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+from decimal import Decimal
+from functools import partial
+
+output_extensions = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'ndjson': '.ndjson',
+}
+
+# CSV / NDJSON 压缩后的文件后缀; Parquet 在文件内部按列压缩, 文件名不变
+compression_extensions = {
+    '': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+class CsvStreamWriter:
+    """
+    按页追加写入 CSV, 内存中只保留当前页
+    第一次写入时创建临时文件并写表头, close() 时原子重命名为目标文件; 没有写入任何行则不生成文件
+    给了 key_index 时记录写入的第一行 / 最后一行在该列上的值 (first_key / last_key), 用于分片清单
+    """
+
+    def __init__(self, filepath, columns, compression='', header=True, key_index=None):
+        self.filepath = filepath
+        self.columns = columns
+        self.compression = compression
+        self.header = header
+        self.key_index = key_index
+        self.tmp_path = f"{filepath}.tmp"
+        self.row_count = 0
+        self.first_key = None
+        self.last_key = None
+        self._file = None
+        self._writer = None
+        # 交给文件流的字符 / 字节数 (压缩前), 以及临时文件上一次变大时的文件大小和当时的这个数, 用于 size() 估算
+        self._written = 0
+        self._header_written = 0
+        self._disk_size = 0
+        self._disk_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def _open(self):
+        self._file = open_text_stream(self.tmp_path, self.compression)
+        self._writer = csv.writer(self._file, lineterminator='\n')
+        if self.header:
+            self._header_written = self._writer.writerow(self.columns)
+            self._written += self._header_written
+
+    def write_rows(self, rows):
+        """rows: 按 columns 顺序排列的序列"""
+        for row in rows:
+            if self._writer is None:
+                self._open()
+            self._written += self._writer.writerow(row)
+            self.row_count += 1
+            self._track_key(row)
+
+    def write_encoded(self, text, row_count, first_key=None, last_key=None, order_offsets=None):
+        """写入已编码好的 CSV 文本块 (不含表头), first_key / last_key 为块内首末行的 key; order_offsets 只有 ShardedWriter 用到"""
+        if not row_count:
+            return
+        if self._writer is None:
+            self._open()
+        self._written += self._file.write(text)
+        self.row_count += row_count
+        if self.first_key is None:
+            self.first_key = first_key
+        if last_key is not None:
+            self.last_key = last_key
+
+    def _track_key(self, row):
+        if self.key_index is None:
+            return
+        if self.first_key is None:
+            self.first_key = row[self.key_index]
+        self.last_key = row[self.key_index]
+
+    def size(self, exact=False):
+        """
+        输出文件当前的字节数 (估计值): 不压缩时为已交给文件流的字节数 (含还在缓冲中的部分);
+        压缩时为已落盘的字节数, 加上还在压缩器中的部分按已落盘部分的压缩比折算 (还没有压缩块落盘时按压缩前的字节数)
+        exact 时先把缓冲和压缩器 flush 到文件再计算
+        """
+        if exact and self._file is not None:
+            self._file.flush()
+        disk_size = os.path.getsize(self.tmp_path) if os.path.exists(self.tmp_path) else 0
+        if not self.compression:
+            return max(disk_size, self._written)
+        if disk_size != self._disk_size:
+            self._disk_size, self._disk_written = disk_size, self._written
+        ratio = disk_size / self._disk_written if self._disk_written else 1.0
+        return disk_size + int((self._written - self._disk_written) * ratio)
+
+    def sized_rows(self):
+        """size() 中已经计入的行数; NDJSON 还没写出的最后一个订单 / Parquet 还在攒的 row group 不计"""
+        return self.row_count
+
+    def estimate_bytes(self, size, rows, orders):
+        """文件当前为 size 字节时, 再写入 rows 行 (orders 个订单) 的估计字节数, 按已写的行 (不含表头) 的平均大小"""
+        if not self.sized_rows() or not self._written:
+            return 0
+        return size * (self._written - self._header_written) / self._written / self.sized_rows() * rows
+
+    def close(self):
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        os.replace(self.tmp_path, self.filepath)
+        return self.filepath
+
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class ParquetStreamWriter(CsvStreamWriter):
+    """
+    按页写入带类型的 Parquet, 攒满 row_group_size 行写一个 row group
+    column_types: {列名: 'decimal' | 'int' | 'dictionary'}, 未列出的列为字符串
+    'decimal' / 'int' 列的空串写为 null; 'dictionary' 列做字典编码
+    """
+
+    def __init__(self, filepath, columns, column_types=None, compression='', row_group_size=10000, key_index=None):
+        super().__init__(filepath, columns, compression, key_index=key_index)
+        self.column_types = column_types or {}
+        self.row_group_size = row_group_size
+        self._pending = []
+        self._schema = None
+
+    def _open(self):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("OUTPUT_FORMAT=parquet 需要安装 pyarrow")
+
+        arrow_types = {
+            'decimal': pa.decimal128(38, 10),
+            'int': pa.int64(),
+            'dictionary': pa.dictionary(pa.int32(), pa.string()),
+        }
+        self._schema = pa.schema([
+            (column, arrow_types.get(self.column_types.get(column), pa.string()))
+            for column in self.columns
+        ])
+        dictionary_columns = [c for c in self.columns if self.column_types.get(c) == 'dictionary']
+        self._file = pq.ParquetWriter(self.tmp_path, self._schema, use_dictionary=dictionary_columns or False,
+                                      compression=self.compression or 'snappy')
+
+    def write_rows(self, rows):
+        for row in rows:
+            self._pending.append(row)
+            self.row_count += 1
+            self._track_key(row)
+            if len(self._pending) >= self.row_group_size:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        import pyarrow as pa
+
+        if self._file is None:
+            self._open()
+        arrays = []
+        for index, column in enumerate(self.columns):
+            values = [convert_value(row[index], self.column_types.get(column)) for row in self._pending]
+            arrays.append(pa.array(values, type=self._schema.field(column).type))
+        self._file.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+        self._pending = []
+
+    def size(self, exact=False):
+        """已写出的 row group 的字节数, 还在攒的 row group 不计; 不为估算提前写出不满的 row group"""
+        return os.path.getsize(self.tmp_path) if os.path.exists(self.tmp_path) else 0
+
+    def sized_rows(self):
+        return self.row_count - len(self._pending)
+
+    def estimate_bytes(self, size, rows, orders):
+        return size / self.sized_rows() * rows if self.sized_rows() else 0
+
+    def close(self):
+        self._flush()
+        return super().close()
+
+    def abort(self):
+        self._pending = []
+        super().abort()
+
+
+class NdjsonStreamWriter(CsvStreamWriter):
+    """
+    每行一个 JSON 文档 (NDJSON), 用 orjson 编码, 写入时即压缩
+    给了 document 和 key_index 时, key_index 列相同的连续行 (同一订单的各明细行) 由 document(rows) 合成一个嵌套文档,
+    下一个 key 的行到达或 close() 时写出; 否则每行写成一个 {列名: 值} 的扁平文档
+    row_count / first_key / last_key 只统计已写出的文档中的行
+    """
+
+    def __init__(self, filepath, columns, compression='', key_index=None, document=None):
+        super().__init__(filepath, columns, compression, header=False, key_index=key_index)
+        self.document = document if key_index is not None else None
+        self.document_count = 0
+        self._pending = []
+        self._dumps = None
+
+    def _open(self):
+        try:
+            import orjson
+        except ImportError:
+            raise RuntimeError("OUTPUT_FORMAT=ndjson 需要安装 orjson")
+        self._dumps = partial(orjson.dumps, default=str, option=orjson.OPT_APPEND_NEWLINE)
+        self._file = open_binary_stream(self.tmp_path, self.compression)
+
+    def write_rows(self, rows):
+        if self.document is None:
+            for row in rows:
+                self._write_document([row])
+            return
+        for row in rows:
+            if self._pending and row[self.key_index] != self._pending[0][self.key_index]:
+                self._write_document(self._pending)
+                self._pending = []
+            self._pending.append(row)
+
+    def write_encoded(self, text, row_count, first_key=None, last_key=None, order_offsets=None):
+        raise ValueError("NDJSON 输出只接受按列排列的行, 不接受编码好的 CSV 文本")
+
+    def _write_document(self, rows):
+        if self._file is None:
+            self._open()
+        document = self.document(rows) if self.document else dict(zip(self.columns, rows[0]))
+        self._written += self._file.write(self._dumps(document))
+        self.document_count += 1
+        self.row_count += len(rows)
+        self._track_key(rows[0])
+        self._track_key(rows[-1])
+
+    def estimate_bytes(self, size, rows, orders):
+        """合成嵌套文档时订单级字段只写一次, 按文档和按行的平均大小各估一次, 取较大的"""
+        by_rows = super().estimate_bytes(size, rows, orders)
+        if self.document is None or not self.document_count:
+            return by_rows
+        return max(by_rows, size / self.document_count * orders)
+
+    def close(self):
+        if self._pending:
+            self._write_document(self._pending)
+            self._pending = []
+        return super().close()
+
+    def abort(self):
+        self._pending = []
+        super().abort()
+
+
+def convert_value(value, column_type):
+    if column_type == 'decimal':
+        return None if value == "" or value is None else Decimal(str(value))
+    if column_type == 'int':
+        return None if value == "" or value is None else int(value)
+    return None if value is None else str(value)
+
+
+def open_text_stream(path, compression):
+    """写入时即压缩的文本流, 不需要导出结束后再整体压缩一遍"""
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', newline='', encoding='utf-8')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("OUTPUT_COMPRESSION=zstd 需要安装 zstandard")
+        stream = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(stream, newline='', encoding='utf-8')
+    return open(path, 'w', newline='', encoding='utf-8')
+
+
+def open_binary_stream(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("OUTPUT_COMPRESSION=zstd 需要安装 zstandard")
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+
+def compress_bytes(data, compression):
+    if compression == 'gzip':
+        return gzip.compress(data)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def output_path(output_format, base_path, compression=''):
+    """base_path 不带扩展名, 按输出格式和压缩方式补上 .csv / .csv.gz / .csv.zst / .ndjson(.gz / .zst) / .parquet"""
+    if output_format not in output_extensions:
+        raise ValueError(f"不支持的输出格式: {output_format}")
+    if compression not in compression_extensions:
+        raise ValueError(f"不支持的压缩方式: {compression}")
+    if output_format == 'parquet':
+        return base_path + output_extensions[output_format]
+    return base_path + output_extensions[output_format] + compression_extensions[compression]
+
+
+def open_writer(output_format, base_path, columns, column_types=None, compression='', header=True, key_index=None,
+                document=None):
+    """
+    header=False 时 CSV 不写表头, 用于之后拼接的分段文件
+    document: NDJSON 把同一 key 的连续行合成嵌套文档的函数, 见 NdjsonStreamWriter; 其他格式忽略
+    """
+    filepath = output_path(output_format, base_path, compression)
+    if output_format == 'parquet':
+        return ParquetStreamWriter(filepath, columns, column_types, compression, key_index=key_index)
+    if output_format == 'ndjson':
+        return NdjsonStreamWriter(filepath, columns, compression, key_index, document)
+    return CsvStreamWriter(filepath, columns, compression, header, key_index)
+
+
+class ShardedWriter:
+    """
+    按行数 / 字节数滚动的输出文件: 当前分片再写一个订单会超过 max_rows 行 / max_bytes 字节时关闭,
+    从这个订单起写入新分片 <base_path>_p{n}
+    一批按 key_index 列拆成订单逐个检查阈值, 只在订单边界处滚动, 同一订单不会拆到两个分片里; 单个订单超过 max_rows 时独占一个分片
+    字节数按 writer.size() 估算, 分片可能略超过 max_bytes
+    每个分片关闭时算出 shard_entry (行数 / 字节数 / 首末 orderId / sha256) 并回调 on_shard(filepath, entry)
+    write_manifest 时 close() 写 <base_path>.manifest.json; 由调用方汇总多个 writer 的分片时传 False
+    max_rows 和 max_bytes 都为 0 时不滚动; numbered 默认只在滚动时给文件名加 _p{n}, 不滚动时数据文件与普通 writer 相同
+    header=False / checksum=False 用于之后还要拼接的中间文件: CSV 不写表头, 分片项不算 sha256
+    """
+
+    def __init__(self, output_format, base_path, columns, column_types=None, compression='', key_index=None,
+                 max_rows=0, max_bytes=0, next_shard=None, on_shard=None, write_manifest=True, numbered=None,
+                 document=None, header=True, checksum=True):
+        self.output_format = output_format
+        self.base_path = base_path
+        self.columns = columns
+        self.column_types = column_types
+        self.compression = compression
+        self.key_index = key_index
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.numbered = (max_rows > 0 or max_bytes > 0) if numbered is None else numbered
+        self.next_shard = next_shard or itertools.count(1).__next__
+        self.on_shard = on_shard
+        self.write_manifest = write_manifest
+        self.document = document
+        self.header = header
+        self.checksum = checksum
+        self.shards = []
+        self.row_count = 0
+        # close() 之后: 不分片时为输出文件, 否则为分片清单
+        self.filepath = None
+        self._writer = None
+        self._shard_paths = []
+        # 当前分片已接收的行数 (含 NDJSON 还没写出的最后一个订单) 和最后一行的 key
+        self._shard_rows = 0
+        self._last_key = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def _current(self):
+        if self._writer is None:
+            base_path = f"{self.base_path}_p{self.next_shard()}" if self.numbered else self.base_path
+            self._writer = open_writer(self.output_format, base_path, self.columns, self.column_types,
+                                       self.compression, self.header, self.key_index, self.document)
+            self._shard_rows = 0
+        return self._writer
+
+    def write_rows(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        if not self.max_rows and not self.max_bytes:
+            self._write_rows(rows)
+            return
+        for order_rows in self._orders(rows):
+            self._roll(len(order_rows), order_rows[0][self.key_index] if self.key_index is not None else None)
+            self._write_rows(order_rows)
+
+    def _write_rows(self, rows):
+        self._current().write_rows(rows)
+        self._shard_rows += len(rows)
+        self.row_count += len(rows)
+        if self.key_index is not None:
+            self._last_key = rows[-1][self.key_index]
+
+    def _orders(self, rows):
+        if self.key_index is None:
+            return ([row] for row in rows)
+        return (list(group) for _, group in itertools.groupby(rows, key=lambda row: row[self.key_index]))
+
+    def write_encoded(self, text, row_count, first_key=None, last_key=None, order_offsets=None):
+        """
+        order_offsets: [(文本偏移, 行序号, key)], 每个订单一项 (见 transform_pool.map_rows)
+        整块放得进当前分片时直接写入; 否则按 order_offsets 在订单边界处切开文本, 逐个订单检查阈值
+        没有 order_offsets 时整块作为一个订单处理
+        """
+        if not row_count:
+            return
+        if order_offsets and self._crosses_limit(row_count, len(text.encode('utf-8'))):
+            bounds = order_offsets + [(len(text), row_count, None)]
+            for (offset, row_index, key), (next_offset, next_row_index, _) in zip(bounds, bounds[1:]):
+                self._roll(next_row_index - row_index, key)
+                self._write_encoded(text[offset:next_offset], next_row_index - row_index, key, key)
+            return
+        self._roll(row_count, first_key)
+        self._write_encoded(text, row_count, first_key, last_key)
+
+    def _write_encoded(self, text, row_count, first_key, last_key):
+        self._current().write_encoded(text, row_count, first_key, last_key)
+        self._shard_rows += row_count
+        self.row_count += row_count
+        self._last_key = last_key
+
+    def _crosses_limit(self, row_count, byte_count):
+        """当前分片 (还没打开时为空分片, 只有 CSV 表头) 再写入 row_count 行 / byte_count 字节是否会超过阈值"""
+        if self._writer is not None:
+            shard_rows, shard_bytes = self._shard_rows, self._writer.size()
+        else:
+            shard_rows = 0
+            shard_bytes = len(csv_header(self.columns, self.compression)) if self.output_format == 'csv' and \
+                self.header else 0
+        return bool((self.max_rows and shard_rows + row_count > self.max_rows) or
+                    (self.max_bytes and shard_bytes + byte_count > self.max_bytes))
+
+    def _roll(self, order_rows, key):
+        """
+        写入下一个订单 (order_rows 行, key) 之前检查阈值; 与上一行同一 key 的续行不换分片
+        订单的字节数按当前分片已写部分的平均大小估算, 见 estimate_bytes
+        """
+        writer = self._writer
+        if writer is None or (key is not None and key == self._last_key):
+            return
+        if self.max_rows and self._shard_rows + order_rows > self.max_rows:
+            self._close_shard()
+        elif self.max_bytes and self._bytes_after(writer, order_rows) > self.max_bytes and \
+                self._bytes_after(writer, order_rows, exact=True) > self.max_bytes:
+            # 估算值超过阈值时 flush 一次取准确的字节数再决定, 压缩流不会因为还没落盘的部分按压缩前计算而过早滚动
+            self._close_shard()
+
+    def _bytes_after(self, writer, order_rows, exact=False):
+        """当前分片再写入 order_rows 行 (一个订单) 后的字节数; 还没计入 size() 的行 (NDJSON 的上一个订单) 一并估算"""
+        size = writer.size(exact)
+        unsized_rows = self._shard_rows - writer.sized_rows()
+        return size + writer.estimate_bytes(size, unsized_rows + order_rows, 2 if unsized_rows else 1)
+
+    def _close_shard(self):
+        writer, self._writer = self._writer, None
+        filepath = writer.close() if writer is not None else None
+        if filepath is None:
+            return
+        entry = shard_entry(filepath, writer.row_count, writer.first_key, writer.last_key, self.checksum)
+        self.shards.append(entry)
+        self._shard_paths.append(filepath)
+        if self.on_shard is not None:
+            self.on_shard(filepath, entry)
+
+    def close(self):
+        self._close_shard()
+        if not self.shards:
+            return None
+        manifest_path = write_shard_manifest(self.base_path, self.shards) if self.write_manifest else None
+        self.filepath = manifest_path if self.numbered and manifest_path else self._shard_paths[-1]
+        return self.filepath
+
+    def abort(self):
+        """丢弃当前分片; 自己写清单时已关闭的分片没有别人记录, 一并删除"""
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+        if self.write_manifest:
+            for filepath in self._shard_paths:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+
+
+def file_sha256(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def shard_entry(filepath, rows, first_key, last_key, checksum=True):
+    """分片清单中的一项; 下游按分片并行上传 / 加载时, 用 bytes 和 sha256 校验而不必重新读一遍全部数据"""
+    entry = {
+        'file': os.path.basename(filepath),
+        'rows': rows,
+        'bytes': os.path.getsize(filepath),
+        'first_order_id': first_key,
+        'last_order_id': last_key,
+    }
+    if checksum:
+        entry['sha256'] = file_sha256(filepath)
+    return entry
+
+
+def write_shard_manifest(base_path, shards):
+    """<base_path>.manifest.json: 按顺序列出全部分片, 写临时文件后原子替换"""
+    path = f"{base_path}.manifest.json"
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump({
+            'rows': sum(shard['rows'] for shard in shards),
+            'bytes': sum(shard['bytes'] for shard in shards),
+            'shards': shards,
+        }, f, ensure_ascii=False, indent=1)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def concat_segments(output_format, base_path, columns, segment_paths, compression='', row_group_size=10000):
+    """
+    把按顺序写好的分段文件拼成一个输出文件, 返回文件路径; 分段都没有数据时不生成文件
+    CSV 分段不带表头, 直接按字节拼接 (gzip 多个 member / zstd 多个 frame 拼接后仍是合法文件); NDJSON 同样按字节拼接
+    Parquet 按 row_group_size 重新攒 row group, 避免很多小分段拼出很多小 row group
+    """
+    segment_paths = [path for path in segment_paths if path and os.path.exists(path)]
+    if not segment_paths:
+        return None
+    filepath = output_path(output_format, base_path, compression)
+    tmp_path = f"{filepath}.tmp"
+
+    if output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        pending = []
+        pending_rows = 0
+        try:
+            for path in segment_paths:
+                segment = pq.ParquetFile(path)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, segment.schema_arrow, compression=compression or 'snappy')
+                for index in range(segment.num_row_groups):
+                    table = segment.read_row_group(index)
+                    pending.append(table)
+                    pending_rows += table.num_rows
+                    if pending_rows >= row_group_size:
+                        writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+                        pending = []
+                        pending_rows = 0
+            if pending:
+                writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        with open(tmp_path, 'wb') as out:
+            if output_format == 'csv':
+                out.write(csv_header(columns, compression))
+            for path in segment_paths:
+                with open(path, 'rb') as segment:
+                    shutil.copyfileobj(segment, out)
+
+    os.replace(tmp_path, filepath)
+    return filepath
+
+
+def csv_header(columns, compression=''):
+    """拼接分段时单独写在最前面的 CSV 表头 (压缩时自成一个 gzip member / zstd frame)"""
+    header = io.StringIO()
+    csv.writer(header, lineterminator='\n').writerow(columns)
+    return compress_bytes(header.getvalue().encode('utf-8'), compression)
+
+
+def segment_max_bytes(output_format, columns, max_bytes, compression=''):
+    """写分段时的字节数阈值: 分片的 max_bytes 减去拼接时加上的 CSV 表头"""
+    if not max_bytes or output_format != 'csv':
+        return max_bytes
+    return max(max_bytes - len(csv_header(columns, compression)), 1)
+
+
+def concat_segment_shards(output_format, base_path, columns, segments, compression='',
+                          max_rows=0, max_bytes=0, row_group_size=10000):
+    """
+    把按顺序写好的分段拼成按 max_rows / max_bytes 滚动的分片, 写分片清单, 返回分片清单中的各项
+    segments: [{'path', 'rows', 'first_order_id', 'last_order_id'}]; 分段写入时已由 ShardedWriter 按同样的阈值切开,
+    这里只把相邻的分段合并成不超过阈值的分片, 分段本身不拆开
+    max_rows 和 max_bytes 都为 0 时拼成一个不带 _p{n} 的文件, 与 concat_segments 相同
+    """
+    segments = [segment for segment in segments if segment['path'] and os.path.exists(segment['path'])]
+    sharded = max_rows > 0 or max_bytes > 0
+    max_bytes = segment_max_bytes(output_format, columns, max_bytes, compression)
+    groups = []
+    rows = size = 0
+    for segment in segments:
+        segment_size = os.path.getsize(segment['path'])
+        if not groups or (sharded and ((max_rows and rows + segment['rows'] > max_rows) or
+                                       (max_bytes and size + segment_size > max_bytes))):
+            groups.append([])
+            rows = size = 0
+        groups[-1].append(segment)
+        rows += segment['rows']
+        size += segment_size
+
+    shards = []
+    for number, group in enumerate(groups, 1):
+        filepath = concat_segments(output_format, f"{base_path}_p{number}" if sharded else base_path, columns,
+                                   [segment['path'] for segment in group], compression, row_group_size)
+        keyed = [segment for segment in group if segment['rows']]
+        shards.append(shard_entry(filepath, sum(segment['rows'] for segment in group),
+                                  keyed[0].get('first_order_id') if keyed else None,
+                                  keyed[-1].get('last_order_id') if keyed else None))
+    if shards:
+        write_shard_manifest(base_path, shards)
+    return shards
@@ -1,29 +1,51 @@
 # order_exporter.py
+import asyncio
 import logging
 import os
+import queue
+import random
 import sys
 import time as totalTime
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime, time, timedelta
+from datetime import datetime, timedelta
 
 import mysql.connector
-import pandas as pd
-import pytz
+
+# 公共模块在上一级目录的 exportcommon 包中 (镜像里与工具同在 /app 下, 不需要这一步)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exportcommon.archive import ResultArchive, check_archive_path
+from exportcommon.autotune import calibrate, max_pool_size
+from exportcommon.checkpoint import CheckpointManifest
+from exportcommon.metrics import StageMetrics
+from exportcommon.pipeline import ExportPipeline
+from exportcommon.preflight import preflight_query, run_preflight
+from exportcommon.replicas import ReplicaRouter, parse_hosts
+from exportcommon.slice_planner import ExportSlice, day_range_utc, plan_export_slices
+from exportcommon.transform_pool import TransformStage, resolve_transform_processes, write_transformed
+from exportcommon.writers import ShardedWriter, output_path, shard_entry, write_shard_manifest
 
 from models import (
     Order, Customer, OrderItem, OrderChargeItem, OrderCharge,
     OrderPayment, StripePaymentIntent,
     OrderAddress, OrderLine, OrderFlag
 )
+from row_mapper import csv_columns, order_document, order_line_to_row, parquet_column_types
 
 db_config = {
     'host': os.getenv('DB_HOST'),
     'user': os.getenv('DB_USER'),
     'password': os.getenv('DB_PASSWORD'),
     'pool_name': 'custom_connection_pool',
+    # AUTOTUNE=off 时的连接数; 否则按校准结果重新设置, 时间片数和逐单组装线程数随之调整
     'pool_size': 20
 }
 
+# 逗号分隔的只读副本 (host 或 host:port), 每个副本一个连接池, 时间片按负载分到各副本; 为空时只用 DB_HOST
+# 副本的分页查询延迟超过其他副本最低延迟的 REPLICA_EJECT_FACTOR 倍时, 摘除 REPLICA_EJECT_SECONDS 秒
+replicas = ReplicaRouter(parse_hosts(os.getenv('DB_HOSTS', ''), db_config['host']), db_config['pool_name'],
+                         float(os.getenv('REPLICA_EJECT_FACTOR', '3')), float(os.getenv('REPLICA_EJECT_SECONDS', '60')))
+
 logging.basicConfig(
     level=logging.INFO,
     stream=sys.stdout,
@@ -33,129 +55,302 @@ logging.basicConfig(
 
 output_dir = os.getenv('OUTPUT_DIR', '/app/export_results')
 
-
-def export_single_day(current_date):
-    logging.info(f"开始处理日期: {current_date.strftime('%Y-%m-%d')}")
+# service: 导出完成后 sleep, 等待 kubectl exec tar / kubectl cp 取走结果
+# job: 每完成一天就把当天的分片和分片清单追加进 ARCHIVE_PATH (tar), 结束后封口并退出, 全部成功时退出码为 0, 否则为 1
+run_mode = os.getenv('RUN_MODE', 'service')
+# ARCHIVE_PATH 必须在单独挂载的持久卷上 (不能在 OUTPUT_DIR 下), 例如 /app/archive/legacy_order_history_results.tar
+archive_path = os.getenv('ARCHIVE_PATH', '')
+# job 模式的结果归档, main() 中创建
+result_archive = None
+
+# csv | parquet | ndjson (每个订单一行嵌套的 JSON 文档, 含 cartItems / payment 数组)
+output_format = os.getenv('OUTPUT_FORMAT', 'csv')
+# 空 | gzip | zstd, 写文件时直接压缩
+output_compression = os.getenv('OUTPUT_COMPRESSION', '')
+
+# keyset: 按 (created_time, id) 续读分页; offset: LIMIT/OFFSET 分页
+# stream: 一条无缓冲查询扫描整天, 按 page_size 分批取行
+order_scan_mode = os.getenv('ORDER_SCAN_MODE', 'keyset')
+page_size = 1000
+
+# 按小时订单数把日期切成约 SLICE_TARGET_ORDERS 单的时间片并发导出, 各时间片按 SHARD_MAX_ROWS 行继续拆分文件; 0 表示每天一个单元
+slice_target_orders = int(os.getenv('SLICE_TARGET_ORDERS', '20000'))
+
+# 行映射和 CSV 编码在进程池中执行; auto 按容器 CPU 限额决定进程数, 0 表示在导出线程内转换
+transform_stage = TransformStage(resolve_transform_processes(os.getenv('TRANSFORM_PROCESSES', 'auto')))
+
+# 每个时间片 取数 (分页查询 + 逐单组装) / 转换 / 写文件三段并发, 段间队列长度为 PIPELINE_QUEUE_SIZE 页
+# 队列满时取数阻塞, 内存中最多保留约 2 * PIPELINE_QUEUE_SIZE 页的明细, 不再攒满 80000 行再导出
+pipeline_queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', '4'))
+# 线程引擎每个时间片逐单组装的线程数上限 (每个线程占用一条连接), 实际值按连接池大小分配
+pipeline_fetch_workers = int(os.getenv('PIPELINE_FETCH_WORKERS', '15'))
+# 每个时间片同时在转换的页数, 0 表示与转换进程数相同
+pipeline_map_workers = int(os.getenv('PIPELINE_MAP_WORKERS', '0')) or max(1, transform_stage.processes)
+# 输出文件按行数 / 字节数 (0 表示不限) 在订单边界处滚动, 日期完成时按时间顺序编号为 orders_{day}_p{n} 并写 orders_{day}.manifest.json
+# (每个分片的行数 / 字节数 / 首末 orderId / sha256), 下游可以按分片并行上传 / 加载并校验
+shard_max_rows = int(os.getenv('SHARD_MAX_ROWS', '80000'))
+shard_max_bytes = int(os.getenv('SHARD_MAX_BYTES', '0'))
+
+# threads: 每个订单在线程池中占用一条连接逐表查询
+# asyncio: 单线程事件循环, 各订单的子表查询在少量连接上并发执行 (需要 aiomysql)
+extraction_engine = os.getenv('EXTRACTION_ENGINE', 'threads')
+# asyncio 引擎同时在途的订单数; 连接数取它和连接池大小中较小的一个
+async_concurrency = int(os.getenv('ASYNC_CONCURRENCY', '200'))
+
+# 各阶段耗时 (订单分页查询 / 子表查询 / 对象构造 / 行映射 / 写文件) 按阶段和日期汇总
+# 每 METRICS_INTERVAL_SECONDS 秒写一次 OUTPUT_DIR/legacy_order_export.prom (Prometheus textfile) 和 .json, 0 表示只在结束时写
+metrics = StageMetrics('legacy_order_export')
+metrics_interval_seconds = int(os.getenv('METRICS_INTERVAL_SECONDS', '30'))
+
+# 导出的日期范围 (纽约时间, 含两端)
+export_start_date = datetime(2025, 8, 10)
+export_end_date = datetime(2025, 8, 10)
+
+# 每个副本同时导出的时间片数上限; 线程引擎每片占用 1 条扫描连接 + 逐单组装线程各 1 条连接
+slice_workers = int(os.getenv('SLICE_WORKERS', '8'))
+
+# 启动时探测从库在不同并发下的吞吐和延迟, 取拐点作为连接池大小, 结果写入 OUTPUT_DIR/autotune.json
+# auto: 沿用 AUTOTUNE_MAX_AGE_HOURS 小时内同一数据库的结果, 否则重新探测; force: 每次探测; off: 使用 pool_size
+autotune_mode = os.getenv('AUTOTUNE', 'auto')
+autotune_max_age_hours = float(os.getenv('AUTOTUNE_MAX_AGE_HOURS', '24'))
+autotune_probe_seconds = float(os.getenv('AUTOTUNE_PROBE_SECONDS', '2'))
+
+# 开始导出前在每个副本上 EXPLAIN 将要执行的查询, 报告用到的索引和估计行数
+# warn: 有全表扫描 / filesort 时只记录警告; strict: 拒绝开始导出; off: 跳过
+preflight_mode = os.getenv('PREFLIGHT', 'warn')
+
+searchOrderSql = """
+    SELECT id, user_id, order_channel, dining_option, order_date, created_time, status, remake_ref_order_id
+    FROM `order`.orders
+    WHERE created_time >= %s AND created_time < %s
+    AND brand_category = 'BLUE_APRON'
+    AND order_channel = 'BA_LEGACY'
+    AND status in ('CANCELED', 'COMPLETE')
+"""
+
+# 按 (created_time, id) 续读的分页查询: 第一页 / 之后各页; offset 模式用 LIMIT / OFFSET
+firstOrderPageSql = searchOrderSql + """
+    ORDER BY created_time, id
+    LIMIT %s
+"""
+
+nextOrderPageSql = searchOrderSql + """
+    AND (created_time > %s OR (created_time = %s AND id > %s))
+    ORDER BY created_time, id
+    LIMIT %s
+"""
+
+offsetOrderPageSql = searchOrderSql + """
+    LIMIT %s OFFSET %s
+"""
+
+countOrdersByHourSql = """
+    SELECT DATE_FORMAT(created_time, '%Y-%m-%d %H:00:00') AS hour_start, COUNT(*) AS order_count
+    FROM `order`.orders
+    WHERE created_time >= %s AND created_time < %s
+    AND brand_category = 'BLUE_APRON'
+    AND order_channel = 'BA_LEGACY'
+    AND status in ('CANCELED', 'COMPLETE')
+    GROUP BY hour_start
+"""
+
+order_id_index = csv_columns.index('orderId')
+
+
+def export_slice(export_slice: ExportSlice, checkpoint):
+    label = (f"{export_slice.day.strftime('%Y-%m-%d')} [{export_slice.start_utc.strftime('%m-%d %H:%M:%S')}, "
+             f"{export_slice.end_utc.strftime('%m-%d %H:%M:%S')}) UTC")
 
     conn = None
+    with replicas.lease() as replica:
+        try:
+            discard_slice_progress(checkpoint, export_slice.day)
+            conn = replicas.connect(replica)
+            return process_time_range(conn, export_slice.day, export_slice.start_utc, export_slice.end_utc,
+                                      f"{label} ({replica.host})" if len(replicas.replicas) > 1 else label, checkpoint)
+        except mysql.connector.Error as err:
+            logging.info(f"{label} - 数据库连接失败: {err}")
+            return False
+        except Exception as e:
+            logging.info(f"{label} - export_slice error: {e}")
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+
+def discard_slice_progress(checkpoint, current_date):
+    """
+    checkpoint: (manifest, 时间片序号)
+    时间片以整片为单位续跑: 上次未完成时已写出的分片文件先删除再重新导出
+    """
+    manifest, index = checkpoint
+    for path in manifest.reset_slice(current_date.strftime('%Y-%m-%d'), index):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def commit_part(checkpoint, current_date, filepath, shard):
+    manifest, index = checkpoint
+    manifest.commit_segment(current_date.strftime('%Y-%m-%d'), index, filepath, shard['rows'], None, shard)
+
+
+def finish_slice(checkpoint, current_date):
+    manifest, index = checkpoint
+    manifest.finish_slice(current_date.strftime('%Y-%m-%d'), index)
+
+
+def process_time_range(conn, current_date, start_time_utc, end_time_utc, label, checkpoint):
+    s = totalTime.time()
+    day = current_date.strftime('%Y-%m-%d')
     try:
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 数据库连接已建立")
-        conn = mysql.connector.connect(pool_name='custom_connection_pool')
-        return process_single_day(conn, current_date)
-    except mysql.connector.Error as err:
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 数据库连接失败: {err}")
-        return False
+        # 取数段: 订单分页, 每页的订单在线程池中逐单查询组装 (与扫描连接在同一副本上), 保持页内顺序
+        replica = replicas.replica_of(conn)
+        with ThreadPoolExecutor(max_workers=pipeline_fetch_workers) as hydrate_executor:
+            pages = replicas.timed(conn, metrics.timed(iter_order_pages(conn, start_time_utc, end_time_utc),
+                                                       'order_page_query', day))
+            page_lines = (
+                [line for lines in hydrate_executor.map(lambda row: process_order_row(row, day, replica), rows)
+                 for line in lines]
+                for rows in pages
+            )
+            write_parts(page_lines, current_date, checkpoint)
+
+        e = totalTime.time()
+        finish_slice(checkpoint, current_date)
+        logging.info(f"{label} - 所有导出任务完成, 耗时: {e - s:.2f} 秒")
+        return True
+
     except Exception as e:
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - export_single_day error: {e}")
+        logging.exception(f"{label} - 处理过程中发生错误: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
 
-def process_single_day(conn, current_date):
-    s = totalTime.time()
-    try:
-        timezone = pytz.timezone('America/New_York')
-        start_of_day_ny = timezone.localize(datetime.combine(current_date, time.min))
-        end_of_day_ny = timezone.localize(datetime.combine(current_date, time.max))
+def write_parts(page_lines, current_date, checkpoint):
+    """
+    page_lines: 每页的 OrderLine 列表, 在取数线程中迭代; 转换和写文件与取数并发执行
+    写文件段按 SHARD_MAX_ROWS / SHARD_MAX_BYTES 在订单边界处换下一个分片, 每个分片关闭后登记到 manifest
+    分片先写到 OUTPUT_DIR/.segments/<日期>/s<时间片序号>_p{n}, 日期完成时按时间片顺序改名为 orders_<日期>_p{n}, 见 assemble_day
+    """
+    day = current_date.strftime('%Y-%m-%d')
+    _, index = checkpoint
 
-        start_of_day_utc = start_of_day_ny.astimezone(pytz.UTC)
-        end_of_day_utc = end_of_day_ny.astimezone(pytz.UTC)
+    def on_shard(filepath, shard):
+        commit_part(checkpoint, current_date, filepath, shard)
+        logging.info(f"{day} - 时间片 {index} 分片 {shard['file']} 导出完成 ({shard['rows']} 条)")
 
-        totalLines = []
-        skip = 0
-        part = 1
+    part_dir = os.path.join(output_dir, '.segments', day)
+    os.makedirs(part_dir, exist_ok=True)
+    writer = ShardedWriter(output_format, os.path.join(part_dir, f"s{index:04d}"), csv_columns,
+                           parquet_column_types, output_compression, order_id_index, shard_max_rows, shard_max_bytes,
+                           on_shard=on_shard, write_manifest=False, numbered=True, document=order_document)
 
-        # ✅ 新增线程池用于并行导出
-        export_executor = ThreadPoolExecutor(max_workers=15)
-        export_futures = []
+    def write_result(result):
+        metrics.observe('row_mapping', day, result.seconds)
+        with metrics.timer('file_write', day):
+            write_transformed(writer, result)
 
-        transform_executor = ThreadPoolExecutor(max_workers=15)
+    pipeline = ExportPipeline(transform_stage, pipeline_map_workers, pipeline_queue_size, metrics, day)
+    with writer:
+        pipeline.run(page_lines, order_line_to_row, output_format == 'csv', write_result, order_id_index)
 
-        while True:
-            with conn.cursor(dictionary=True) as cursor:
-                searchOrderSql = """
-                    SELECT id, user_id, order_channel, dining_option, order_date, created_time, status, remake_ref_order_id
-                    FROM `order`.orders
-                    WHERE created_time >= %s AND created_time <= %s
-                    AND brand_category = 'BLUE_APRON'
-                    AND order_channel = 'BA_LEGACY'
-                    AND status in ('CANCELED', 'COMPLETE')
-                    LIMIT 1000 OFFSET %s
-                """
-                cursor.execute(searchOrderSql, (start_of_day_utc, end_of_day_utc, skip))
-                rows = cursor.fetchall()
-                if not rows:
-                    break
 
-                futures = []
-                for row in rows:
-                    futures.append(transform_executor.submit(process_order_row, row))
-
-                for f in as_completed(futures):
-                    try:
-                        lines = f.result()
-                        if lines:
-                            totalLines.extend(lines)
-                    except Exception:
-                        logging.exception("订单转换时发生异常")
-                skip += 1000
-
-                # ✅ 到达阈值，异步导出
-                if len(totalLines) >= 80000:
-                    filename = f"orders_{current_date.strftime('%Y-%m-%d')}_p{part}.csv"
-                    filepath = os.path.join(output_dir, filename)
-
-                    # 深拷贝当前批次，防止清空影响
-                    batch_lines = totalLines[:]
-                    totalLines.clear()
-
-                    future = export_executor.submit(export_to_excel, batch_lines, filepath)
-                    export_futures.append((part, future))
-                    logging.info(f"{current_date.strftime('%Y-%m-%d')}_p{part} - 已提交导出任务 ({len(batch_lines)} 条) 到后台线程")
-                    part += 1
-
-        # ✅ 导出剩余数据
-        if totalLines:
-            filename = f"orders_{current_date.strftime('%Y-%m-%d')}_p{part}.csv"
-            filepath = os.path.join(output_dir, filename)
-            batch_lines = totalLines[:]
-            totalLines.clear()
-
-            future = export_executor.submit(export_to_excel, batch_lines, filepath)
-            export_futures.append((part, future))
-            logging.info(f"{current_date.strftime('%Y-%m-%d')}_p{part} - 已提交最后一批导出任务 ({len(batch_lines)} 条)")
-
-        # ✅ 等待所有导出完成
-        for part_num, future in export_futures:
-            try:
-                future.result()
-                logging.info(f"{current_date.strftime('%Y-%m-%d')}_p{part_num} - 导出完成")
-            except Exception as e:
-                logging.error(f"{current_date.strftime('%Y-%m-%d')}_p{part_num} - 导出失败: {e}")
+def assemble_day(state, day):
+    """
+    把 manifest 中登记的当天分片按时间片顺序改名为 orders_<日期>_p1 .. p{n}, 写分片清单, 返回改名后的文件路径
+    时间片并发完成, 按完成顺序编号时文件名与时间顺序不一致; 改名中途被杀时已改名的分片在下次重做时跳过
+    升级前登记的分片没有校验信息, 在这里补算
+    """
+    base_path = os.path.join(output_dir, f"orders_{day}")
+    files, shards = [], []
+    segments = [segment for slice_state in state['slices'] for segment in slice_state['segments']]
+    for number, segment in enumerate(segments, 1):
+        filepath = output_path(output_format, f"{base_path}_p{number}", output_compression)
+        if os.path.exists(segment['path']):
+            os.replace(segment['path'], filepath)
+        elif not os.path.exists(filepath):
+            continue
+        if 'sha256' in segment:
+            shard = {key: value for key, value in segment.items() if key != 'path'}
+            shard['file'] = os.path.basename(filepath)
+        else:
+            shard = shard_entry(filepath, segment['rows'], None, None)
+        files.append(filepath)
+        shards.append(shard)
+    if shards:
+        write_shard_manifest(base_path, shards)
+    for path in (os.path.join(output_dir, '.segments', day), os.path.join(output_dir, '.segments')):
+        if os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+    return files
+
+
+def iter_order_pages(conn, start_time_utc, end_time_utc):
+    """
+    按页返回时间范围内的订单行
+    keyset 模式按 (created_time, id) 排序并从上一页最后一条续读, 避免 OFFSET 重复扫描已读行
+    """
+    if order_scan_mode == 'stream':
+        yield from stream_order_pages(conn, start_time_utc, end_time_utc)
+        return
 
-        export_executor.shutdown(wait=True)
+    last_key = None
+    skip = 0
 
-        e = totalTime.time()
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 所有导出任务完成, 耗时: {e - s:.2f} 秒")
-        return True
+    while True:
+        with conn.cursor(dictionary=True) as cursor:
+            if order_scan_mode == 'offset':
+                cursor.execute(offsetOrderPageSql, (start_time_utc, end_time_utc, page_size, skip))
+            elif last_key is None:
+                cursor.execute(firstOrderPageSql, (start_time_utc, end_time_utc, page_size))
+            else:
+                last_created_time, last_id = last_key
+                cursor.execute(nextOrderPageSql, (start_time_utc, end_time_utc, last_created_time, last_created_time,
+                                                  last_id, page_size))
+            rows = cursor.fetchall()
 
-    except Exception as e:
-        logging.exception(f"{current_date.strftime('%Y-%m-%d')} - 处理过程中发生错误: {e}")
-        return False
+        if not rows:
+            return
+
+        yield rows
 
-def process_order_row(row):
+        if len(rows) < page_size:
+            return
+        last_key = (rows[-1]['created_time'], rows[-1]['id'])
+        skip += page_size
+
+
+def stream_order_pages(conn, start_time_utc, end_time_utc):
+    """
+    无缓冲 (服务端) 游标扫描整个时间范围, 行从 MySQL 边读边返回, 不会重复执行分页查询
+    扫描期间该连接不能执行其他查询, 子表加载需使用另一条连接
+    """
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(searchOrderSql, (start_time_utc, end_time_utc))
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        try:
+            cursor.close()
+        except mysql.connector.Error as err:
+            logging.info(f"关闭订单扫描游标失败: {err}")
+
+
+def process_order_row(row, day, replica=None):
     """
     在独立线程中执行 order_lines(Order(**row))
     每个线程自己建立数据库连接，避免 cursor 冲突
     """
     conn = None
     try:
-        conn = mysql.connector.connect(pool_name='custom_connection_pool')
+        conn = replicas.connect(replica)
         with conn.cursor(dictionary=True) as cursor:
             order = Order(**row)
-            return order_lines(order, cursor)
+            return order_lines(order, cursor, day)
     except Exception as e:
         logging.exception(f"处理订单 {row.get('id')} 出错: {e}")
         return []
@@ -168,38 +363,99 @@ def export_with_threadpool():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    start_date = datetime(2025, 8, 10)
-    end_date = datetime(2025, 8, 10)
 
     dates_to_process = []
-    current_date = start_date
-    while current_date <= end_date:
+    current_date = export_start_date
+    while current_date <= export_end_date:
         dates_to_process.append(current_date)
         current_date += timedelta(days=1)
 
     logging.info(f"开始处理 {len(dates_to_process)} 天的数据")
 
-    max_workers = min(8, len(dates_to_process))
-    successful_days = 0
-    failed_days = 0
-
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_date = {
-            executor.submit(export_single_day, date): date
-            for date in dates_to_process
-        }
-
-        for future in as_completed(future_to_date):
-            date = future_to_date[future]
-            try:
-                result = future.result()
-                if result:
-                    successful_days += 1
-                else:
-                    failed_days += 1
-            except Exception as e:
-                logging.info(f"{date.strftime('%Y-%m-%d')} - 线程执行异常: {e}")
-                failed_days += 1
+    # OUTPUT_DIR/manifest.json 记录已完成的日期和时间片, 重启后跳过; 未完成的时间片整片重做
+    if metrics_interval_seconds > 0:
+        metrics.start_periodic_write(output_dir, metrics_interval_seconds)
+
+    manifest = CheckpointManifest(os.path.join(output_dir, 'manifest.json'))
+    pending_dates = []
+    for date in dates_to_process:
+        state = manifest.day_state(date.strftime('%Y-%m-%d'))
+        if state and state['done']:
+            logging.info(f"{date.strftime('%Y-%m-%d')} - 已完成 ({state['rows']} 条记录), 跳过")
+            archive_day(date)
+        else:
+            pending_dates.append(date)
+
+    # 已经开始过的日期沿用 manifest 中的划分, 不再重新统计
+    unplanned_dates = [date for date in pending_dates if manifest.day_state(date.strftime('%Y-%m-%d')) is None]
+    conn = replicas.connect()
+    try:
+        planned = plan_export_slices(conn, countOrdersByHourSql, unplanned_dates, slice_target_orders)
+    finally:
+        conn.close()
+
+    slices = []
+    for date in pending_dates:
+        day_slices = manifest.plan_day(date, [sl for sl in planned if sl.day == date])
+        slices.extend((index, export_slice_) for index, export_slice_ in enumerate(day_slices)
+                      if not manifest.slice_state(date.strftime('%Y-%m-%d'), index)['done'])
+    logging.info(f"待处理 {len(slices)} 个时间片, 目标每片 {slice_target_orders} 单, 转换进程数: {transform_stage.processes}")
+
+    max_workers = min(slice_workers * len(replicas.replicas), len(slices)) or 1
+    pending_slices = {date: 0 for date in pending_dates}
+    failed_dates = set()
+    for _, export_slice_ in slices:
+        pending_slices[export_slice_.day] += 1
+
+    def finish_day(date):
+        day = date.strftime('%Y-%m-%d')
+        if date in failed_dates:
+            logging.info(f"{day} - 存在失败的时间片, 已完成的时间片保留到下次继续")
+            return
+        state = manifest.day_state(day)
+        rows = sum(slice_state['rows'] for slice_state in state['slices'])
+        files = assemble_day(state, day)
+        manifest.finish_day(day, files, rows)
+        logging.info(f"{day} - 全部时间片完成: {len(files)} 个文件, {rows} 条记录")
+        archive_day(date)
+
+    def finish_slice_result(date, result):
+        if not result:
+            failed_dates.add(date)
+        pending_slices[date] -= 1
+        if pending_slices[date] == 0:
+            finish_day(date)
+
+    # 所有时间片都已完成, 只差登记的日期
+    for date in pending_dates:
+        if pending_slices[date] == 0:
+            finish_day(date)
+
+    if extraction_engine == 'asyncio':
+        results = asyncio.run(export_slices_async(slices, max_workers, manifest)) if slices else []
+        for (_, export_slice_), result in zip(slices, results):
+            if isinstance(result, BaseException):
+                logging.info(f"{export_slice_.day.strftime('%Y-%m-%d')} - 协程执行异常: {result}")
+                result = False
+            finish_slice_result(export_slice_.day, result)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_slice = {
+                executor.submit(export_slice, export_slice_, (manifest, index)): export_slice_
+                for index, export_slice_ in slices
+            }
+
+            for future in as_completed(future_to_slice):
+                date = future_to_slice[future].day
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.info(f"{date.strftime('%Y-%m-%d')} - 线程执行异常: {e}")
+                    result = False
+                finish_slice_result(date, result)
+
+    failed_days = len(failed_dates)
+    successful_days = len(dates_to_process) - failed_days
 
     end = totalTime.time()
     logging.info(f"\n=== 处理完成 ===")
@@ -207,82 +463,137 @@ def export_with_threadpool():
     logging.info(f"成功: {successful_days} 天")
     logging.info(f"失败: {failed_days} 天")
     logging.info(f"总耗时: {end - start: .2f} 秒")
-
-
-def order_lines(order: Order, cursor):
+    snapshot = metrics.snapshot()
+    logging.info(f"阶段耗时: {snapshot['stages']}")
+    logging.info(f"队列深度: {snapshot['queues']}")
+    replicas.log_summary()
+    metrics.stop(output_dir)
+    transform_stage.shutdown()
+    return failed_days == 0
+
+
+def archive_day(current_date):
+    """job 模式: 把当天的分片和分片清单加入结果归档"""
+    if result_archive is not None:
+        result_archive.add_shards(os.path.join(output_dir, f"orders_{current_date.strftime('%Y-%m-%d')}"))
+
+
+# 单个订单的子表查询, 线程引擎和 asyncio 引擎共用
+customerSql = """
+    SELECT user_id, email, phone, first_name, last_name, created_time
+    FROM customer.customers
+    WHERE user_id=%s
+"""
+
+orderItemsSql = """
+    SELECT id, menu_item_name, order_quantity, restaurant_id
+    FROM order.order_items
+    WHERE order_id=%s AND NOT deleted
+"""
+
+orderChargeItemsSql = """
+    SELECT order_item_id, subtotal, adjust_subtotal, discount, promotion, membership_subtotal, subscription_save_discount
+    FROM order.order_charge_items
+    WHERE order_id=%s
+"""
+
+orderChargeSql = """
+    SELECT final_amount
+    FROM order.order_charges
+    WHERE order_id=%s
+"""
+
+orderPaymentsSql = """
+    SELECT id, payment_method, credit_card_id, account_number, brand, revised_auth_amount, capture_amount, refund_amount
+    FROM order.order_payments
+    WHERE order_id=%s
+"""
+
+stripePaymentIntentsSql = """
+    SELECT payment_id, stripe_payment_method_id
+    FROM payment.stripe_payment_intents
+    WHERE payment_id IN ({placeholders})
+"""
+
+orderAddressSql = """
+    SELECT address_line, unit_number_or_company, city, state, zip_code
+    FROM order.order_addresses
+    WHERE order_id=%s
+"""
+
+orderFlagsSql = """
+    SELECT order_id, action, created_by
+    FROM order.order_flags
+    WHERE order_id = %s AND action = 'BO_CANCEL'
+"""
+
+
+def order_lines(order: Order, cursor, day):
     # customer
-    cursor.execute("""
-        SELECT user_id, email, phone, first_name, last_name, created_time
-        FROM customer.customers
-        WHERE user_id=%s
-    """, (order.user_id,))
-    customer_data = cursor.fetchone()
-    customer = Customer(**customer_data)
+    with metrics.timer('query_customers', day):
+        cursor.execute(customerSql, (order.user_id,))
+        customer_data = cursor.fetchone()
 
     # order_items
-    cursor.execute("""
-        SELECT id, menu_item_name, order_quantity, restaurant_id
-        FROM order.order_items
-        WHERE order_id=%s AND NOT deleted
-    """, (order.id,))
-    order_items = [OrderItem(**row) for row in cursor.fetchall()]
+    with metrics.timer('query_order_items', day):
+        cursor.execute(orderItemsSql, (order.id,))
+        order_items = cursor.fetchall()
     # order_charge_items
-    cursor.execute("""
-        SELECT order_item_id, subtotal, adjust_subtotal, discount, promotion, membership_subtotal, subscription_save_discount
-        FROM order.order_charge_items
-        WHERE order_id=%s
-    """, (order.id,))
-    order_charge_items = [OrderChargeItem(**row) for row in cursor.fetchall()]
+    with metrics.timer('query_order_charge_items', day):
+        cursor.execute(orderChargeItemsSql, (order.id,))
+        order_charge_items = cursor.fetchall()
     # order_charge
-    cursor.execute("""
-        SELECT final_amount
-        FROM order.order_charges
-        WHERE order_id=%s
-    """, (order.id,))
-    order_charge = OrderCharge(**cursor.fetchone())
+    with metrics.timer('query_order_charges', day):
+        cursor.execute(orderChargeSql, (order.id,))
+        order_charge = cursor.fetchone()
 
     # order_payments
-    cursor.execute("""
-        SELECT id, payment_method, credit_card_id, account_number, brand, revised_auth_amount, capture_amount, refund_amount
-        FROM order.order_payments
-        WHERE order_id=%s
-    """, (order.id,))
-    order_payments = [OrderPayment(**row) for row in cursor.fetchall()]
+    with metrics.timer('query_order_payments', day):
+        cursor.execute(orderPaymentsSql, (order.id,))
+        order_payments = cursor.fetchall()
     # stripe_payment_intents
-    psp_payment_ids = [p.id for p in order_payments if p.payment_method in ('APPLE_PAY', 'GOOGLE_PAY')]
+    psp_payment_ids = psp_payment_ids_of(order_payments)
     if psp_payment_ids:
-        format_strings = ','.join(['%s'] * len(psp_payment_ids))
-        cursor.execute(f"""
-            SELECT payment_id, stripe_payment_method_id
-            FROM payment.stripe_payment_intents
-            WHERE payment_id IN ({format_strings})
-        """, tuple(psp_payment_ids))
-        stripe_payment_intents = [StripePaymentIntent(**row) for row in cursor.fetchall()]
+        with metrics.timer('query_stripe_payment_intents', day):
+            cursor.execute(stripePaymentIntentsSql.format(placeholders=','.join(['%s'] * len(psp_payment_ids))),
+                           tuple(psp_payment_ids))
+            stripe_payment_intents = cursor.fetchall()
     else:
         stripe_payment_intents = []
 
     # order_address
-    cursor.execute("""
-        SELECT address_line, unit_number_or_company, city, state, zip_code
-        FROM order.order_addresses
-        WHERE order_id=%s
-    """, (order.id,))
-    addr_row = cursor.fetchone()
-    order_address = OrderAddress(**addr_row) if addr_row else None
-
-    result = []
+    with metrics.timer('query_order_addresses', day):
+        cursor.execute(orderAddressSql, (order.id,))
+        addr_row = cursor.fetchone()
 
-    order_flags = []
+    flags_data = []
     if order.status == 'CANCELED':
-        cursor.execute("""
-                        SELECT order_id, action, created_by
-                        FROM order.order_flags
-                        WHERE order_id = %s AND action = 'BO_CANCEL'
-                    """, (order.id,))
+        with metrics.timer('query_order_flags', day):
+            cursor.execute(orderFlagsSql, (order.id,))
+            flags_data = cursor.fetchall()
+
+    with metrics.timer('build_order_lines', day):
+        return build_order_lines(order, customer_data, order_items, order_charge_items, order_charge,
+                                 order_payments, stripe_payment_intents, addr_row, flags_data)
+
+
+def psp_payment_ids_of(payment_rows):
+    return [p['id'] for p in payment_rows if p['payment_method'] in ('APPLE_PAY', 'GOOGLE_PAY')]
 
-        flags_data = cursor.fetchall()
-        order_flags = [OrderFlag(**row) for row in flags_data]
 
+def build_order_lines(order, customer_data, item_rows, charge_item_rows, charge_row,
+                      payment_rows, stripe_rows, addr_row, flag_rows):
+    """由各子表查询结果组装 OrderLine, 每个明细一行"""
+    customer = Customer(**customer_data)
+    order_items = [OrderItem(**row) for row in item_rows]
+    order_charge_items = [OrderChargeItem(**row) for row in charge_item_rows]
+    order_charge = OrderCharge(**charge_row)
+    order_payments = [OrderPayment(**row) for row in payment_rows]
+    stripe_payment_intents = [StripePaymentIntent(**row) for row in stripe_rows]
+    order_address = OrderAddress(**addr_row) if addr_row else None
+    order_flags = [OrderFlag(**row) for row in flag_rows]
+
+    result = []
     for item in order_items:
         charge_item = []
         if order_charge_items:
@@ -304,257 +615,304 @@ def order_lines(order: Order, cursor):
     return result
 
 
-def order_line_to_dict(order_line):
-    def safe_get(attr_path, default=""):
-        try:
-            value = order_line
-            for attr in attr_path.split('.'):
-                if value is None:
-                    return default
-                value = getattr(value, attr, None)
-            return default if value is None else value
-        except (AttributeError, IndexError, TypeError):
-            return default
-
-    def refundable_subtotal(charge_item):
-        if not charge_item:
-            return ""
-        return str(charge_item.subtotal) if charge_item.subtotal is not None else ""
-
-    def find_payment(method):
-        for payment in (order_line.order_payments or []):
-            if payment.payment_method == method:
-                return payment
-        return None
-
-    def find_stripe_token(payment_id):
-        for stripe_payment in (order_line.stripe_payment_intents or []):
-            if stripe_payment.payment_id == payment_id:
-                return stripe_payment.stripe_payment_method_id
-        return ""
-
-    google_pay = find_payment("GOOGLE_PAY")
-    apple_pay = find_payment("APPLE_PAY")
-    credit_card = find_payment("CREDIT_CARD")
-
-    google_pay_token = find_stripe_token(google_pay.id) if google_pay else ""
-    apple_pay_token = find_stripe_token(apple_pay.id) if apple_pay else ""
-
-    address_line1 = safe_get('order_address.address_line') or ''
-    address_line2 = safe_get('order_address.unit_number_or_company') or ''
-    city = safe_get('order_address.city') or ''
-    state = safe_get('order_address.state') or ''
-    zip_code = safe_get('order_address.zip_code') or ''
-
-    data = {
-        "accountOwner.accountId": safe_get('customer.user_id'),
-        "accountOwner.created": str(int(safe_get('customer.created_time').timestamp())) if safe_get(
-            'customer.created_time') else "",
-        "accountOwner.email": safe_get('customer.email'),
-        "accountOwner.firstName": safe_get('customer.first_name'),
-        "accountOwner.fullName": "",
-        "accountOwner.lastName": safe_get('customer.last_name'),
-
-        "cartItems[].basicItemData.name": safe_get('order_item.menu_item_name'),
-        "cartItems[].basicItemData.quantity": str(safe_get('order_item.order_quantity')) if safe_get(
-            'order_item.order_quantity') else "",
-        "cartItems[].basicItemData.category": "",
-        "cartItems[].basicItemData.price.amountLocalCurrency": "",
-        "cartItems[].basicItemData.price.amountUSD": refundable_subtotal(order_line.order_charge_item),
-        "cartItems[].basicItemData.price.currency": "",
-
-        "cartItems[].beneficiaries[].personalDetails.email": "",
-        "cartItems[].beneficiaries[].personalDetails.firstName": "",
-        "cartItems[].beneficiaries[].personalDetails.fullName": "",
-        "cartItems[].beneficiaries[].personalDetails.lastName": "",
-        "cartItems[].beneficiaries[].phone[].phone": "",
-
-        "cartItems[].itemSpecificData.food.restaurantAddress.address1": '',
-        "cartItems[].itemSpecificData.food.restaurantAddress.address2": '',
-        "cartItems[].itemSpecificData.food.restaurantAddress.city": '',
-        "cartItems[].itemSpecificData.food.restaurantAddress.country": "US",
-        "cartItems[].itemSpecificData.food.restaurantAddress.region": "",
-        "cartItems[].itemSpecificData.food.restaurantAddress.zip": "",
-        "cartItems[].itemSpecificData.food.restaurantId": "Blue Apron",
-        "cartItems[].itemSpecificData.food.restaurantName": "Blue Apron",
-
-        "checkoutTime": str(int(safe_get('order.order_date').timestamp())) if safe_get('order.order_date') else "",
-        "connectionInformation.customerIP": '127.0.0.1',
-        "historicalData.fraud": "",
-        "historicalData.orderStatus": get_historical_order_status(order_line.order, order_line.order_flags),
-        "orderId": safe_get('order.id'),
-        "orderType": get_order_type(order_line.order),
-
-        # Android Pay (Google Pay)
-        "payment[].androidPay.bin": "",
-        "payment[].androidPay.expirationMonth": "",
-        "payment[].androidPay.expirationYear": "",
-        "payment[].androidPay.lastFourDigits": "",
-        "payment[].androidPay.nameOnCard": "",
-        "payment[].androidPay.token": google_pay_token,
-
-        # Apple Pay
-        "payment[].applePay.bin": "",
-        "payment[].applePay.expirationMonth": "",
-        "payment[].applePay.expirationYear": "",
-        "payment[].applePay.lastFourDigits": "",
-        "payment[].applePay.nameOnCard": "",
-        "payment[].applePay.token": apple_pay_token,
-
-        # Billing Details
-        "payment[].billingDetails.address.address1": "",
-        "payment[].billingDetails.address.address2": "",
-        "payment[].billingDetails.address.city": "",
-        "payment[].billingDetails.address.country": "",
-        "payment[].billingDetails.address.region": "",
-        "payment[].billingDetails.address.zip": "",
-        "payment[].billingDetails.personalDetails.email": "",
-        "payment[].billingDetails.phone[].phone": "",
-        "payment[].billingDetails.personalDetails.fullName": "",
-        "payment[].billingDetails.personalDetails.firstName": "",
-        "payment[].billingDetails.personalDetails.lastName": "",
-
-        # Credit Card
-        "payment[].creditCard.bin": "",
-        "payment[].creditCard.expirationMonth": "",
-        "payment[].creditCard.expirationYear": "",
-        "payment[].creditCard.lastFourDigits": "",
-        "payment[].creditCard.nameOnCard": "",
-        "payment[].creditCard.verificationResults.processorResponseCode": "",
-        "payment[].creditCard.verificationResults.processorResponseText": "",
-
-        # Tokenized Card
-        "payment[].tokenizedCard.bin": "",
-        "payment[].tokenizedCard.expirationMonth": "",
-        "payment[].tokenizedCard.expirationYear": "",
-        "payment[].tokenizedCard.lastFourDigits": credit_card.account_number if credit_card else "",
-        "payment[].tokenizedCard.verificationResults.processorResponseCode": "",
-        "payment[].tokenizedCard.verificationResults.processorResponseText": "",
-        "payment[].tokenizedCard.verificationResults.eciValue": "",
-        "payment[].tokenizedCard.token": credit_card.credit_card_id if credit_card else "",
-
-        # Delivery Details
-        "primaryDeliveryDetails.deliveryMethod": safe_get('order.dining_option'),
-        "primaryDeliveryDetails.deliveryType": "PHYSICAL",
-
-        # Recipient Details
-        "primaryRecipient.address.address1": address_line1,
-        "primaryRecipient.address.address2": address_line2,
-        "primaryRecipient.address.city": city,
-        "primaryRecipient.address.zip": zip_code,
-        "primaryRecipient.address.country": "US",
-        "primaryRecipient.address.region": state,
-        "primaryRecipient.personalDetails.email": safe_get('customer.email'),
-        "primaryRecipient.phone[].phone": safe_get('customer.phone'),
-
-        # Total Amount
-        "totalAmount.amountLocalCurrency": "",
-        "totalAmount.amountUSD": get_final_amount(order_line.order_charge),
-        "totalAmount.currency": 'USD'
-    }
+async def export_slices_async(slices, max_slices, manifest):
+    """
+    asyncio 引擎: 最多 max_slices 个时间片同时扫描, 全部时间片共享 async_concurrency 个在途订单
+    slices: [(时间片序号, ExportSlice)], 返回与 slices 顺序一致的结果 (True / False / 异常)
+    """
+    try:
+        import aiomysql
+    except ImportError:
+        raise RuntimeError("EXTRACTION_ENGINE=asyncio 需要安装 aiomysql")
+
+    # 每个副本一个连接池, 时间片开始时按负载选副本
+    pools = []
+    for replica in replicas.replicas:
+        pools.append(await aiomysql.create_pool(
+            host=replica.address,
+            port=replica.port,
+            user=db_config['user'],
+            password=db_config['password'],
+            minsize=1,
+            maxsize=min(async_concurrency, db_config['pool_size']),
+            autocommit=True
+        ))
+    slice_semaphore = asyncio.Semaphore(max_slices)
+    order_semaphore = asyncio.Semaphore(async_concurrency)
+
+    async def run_slice(index, export_slice_):
+        async with slice_semaphore:
+            checkpoint = (manifest, index)
+            # 所有副本都满时在线程中等待, 不阻塞事件循环
+            replica = await asyncio.to_thread(replicas.acquire)
+            try:
+                return await export_slice_async(export_slice_, pools[replica.index], order_semaphore, checkpoint,
+                                                replica)
+            finally:
+                replicas.release(replica)
+
+    try:
+        return await asyncio.gather(*(run_slice(index, export_slice_) for index, export_slice_ in slices),
+                                    return_exceptions=True)
+    finally:
+        for pool in pools:
+            pool.close()
+            await pool.wait_closed()
 
-    return data
 
+async def export_slice_async(export_slice: ExportSlice, pool, order_semaphore, checkpoint, replica=None):
+    current_date = export_slice.day
+    day = current_date.strftime('%Y-%m-%d')
+    label = (f"{current_date.strftime('%Y-%m-%d')} [{export_slice.start_utc.strftime('%m-%d %H:%M:%S')}, "
+             f"{export_slice.end_utc.strftime('%m-%d %H:%M:%S')}) UTC")
+    s = totalTime.time()
+
+    async def hydrate(row):
+        async with order_semaphore:
+            try:
+                return await order_lines_async(Order(**row), pool, day)
+            except Exception as e:
+                logging.exception(f"处理订单 {row.get('id')} 出错: {e}")
+                return []
 
-def get_final_amount(orderCharge: OrderCharge):
-    if orderCharge is None or orderCharge.final_amount is None:
-        return "0"
-    return str(orderCharge.final_amount)
+    try:
+        discard_slice_progress(checkpoint, current_date)
+        # 事件循环负责取数, 转换和写文件在线程中进行; 两边通过有界队列交接, 队列满时暂停取数
+        page_queue = queue.Queue(pipeline_queue_size)
+        write_task = asyncio.create_task(asyncio.to_thread(write_parts, iter_page_queue(page_queue), current_date,
+                                                           checkpoint))
+        try:
+            async for rows in iter_order_pages_async(pool, export_slice.start_utc, export_slice.end_utc, day, replica):
+                lines = [line for lines in await asyncio.gather(*(hydrate(row) for row in rows)) for line in lines]
+                if not await put_page(page_queue, lines, write_task):
+                    break
+        finally:
+            await put_page(page_queue, None, write_task)
+        await write_task
+
+        e = totalTime.time()
+        finish_slice(checkpoint, current_date)
+        logging.info(f"{label} - 所有导出任务完成, 耗时: {e - s:.2f} 秒")
+        return True
+
+    except Exception as e:
+        logging.exception(f"{label} - 处理过程中发生错误: {e}")
+        return False
 
 
-def get_order_type(order: Order):
-    if order.order_channel == 'BA_WEB' or order.order_channel == 'WEB':
-        return 'WEB'
-    elif order.order_channel == 'BA_APP' or order.order_channel == 'APP':
-        return 'MOBILE'
+async def put_page(page_queue, lines, write_task):
+    """队列满时让出事件循环等待写文件线程消费; 写文件线程已退出 (出错) 时返回 False"""
+    while not write_task.done():
+        try:
+            page_queue.put_nowait(lines)
+            return True
+        except queue.Full:
+            await asyncio.sleep(0.05)
+    return False
+
+
+def iter_page_queue(page_queue):
+    while True:
+        lines = page_queue.get()
+        if lines is None:
+            return
+        yield lines
+
+
+async def iter_order_pages_async(pool, start_time_utc, end_time_utc, day, replica=None):
+    """按 (created_time, id) 续读分页, 与 keyset 模式的 iter_order_pages 相同; 每页耗时记为 replica 的延迟"""
+    last_key = None
+    while True:
+        start = totalTime.perf_counter()
+        if last_key is None:
+            rows = await timed_async('order_page_query', day, fetch_rows_async(
+                pool, firstOrderPageSql, (start_time_utc, end_time_utc, page_size)))
+        else:
+            last_created_time, last_id = last_key
+            rows = await timed_async('order_page_query', day, fetch_rows_async(
+                pool, nextOrderPageSql,
+                (start_time_utc, end_time_utc, last_created_time, last_created_time, last_id, page_size)))
+
+        if replica is not None:
+            replicas.observe(replica, totalTime.perf_counter() - start)
+        if not rows:
+            return
+
+        yield rows
+
+        if len(rows) < page_size:
+            return
+        last_key = (rows[-1]['created_time'], rows[-1]['id'])
+
+
+async def fetch_rows_async(pool, sql, params):
+    import aiomysql
+
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            await cursor.execute(sql, params)
+            return await cursor.fetchall()
+
+
+async def fetch_one_async(pool, sql, params):
+    rows = await fetch_rows_async(pool, sql, params)
+    return rows[0] if rows else None
+
+
+async def no_rows():
+    return []
+
+
+async def timed_async(stage, day, awaitable):
+    """耗时包含等待连接池的时间, 与线程引擎等待 mysql 连接池一致"""
+    with metrics.timer(stage, day):
+        return await awaitable
+
+
+async def order_lines_async(order: Order, pool, day):
+    """与 order_lines 相同的查询, 互不依赖的子表查询同时发出"""
+    (customer_data, order_items, order_charge_items, order_charge,
+     order_payments, addr_row, flags_data) = await asyncio.gather(
+        timed_async('query_customers', day, fetch_one_async(pool, customerSql, (order.user_id,))),
+        timed_async('query_order_items', day, fetch_rows_async(pool, orderItemsSql, (order.id,))),
+        timed_async('query_order_charge_items', day, fetch_rows_async(pool, orderChargeItemsSql, (order.id,))),
+        timed_async('query_order_charges', day, fetch_one_async(pool, orderChargeSql, (order.id,))),
+        timed_async('query_order_payments', day, fetch_rows_async(pool, orderPaymentsSql, (order.id,))),
+        timed_async('query_order_addresses', day, fetch_one_async(pool, orderAddressSql, (order.id,))),
+        timed_async('query_order_flags', day, fetch_rows_async(pool, orderFlagsSql, (order.id,)))
+        if order.status == 'CANCELED' else no_rows()
+    )
+
+    psp_payment_ids = psp_payment_ids_of(order_payments)
+    stripe_payment_intents = []
+    if psp_payment_ids:
+        stripe_payment_intents = await timed_async('query_stripe_payment_intents', day, fetch_rows_async(
+            pool, stripePaymentIntentsSql.format(placeholders=','.join(['%s'] * len(psp_payment_ids))),
+            tuple(psp_payment_ids)))
 
-    return "UNKNOWN"
+    with metrics.timer('build_order_lines', day):
+        return build_order_lines(order, customer_data, order_items, order_charge_items, order_charge,
+                                 order_payments, stripe_payment_intents, addr_row, flags_data)
 
 
-def get_historical_order_status(order: Order, order_flags: list) -> str:
-    if order.status == 'COMPLETE':
-        return 'COMPLETE'
+def tune_workers():
+    """
+    在创建连接池之前校准, 按拐点并发分配连接池大小、时间片数和逐单组装线程数, 保证
+    时间片数 * (1 + 组装线程数) 不超过连接池, 避免取不到连接时订单被当作出错跳过
+    asyncio 引擎的 aiomysql 连接池取 min(ASYNC_CONCURRENCY, pool_size)
+    多个副本时只探测第一个, 假定各副本规格相同; 结果是单个副本的连接池大小和并发时间片数
+    """
+    global slice_workers, pipeline_fetch_workers
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-    elif order.status == 'CANCELED':
-        for flag in order_flags:
-            if flag.created_by == 'customer-service-site':
-                return 'CANCELED_BY_MERCHANT'
+    probe_start, probe_end = day_range_utc(export_start_date)
+    replica = replicas.replicas[0]
 
-        return 'CANCELED_BY_CUSTOMER'
+    def connect():
+        return mysql.connector.connect(host=replica.address, port=replica.port, user=db_config['user'],
+                                       password=db_config['password'])
 
+    def run_query(conn):
+        # 与逐单组装相同的子表查询模式: 随机取一页订单中的一单查明细
+        start = probe_start + timedelta(minutes=random.randrange(24 * 60))
+        with conn.cursor(dictionary=True) as cursor:
+            cursor.execute(firstOrderPageSql, (start, probe_end, 1))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute(orderItemsSql, (row['id'],))
+                cursor.fetchall()
+
+    calibration = calibrate(os.path.join(output_dir, 'autotune.json'), autotune_mode, replica.host,
+                            autotune_max_age_hours, connect, run_query, autotune_probe_seconds)
+    connections = min(calibration['concurrency'] if calibration else db_config['pool_size'], max_pool_size)
+    if extraction_engine == 'asyncio':
+        db_config['pool_size'] = connections
     else:
-        return ''
-
-
-def export_to_excel(lines, filename=None):
-    data = [order_line_to_dict(line) for line in lines]
-    csv_columns = [
-        'accountOwner.accountId', 'accountOwner.created', 'accountOwner.email',
-        'accountOwner.firstName', 'accountOwner.fullName', 'accountOwner.lastName',
-        'cartItems[].basicItemData.name', 'cartItems[].basicItemData.quantity',
-        'cartItems[].basicItemData.category', 'cartItems[].basicItemData.price.amountLocalCurrency',
-        'cartItems[].basicItemData.price.amountUSD', 'cartItems[].basicItemData.price.currency',
-        'cartItems[].beneficiaries[].personalDetails.email',
-        'cartItems[].beneficiaries[].personalDetails.firstName',
-        'cartItems[].beneficiaries[].personalDetails.fullName',
-        'cartItems[].beneficiaries[].personalDetails.lastName',
-        'cartItems[].beneficiaries[].phone[].phone', 'cartItems[].itemSpecificData.food.restaurantAddress.address1',
-        'cartItems[].itemSpecificData.food.restaurantAddress.address2',
-        'cartItems[].itemSpecificData.food.restaurantAddress.city',
-        'cartItems[].itemSpecificData.food.restaurantAddress.country',
-        'cartItems[].itemSpecificData.food.restaurantAddress.region',
-        'cartItems[].itemSpecificData.food.restaurantAddress.zip', 'cartItems[].itemSpecificData.food.restaurantId',
-        'cartItems[].itemSpecificData.food.restaurantName', 'checkoutTime', 'connectionInformation.customerIP',
-        'historicalData.fraud', 'historicalData.orderStatus', 'orderId', 'orderType',
-        'payment[].androidPay.bin', 'payment[].androidPay.expirationMonth', 'payment[].androidPay.expirationYear',
-        'payment[].androidPay.lastFourDigits', 'payment[].androidPay.nameOnCard', 'payment[].androidPay.token',
-        'payment[].applePay.bin',
-        'payment[].applePay.expirationMonth', 'payment[].applePay.expirationYear',
-        'payment[].applePay.lastFourDigits',
-        'payment[].applePay.nameOnCard', 'payment[].applePay.token', 'payment[].billingDetails.address.address1',
-        'payment[].billingDetails.address.address2',
-        'payment[].billingDetails.address.city', 'payment[].billingDetails.address.country',
-        'payment[].billingDetails.address.region',
-        'payment[].billingDetails.address.zip', 'payment[].billingDetails.personalDetails.email',
-        'payment[].billingDetails.phone[].phone',
-        'payment[].billingDetails.personalDetails.fullName', 'payment[].billingDetails.personalDetails.firstName',
-        'payment[].billingDetails.personalDetails.lastName', 'payment[].creditCard.bin',
-        'payment[].creditCard.expirationMonth',
-        'payment[].creditCard.expirationYear', 'payment[].creditCard.lastFourDigits',
-        'payment[].creditCard.nameOnCard',
-        'payment[].creditCard.verificationResults.processorResponseCode',
-        'payment[].creditCard.verificationResults.processorResponseText',
-        'payment[].tokenizedCard.bin', 'payment[].tokenizedCard.expirationMonth',
-        'payment[].tokenizedCard.expirationYear',
-        'payment[].tokenizedCard.lastFourDigits',
-        'payment[].tokenizedCard.verificationResults.processorResponseCode',
-        'payment[].tokenizedCard.verificationResults.processorResponseText',
-        'payment[].tokenizedCard.verificationResults.eciValue',
-        'payment[].tokenizedCard.token', 'primaryDeliveryDetails.deliveryMethod',
-        'primaryDeliveryDetails.deliveryType',
-        'primaryRecipient.address.address1', 'primaryRecipient.address.address2', 'primaryRecipient.address.city',
-        'primaryRecipient.address.zip', 'primaryRecipient.address.country', 'primaryRecipient.address.region',
-        'primaryRecipient.personalDetails.email', 'primaryRecipient.phone[].phone',
-        'totalAmount.amountLocalCurrency',
-        'totalAmount.amountUSD', 'totalAmount.currency'
+        slice_workers = max(1, min(slice_workers, connections // 2))
+        pipeline_fetch_workers = max(1, min(pipeline_fetch_workers, connections // slice_workers - 1))
+        db_config['pool_size'] = slice_workers * (pipeline_fetch_workers + 1)
+    logging.info(f"连接池 {db_config['pool_size']} 条, 并发时间片 {slice_workers} 个, "
+                 f"每片组装线程 {pipeline_fetch_workers} 个, 来源: {'校准' if calibration else 'pool_size'}")
+
+
+def preflight_queries(conn):
+    """按当前的扫描模式 / 引擎列出会执行的查询, 参数取第一天的时间范围和当天的一个真实订单"""
+    day_start, day_end = day_range_utc(export_start_date)
+    with conn.cursor(dictionary=True) as cursor:
+        cursor.execute(firstOrderPageSql, (day_start, day_end, 1))
+        sample = (cursor.fetchall() or [{}])[0]
+        payments = []
+        if sample:
+            cursor.execute(orderPaymentsSql, (sample['id'],))
+            payments = cursor.fetchall()
+    order_id = sample.get('id', '')
+    payment_id = payments[0]['id'] if payments else ''
+
+    # asyncio 引擎总是按 (created_time, id) 续读
+    scan_mode = 'keyset' if extraction_engine == 'asyncio' else order_scan_mode
+    scan_queries = {
+        'keyset': (nextOrderPageSql, (day_start, day_end, day_start, day_start, '', page_size)),
+        'offset': (offsetOrderPageSql, (day_start, day_end, page_size, 0)),
+        'stream': (searchOrderSql, (day_start, day_end)),
+    }
+    sql, params = scan_queries[scan_mode]
+    return [
+        preflight_query('order_page_query', sql, params, '天'),
+        preflight_query('count_orders_by_hour', countOrdersByHourSql, (day_start, day_end), '天', allow_filesort=True),
+        preflight_query('query_customers', customerSql, (sample.get('user_id', ''),), '单'),
+        preflight_query('query_order_items', orderItemsSql, (order_id,), '单'),
+        preflight_query('query_order_charge_items', orderChargeItemsSql, (order_id,), '单'),
+        preflight_query('query_order_charges', orderChargeSql, (order_id,), '单'),
+        preflight_query('query_order_payments', orderPaymentsSql, (order_id,), '单'),
+        preflight_query('query_stripe_payment_intents', stripePaymentIntentsSql.format(placeholders='%s'),
+                        (payment_id,), '单'),
+        preflight_query('query_order_addresses', orderAddressSql, (order_id,), '单'),
+        preflight_query('query_order_flags', orderFlagsSql, (order_id,), '单'),
     ]
 
-    if data:
-        df = pd.DataFrame(data, columns=csv_columns)
-    else:
-        df = pd.DataFrame(columns=csv_columns)
 
-    df.to_csv(filename, index=False, encoding='utf-8')
-    return filename
+def preflight():
+    """每个副本都检查一遍: 缺索引的往往只是其中一个副本"""
+    if preflight_mode == 'off':
+        return
+    for replica in replicas.replicas:
+        conn = replicas.connect(replica)
+        try:
+            run_preflight(conn, preflight_queries(conn), preflight_mode, replica.host)
+        finally:
+            conn.close()
 
 
 def main():
+    global result_archive
     logging.info("开始数据导出任务...")
-    mysql.connector.connect(**db_config)
-    export_with_threadpool()
+    if run_mode == 'job':
+        result_archive = ResultArchive(check_archive_path(archive_path, output_dir))
+    tune_workers()
+    replicas.create_pools(db_config, slice_workers)
+    preflight()
+    succeeded = export_with_threadpool()
     logging.info("数据导出完成")
+    if run_mode == 'job':
+        seal_archive(succeeded)
+        return 0 if succeeded else 1
     totalTime.sleep(86400)
+    return 0
+
+
+def seal_archive(succeeded):
+    """阶段耗时快照也放进归档, 然后封口"""
+    metrics_path = os.path.join(output_dir, f"{metrics.prefix}.json")
+    if os.path.exists(metrics_path):
+        result_archive.add(metrics_path)
+    result_archive.seal({
+        'extraction_engine': extraction_engine,
+        'start_date': export_start_date.strftime('%Y-%m-%d'),
+        'end_date': export_end_date.strftime('%Y-%m-%d'),
+        'succeeded': succeeded,
+    })
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
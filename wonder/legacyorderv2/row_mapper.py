@@ -0,0 +1,23 @@
+# row_mapper.py
+from exportcommon.row_mapper import (
+    compile_document, compile_row_mapper, epoch_seconds, order_line_columns, parquet_column_types
+)
+
+# 旧订单的 checkoutTime 取 order_date
+forter_columns = order_line_columns(epoch_seconds('order.order_date'))
+
+csv_columns = [column for column, _ in forter_columns]
+
+map_order_line = compile_row_mapper(forter_columns)
+
+
+def order_line_to_row(order_line):
+    # 模块级函数, 可以按名字 pickle 传给转换进程
+    return map_order_line(order_line)
+
+
+def order_line_to_dict(order_line):
+    return dict(zip(csv_columns, order_line_to_row(order_line)))
+
+
+order_document = compile_document(csv_columns, parquet_column_types)
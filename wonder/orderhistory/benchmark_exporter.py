@@ -0,0 +1,415 @@
+# benchmark_exporter.py
+"""
+端到端基准: 在本地 SQLite 中建出导出工具查询的 order / customer / payment 库, 按接近线上的分布造数,
+再与 export_with_threadpool 相同地按时间片 (export_slice) 并发导出其中一天并合并 (assemble_day),
+输出 订单/秒、每单查询数、峰值内存 (RSS) 和各阶段耗时
+不需要 MySQL: 运行前把 mysql.connector 替换为 SQLite 适配层 (%s 占位符, `order` 库名, DATE_FORMAT, 无缓冲游标)
+
+用法: python benchmark_exporter.py [--orders 20000] [--seed 1] [--date 2025-08-11] [--db-dir DIR] [--output-dir DIR]
+导出方式仍由环境变量决定, 例如 HYDRATION_MODE=join ORDER_SCAN_MODE=stream TRANSFORM_PROCESSES=0
+"""
+import argparse
+import csv
+import importlib
+import itertools
+import os
+import random
+import re
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+
+import pytz
+
+schemas = ('order', 'customer', 'payment')
+
+schemaSql = """
+CREATE TABLE "order".orders (
+    id TEXT PRIMARY KEY, user_id TEXT, order_channel TEXT, dining_option TEXT, order_date DATETIME,
+    created_time DATETIME, updated_time DATETIME, status TEXT, remake_ref_order_id TEXT, brand_category TEXT
+);
+CREATE INDEX "order".idx_orders_created_time ON orders (created_time, id);
+CREATE INDEX "order".idx_orders_updated_time ON orders (updated_time);
+CREATE TABLE customer.customers (
+    user_id TEXT PRIMARY KEY, email TEXT, phone TEXT, first_name TEXT, last_name TEXT, created_time DATETIME
+);
+CREATE TABLE "order".order_items (
+    id TEXT PRIMARY KEY, order_id TEXT, menu_item_name TEXT, order_quantity INTEGER, restaurant_id TEXT,
+    deleted INTEGER DEFAULT 0, updated_time DATETIME
+);
+CREATE INDEX "order".idx_order_items_order_id ON order_items (order_id);
+CREATE TABLE "order".order_charge_items (
+    order_item_id TEXT, order_id TEXT, subtotal DECIMAL, adjust_subtotal DECIMAL, discount DECIMAL,
+    promotion DECIMAL, membership_subtotal DECIMAL, subscription_save_discount DECIMAL
+);
+CREATE INDEX "order".idx_order_charge_items_order_id ON order_charge_items (order_id);
+CREATE TABLE "order".order_charges (order_id TEXT, final_amount DECIMAL, updated_time DATETIME);
+CREATE INDEX "order".idx_order_charges_order_id ON order_charges (order_id);
+CREATE TABLE "order".order_payments (
+    id TEXT PRIMARY KEY, order_id TEXT, payment_method TEXT, credit_card_id TEXT, account_number TEXT, brand TEXT,
+    revised_auth_amount DECIMAL, capture_amount DECIMAL, refund_amount DECIMAL, updated_time DATETIME
+);
+CREATE INDEX "order".idx_order_payments_order_id ON order_payments (order_id);
+CREATE TABLE payment.stripe_payment_intents (id INTEGER PRIMARY KEY, payment_id TEXT, stripe_payment_method_id TEXT);
+CREATE INDEX payment.idx_stripe_payment_intents_payment_id ON stripe_payment_intents (payment_id);
+CREATE TABLE "order".order_addresses (
+    order_id TEXT, address_line TEXT, unit_number_or_company TEXT, city TEXT, state TEXT, zip_code TEXT
+);
+CREATE INDEX "order".idx_order_addresses_order_id ON order_addresses (order_id);
+CREATE TABLE "order".order_flags (order_id TEXT, action TEXT, created_by TEXT, created_time DATETIME);
+CREATE INDEX "order".idx_order_flags_order_id ON order_flags (order_id);
+CREATE TABLE "order".order_issues_v2 (
+    id TEXT PRIMARY KEY, order_id TEXT, issue_type TEXT, created_time DATETIME, discount DECIMAL, refund DECIMAL,
+    additional_credit DECIMAL, concession_total DECIMAL, updated_time DATETIME
+);
+CREATE INDEX "order".idx_order_issues_v2_order_id ON order_issues_v2 (order_id);
+CREATE INDEX "order".idx_order_issues_v2_updated_time ON order_issues_v2 (updated_time);
+CREATE TABLE "order".order_issue_items (
+    id TEXT PRIMARY KEY, order_issue_id TEXT, issue_order_id TEXT, issue_order_item_id TEXT, issue_category TEXT,
+    issue_quantity INTEGER, issue_source TEXT, reason_number TEXT, updated_time DATETIME
+);
+CREATE INDEX "order".idx_order_issue_items_order_issue_id ON order_issue_items (order_issue_id);
+CREATE INDEX "order".idx_order_issue_items_updated_time ON order_issue_items (updated_time);
+"""
+
+# 纽约时间各小时的下单权重: 午饭和晚饭前后最多
+hour_weights = [1, 1, 1, 1, 1, 2, 4, 6, 8, 9, 10, 14, 16, 12, 10, 10, 14, 20, 22, 18, 12, 8, 4, 2]
+# 每单明细数的分布 (0 ~ 6 个)
+item_count_weights = [1, 15, 30, 28, 15, 7, 4]
+menu_items = [f"Menu Item {i}, \"Chef's\" choice" if i % 17 == 0 else f"Menu Item {i}" for i in range(400)]
+
+
+def create_database(db_dir, order_count, current_date, seed):
+    """按 current_date 所在的纽约时间一天造 order_count 单, 另有约 5% 落在前后一天, 用来检查日期边界"""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(os.path.join(db_dir, 'main.db'))
+    for schema in schemas:
+        conn.execute(f"ATTACH DATABASE '{os.path.join(db_dir, schema + '.db')}' AS \"{schema}\"")
+    conn.executescript(schemaSql)
+
+    # 用户下单次数长尾分布: 少数订阅用户贡献大量订单, 客户缓存能命中
+    user_count = max(1, order_count // 4)
+    user_weights = [1 / (rank + 1) ** 0.8 for rank in range(user_count)]
+    conn.executemany('INSERT INTO customer.customers VALUES (?, ?, ?, ?, ?, ?)', (
+        (f"u{u:07d}", f"user{u}@example.com", None if u % 5 == 0 else f"555{u:07d}", f"First{u}",
+         f"Last, {u}" if u % 11 == 0 else f"Last{u}", '2020-01-01 00:00:00')
+        for u in range(user_count)
+    ))
+
+    ny = pytz.timezone('America/New_York')
+    day_start = ny.localize(datetime.combine(current_date, datetime.min.time()))
+    users = rng.choices(range(user_count), weights=user_weights, k=order_count)
+
+    orders, items, charge_items, charges, payments, intents, addresses, flags, issues, issue_items = (
+        [] for _ in range(10))
+    for i in range(order_count):
+        order_id = f"o{i:08d}"
+        day_offset = rng.choices([-1, 0, 1], weights=[2, 95, 3])[0]
+        hour = rng.choices(range(24), weights=hour_weights)[0]
+        local_time = day_start + timedelta(days=day_offset, hours=hour, seconds=rng.randrange(3600))
+        created = local_time.astimezone(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
+        status = rng.choices(['COMPLETE', 'CANCELED', 'IN_PROGRESS'], weights=[90, 8, 2])[0]
+        channel = rng.choices(['BA_APP', 'BA_WEB', 'BA_LEGACY'], weights=[55, 35, 10])[0]
+        # 约 0.3% 的订单找不到客户, 导出时应跳过该单
+        user_id = f"u{users[i]:07d}" if rng.random() >= 0.003 else f"x{i:07d}"
+        orders.append((order_id, user_id, channel, 'DELIVERY', local_time.strftime('%Y-%m-%d'), created,
+                       created, status, None, 'BLUE_APRON'))
+
+        # 约 0.5% 的订单缺少 order_charges, 导出时应跳过该单
+        if rng.random() >= 0.005:
+            charges.append((order_id, f"{rng.randint(1500, 25000) / 100:.2f}", created))
+        for k in range(rng.choices(range(len(item_count_weights)), weights=item_count_weights)[0]):
+            item_id = f"{order_id}-{k}"
+            items.append((item_id, order_id, rng.choice(menu_items), rng.randint(1, 3), f"r{rng.randint(1, 40)}",
+                          1 if rng.random() < 0.02 else 0, created))
+            # 约 0.3% 的明细缺少 order_charge_items, 导出时应跳过整单
+            if rng.random() >= 0.003:
+                charge_items.append((item_id, order_id, f"{rng.randint(800, 3000) / 100:.2f}", '0.00',
+                                     f"{rng.randint(0, 300) / 100:.2f}", '0.00', '0.00', '0.00'))
+        if rng.random() < 0.95:
+            addresses.append((order_id, f"{rng.randint(1, 999)} Main St", 'Apt 2' if i % 3 else '', 'New York',
+                              'NY', f"{10001 + rng.randrange(200):05d}"))
+
+        methods = [rng.choices(['CREDIT_CARD', 'APPLE_PAY', 'GOOGLE_PAY'], weights=[70, 20, 10])[0]]
+        if rng.random() < 0.05:
+            methods.append('CREDIT_CARD' if methods[0] != 'CREDIT_CARD' else 'APPLE_PAY')
+        # 少数订单同一支付方式有两笔支付, 导出取 id 最小的一笔
+        if rng.random() < 0.02:
+            methods.append(methods[0])
+        for k, method in enumerate(methods):
+            payment_id = f"p{i:08d}-{k}"
+            payments.append((payment_id, order_id, method, f"cc{i}-{k}", f"{rng.randint(0, 9999):04d}", 'visa',
+                             '10.00', None, None, created))
+            if method != 'CREDIT_CARD':
+                intents.append((None, payment_id, f"pm_{i}_{k}"))
+                # 少数支付有两条 stripe_payment_intents, 导出取 id 最小的一条
+                if rng.random() < 0.05:
+                    intents.append((None, payment_id, f"pm_{i}_{k}_retry"))
+
+        if status == 'CANCELED' and rng.random() < 0.6:
+            flags.append((order_id, 'BO_CANCEL', rng.choice(['customer-service-site', 'customer-app']), created))
+        if rng.random() < 0.03:
+            issue_id = f"is{i:08d}"
+            issues.append((issue_id, order_id, rng.choice(['COMPLAINTS', 'REMAKE']), created, '0.00', '5.00',
+                           '0.00', '5.00', created))
+            issue_items.append((f"ii{i:08d}", issue_id, order_id, f"{order_id}-0",
+                                rng.choice(['ORDER_ISSUE', 'ITEM_ISSUE']), 1, 'CUSTOMER', '21009000000', created))
+
+    for table, rows in (
+            ('"order".orders', orders), ('"order".order_items', items),
+            ('"order".order_charge_items', charge_items), ('"order".order_charges', charges),
+            ('"order".order_payments', payments), ('payment.stripe_payment_intents', intents),
+            ('"order".order_addresses', addresses), ('"order".order_flags', flags),
+            ('"order".order_issues_v2', issues), ('"order".order_issue_items', issue_items)):
+        if rows:
+            conn.executemany(f"INSERT INTO {table} VALUES ({','.join(['?'] * len(rows[0]))})", rows)
+    conn.commit()
+    conn.close()
+
+
+class SqliteCursor:
+    def __init__(self, connection, dictionary):
+        self._connection = connection
+        self._cursor = connection.sqlite.cursor()
+        self._dictionary = dictionary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def execute(self, sql, params=()):
+        self._connection.adapter.count_query()
+        try:
+            self._cursor.execute(translate_sql(sql), tuple(params))
+        except sqlite3.Error as e:
+            raise self._connection.adapter.Error(msg=str(e)) from e
+
+    def _convert(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return {column[0]: value for column, value in zip(self._cursor.description, row)}
+
+    def fetchone(self):
+        return self._convert(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self._convert(row) for row in self._cursor.fetchall()]
+
+    def fetchmany(self, size=1):
+        return [self._convert(row) for row in self._cursor.fetchmany(size)]
+
+    def close(self):
+        self._cursor.close()
+
+
+class SqliteConnection:
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self._open()
+
+    def _open(self):
+        self.sqlite = sqlite3.connect(os.path.join(self.adapter.db_dir, 'main.db'),
+                                      detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        for schema in schemas:
+            self.sqlite.execute(f"ATTACH DATABASE '{os.path.join(self.adapter.db_dir, schema + '.db')}' AS \"{schema}\"")
+        self.sqlite.create_function('DATE_FORMAT', 2, date_format, deterministic=True)
+
+    def cursor(self, dictionary=False, buffered=None):
+        return SqliteCursor(self, dictionary)
+
+    def reconnect(self, attempts=1, delay=0):
+        self.sqlite.close()
+        self._open()
+
+    def close(self):
+        self.sqlite.close()
+
+
+class MysqlConnectorAdapter(types.ModuleType):
+    """
+    替代 mysql.connector 的模块: connect() 每次返回一条新的 SQLite 连接, 并统计执行的查询数
+    导出工具用到的 Error (带 errno) / PoolError / errorcode / errors 也一并提供, 接口与 mysql.connector 相同
+    """
+
+    class Error(Exception):
+        def __init__(self, msg=None, errno=None):
+            super().__init__(msg)
+            self.msg = msg
+            self.errno = errno
+
+    class PoolError(Error):
+        pass
+
+    class DatabaseError(Error):
+        pass
+
+    class OperationalError(DatabaseError):
+        pass
+
+    # mysql.connector.errors 中的同名异常类, 测试注入故障时使用
+    errors = types.SimpleNamespace(Error=Error, PoolError=PoolError, DatabaseError=DatabaseError,
+                                   OperationalError=OperationalError)
+
+    # retry.py 判断暂时性错误用到的错误码, 取值与 mysql.connector.errorcode 相同
+    errorcode = types.SimpleNamespace(
+        CR_CONN_HOST_ERROR=2003,
+        CR_SERVER_GONE_ERROR=2006,
+        CR_SERVER_LOST=2013,
+        CR_SERVER_LOST_EXTENDED=2055,
+        ER_CON_COUNT_ERROR=1040,
+        ER_LOCK_WAIT_TIMEOUT=1205,
+        ER_LOCK_DEADLOCK=1213,
+    )
+
+    def __init__(self, db_dir):
+        super().__init__('mysql.connector')
+        self.db_dir = db_dir
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def count_query(self):
+        with self._lock:
+            self.queries += 1
+
+    def connect(self, **kwargs):
+        return SqliteConnection(self)
+
+
+def translate_sql(sql):
+    """MySQL 写法转为 SQLite: %s 占位符, `order` / order. 库名"""
+    sql = sql.replace('%s', '?').replace('`order`.', '"order".')
+    return re.sub(r'(?<!["\w])order\.', '"order".', sql)
+
+
+def date_format(value, fmt):
+    if value is None:
+        return None
+    return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S').strftime(fmt.replace('%i', '%M'))
+
+
+def install_adapter(db_dir):
+    sqlite3.register_converter('DATETIME', lambda b: datetime.strptime(b.decode(), '%Y-%m-%d %H:%M:%S'))
+    sqlite3.register_converter('DECIMAL', lambda b: Decimal(b.decode()))
+    sqlite3.register_adapter(Decimal, str)
+    sqlite3.register_adapter(datetime, lambda d: (d.astimezone(dt_timezone.utc).replace(tzinfo=None) if d.tzinfo
+                                                  else d).strftime('%Y-%m-%d %H:%M:%S'))
+    adapter = MysqlConnectorAdapter(db_dir)
+    mysql = types.ModuleType('mysql')
+    mysql.connector = adapter
+    sys.modules['mysql'] = mysql
+    sys.modules['mysql.connector'] = adapter
+    return adapter
+
+
+def count_exported_orders(db_dir, current_date):
+    from exportcommon.slice_planner import day_range_utc
+
+    start_utc, end_utc = day_range_utc(current_date)
+    conn = sqlite3.connect(os.path.join(db_dir, 'order.db'))
+    try:
+        return conn.execute("""
+            SELECT COUNT(*) FROM orders
+            WHERE created_time >= ? AND created_time < ?
+            AND brand_category = 'BLUE_APRON' AND order_channel IN ('BA_APP', 'BA_WEB')
+            AND status IN ('CANCELED', 'COMPLETE')
+        """, (start_utc.strftime('%Y-%m-%d %H:%M:%S'), end_utc.strftime('%Y-%m-%d %H:%M:%S'))).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def count_csv_rows(output_dir):
+    """未压缩的 CSV 输出统计行数, 其他格式返回 None"""
+    rows = None
+    for filename in os.listdir(output_dir):
+        if filename.endswith('.csv'):
+            with open(os.path.join(output_dir, filename), newline='', encoding='utf-8') as f:
+                rows = (rows or 0) + sum(1 for _ in itertools.islice(csv.reader(f), 1, None))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='order history 导出端到端基准')
+    parser.add_argument('--orders', type=int, default=20000, help='造数订单数 (含前后一天约 5%%)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--date', default='2025-08-11', help='导出的纽约日期')
+    parser.add_argument('--db-dir', help='复用已有的造数目录; 目录为空时在其中造数')
+    parser.add_argument('--output-dir', help='导出文件写到该空目录并保留; 不指定时写到临时目录, 结束后删除')
+    args = parser.parse_args()
+    if args.output_dir and os.path.isdir(args.output_dir) and os.listdir(args.output_dir):
+        parser.error(f"--output-dir 必须是空目录: {args.output_dir}")
+    current_date = datetime.strptime(args.date, '%Y-%m-%d')
+
+    work_dir = tempfile.mkdtemp(prefix='order_export_bench_')
+    db_dir = args.db_dir or os.path.join(work_dir, 'db')
+    output_dir = args.output_dir or os.path.join(work_dir, 'output')
+    os.makedirs(db_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    os.environ['OUTPUT_DIR'] = output_dir
+    # 周期写指标的线程在基准里没有意义, 结束时打印即可
+    os.environ.setdefault('METRICS_INTERVAL_SECONDS', '0')
+
+    try:
+        if not os.path.exists(os.path.join(db_dir, 'main.db')):
+            s = time.time()
+            create_database(db_dir, args.orders, current_date, args.seed)
+            print(f"造数完成: {args.orders} 单, 耗时 {time.time() - s:.2f} 秒, 目录 {db_dir}")
+
+        adapter = install_adapter(db_dir)
+        tool = importlib.import_module('export_order_history_tool')
+        orders = count_exported_orders(db_dir, current_date)
+
+        tool.replicas.create_pools(tool.db_config, tool.slice_workers)
+        manifest = tool.CheckpointManifest(os.path.join(output_dir, 'manifest.json'))
+        s = time.perf_counter()
+        try:
+            conn = tool.replicas.connect()
+            try:
+                planned = tool.plan_export_slices(conn, tool.countOrdersByHourSql, [current_date],
+                                                  tool.slice_target_orders)
+            finally:
+                conn.close()
+            day_slices = manifest.plan_day(current_date, planned)
+            with ThreadPoolExecutor(max_workers=min(tool.slice_workers, len(day_slices)) or 1) as executor:
+                results = list(executor.map(lambda item: tool.export_slice(item[1], item[0], manifest),
+                                            enumerate(day_slices)))
+            ok = all(results)
+            if ok:
+                tool.assemble_day(manifest, current_date)
+        finally:
+            elapsed = time.perf_counter() - s
+            tool.transform_stage.shutdown()
+
+        rows = count_csv_rows(output_dir)
+        # Linux 上 ru_maxrss 单位为 KB; 转换进程的峰值单独统计
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        peak_rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+        print(f"模式: HYDRATION_MODE={tool.hydration_mode} ORDER_SCAN_MODE={tool.order_scan_mode} "
+              f"OUTPUT_FORMAT={tool.output_format} TRANSFORM_PROCESSES={tool.transform_stage.processes}")
+        print(f"结果: {'成功' if ok else '失败'}, 订单 {orders}, 明细行 {rows if rows is not None else '-'}, "
+              f"时间片 {len(day_slices)} 个")
+        print(f"耗时: {elapsed:.2f} 秒, {orders / elapsed if elapsed else 0:.0f} 单/秒")
+        print(f"查询: {adapter.queries} 条, {adapter.queries / orders if orders else 0:.2f} 条/单")
+        print(f"峰值 RSS: {peak_rss:.1f} MB (转换进程 {peak_rss_children:.1f} MB)")
+        for stage, summary in tool.metrics.snapshot()['stages'].items():
+            print(f"  {stage:<30} count={summary['count']:<8} sum={summary['sum']:.3f}s "
+                  f"p50={summary['p50'] * 1000:.2f}ms p95={summary['p95'] * 1000:.2f}ms p99={summary['p99'] * 1000:.2f}ms")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,245 @@
+# benchmark_row_mapper.py
+"""
+行映射微基准: 旧的 safe_get 版 order_line_to_dict (按 csv_columns 取值) 对比 row_mapper 编译后的映射
+用法: python benchmark_row_mapper.py [行数] [每单明细数]
+"""
+import os
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+# 公共模块在上一级目录的 exportcommon 包中
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exportcommon.row_mapper import get_final_amount, get_order_type, get_historical_order_status
+from models import (
+    Order, Customer, OrderItem, OrderChargeItem, OrderCharge,
+    OrderPayment, StripePaymentIntent, OrderAddress, OrderLine, OrderFlag
+)
+from row_mapper import csv_columns, order_line_to_row
+
+
+def baseline_order_line_to_dict(order_line, checkout_time_path='order.created_time'):
+    """旧实现; 旧订单导出的 checkoutTime 取 order.order_date, 其余列相同"""
+    def safe_get(attr_path, default=""):
+        try:
+            value = order_line
+            for attr in attr_path.split('.'):
+                if value is None:
+                    return default
+                value = getattr(value, attr, None)
+            return default if value is None else value
+        except (AttributeError, IndexError, TypeError):
+            return default
+
+    def refundable_subtotal(charge_item):
+        if not charge_item:
+            return ""
+        return str(charge_item.subtotal) if charge_item.subtotal is not None else ""
+
+    def find_payment(method):
+        for payment in (order_line.order_payments or []):
+            if payment.payment_method == method:
+                return payment
+        return None
+
+    def find_stripe_token(payment_id):
+        for stripe_payment in (order_line.stripe_payment_intents or []):
+            if stripe_payment.payment_id == payment_id:
+                return stripe_payment.stripe_payment_method_id
+        return ""
+
+    google_pay = find_payment("GOOGLE_PAY")
+    apple_pay = find_payment("APPLE_PAY")
+    credit_card = find_payment("CREDIT_CARD")
+
+    google_pay_token = find_stripe_token(google_pay.id) if google_pay else ""
+    apple_pay_token = find_stripe_token(apple_pay.id) if apple_pay else ""
+
+    address_line1 = safe_get('order_address.address_line') or ''
+    address_line2 = safe_get('order_address.unit_number_or_company') or ''
+    city = safe_get('order_address.city') or ''
+    state = safe_get('order_address.state') or ''
+    zip_code = safe_get('order_address.zip_code') or ''
+
+    data = {
+        "accountOwner.accountId": safe_get('customer.user_id'),
+        "accountOwner.created": str(int(safe_get('customer.created_time').timestamp())) if safe_get(
+            'customer.created_time') else "",
+        "accountOwner.email": safe_get('customer.email'),
+        "accountOwner.firstName": safe_get('customer.first_name'),
+        "accountOwner.fullName": "",
+        "accountOwner.lastName": safe_get('customer.last_name'),
+
+        "cartItems[].basicItemData.name": safe_get('order_item.menu_item_name'),
+        "cartItems[].basicItemData.quantity": str(safe_get('order_item.order_quantity')) if safe_get(
+            'order_item.order_quantity') else "",
+        "cartItems[].basicItemData.category": "",
+        "cartItems[].basicItemData.price.amountLocalCurrency": "",
+        "cartItems[].basicItemData.price.amountUSD": refundable_subtotal(order_line.order_charge_item),
+        "cartItems[].basicItemData.price.currency": "",
+
+        "cartItems[].beneficiaries[].personalDetails.email": "",
+        "cartItems[].beneficiaries[].personalDetails.firstName": "",
+        "cartItems[].beneficiaries[].personalDetails.fullName": "",
+        "cartItems[].beneficiaries[].personalDetails.lastName": "",
+        "cartItems[].beneficiaries[].phone[].phone": "",
+
+        "cartItems[].itemSpecificData.food.restaurantAddress.address1": '',
+        "cartItems[].itemSpecificData.food.restaurantAddress.address2": '',
+        "cartItems[].itemSpecificData.food.restaurantAddress.city": '',
+        "cartItems[].itemSpecificData.food.restaurantAddress.country": "US",
+        "cartItems[].itemSpecificData.food.restaurantAddress.region": "",
+        "cartItems[].itemSpecificData.food.restaurantAddress.zip": "",
+        "cartItems[].itemSpecificData.food.restaurantId": "Blue Apron",
+        "cartItems[].itemSpecificData.food.restaurantName": "Blue Apron",
+
+        "checkoutTime": str(int(safe_get(checkout_time_path).timestamp())) if safe_get(checkout_time_path) else "",
+        "connectionInformation.customerIP": '127.0.0.1',
+        "historicalData.fraud": "",
+        "historicalData.orderStatus": get_historical_order_status(order_line.order, order_line.order_flags),
+        "orderId": safe_get('order.id'),
+        "orderType": get_order_type(order_line.order),
+
+        # Android Pay (Google Pay)
+        "payment[].androidPay.bin": "",
+        "payment[].androidPay.expirationMonth": "",
+        "payment[].androidPay.expirationYear": "",
+        "payment[].androidPay.lastFourDigits": "",
+        "payment[].androidPay.nameOnCard": "",
+        "payment[].androidPay.token": google_pay_token,
+
+        # Apple Pay
+        "payment[].applePay.bin": "",
+        "payment[].applePay.expirationMonth": "",
+        "payment[].applePay.expirationYear": "",
+        "payment[].applePay.lastFourDigits": "",
+        "payment[].applePay.nameOnCard": "",
+        "payment[].applePay.token": apple_pay_token,
+
+        # Billing Details
+        "payment[].billingDetails.address.address1": "",
+        "payment[].billingDetails.address.address2": "",
+        "payment[].billingDetails.address.city": "",
+        "payment[].billingDetails.address.country": "",
+        "payment[].billingDetails.address.region": "",
+        "payment[].billingDetails.address.zip": "",
+        "payment[].billingDetails.personalDetails.email": "",
+        "payment[].billingDetails.phone[].phone": "",
+        "payment[].billingDetails.personalDetails.fullName": "",
+        "payment[].billingDetails.personalDetails.firstName": "",
+        "payment[].billingDetails.personalDetails.lastName": "",
+
+        # Credit Card
+        "payment[].creditCard.bin": "",
+        "payment[].creditCard.expirationMonth": "",
+        "payment[].creditCard.expirationYear": "",
+        "payment[].creditCard.lastFourDigits": "",
+        "payment[].creditCard.nameOnCard": "",
+        "payment[].creditCard.verificationResults.processorResponseCode": "",
+        "payment[].creditCard.verificationResults.processorResponseText": "",
+
+        # Tokenized Card
+        "payment[].tokenizedCard.bin": "",
+        "payment[].tokenizedCard.expirationMonth": "",
+        "payment[].tokenizedCard.expirationYear": "",
+        "payment[].tokenizedCard.lastFourDigits": credit_card.account_number if credit_card else "",
+        "payment[].tokenizedCard.verificationResults.processorResponseCode": "",
+        "payment[].tokenizedCard.verificationResults.processorResponseText": "",
+        "payment[].tokenizedCard.verificationResults.eciValue": "",
+        "payment[].tokenizedCard.token": credit_card.credit_card_id if credit_card else "",
+
+        # Delivery Details
+        "primaryDeliveryDetails.deliveryMethod": safe_get('order.dining_option'),
+        "primaryDeliveryDetails.deliveryType": "PHYSICAL",
+
+        # Recipient Details
+        "primaryRecipient.address.address1": address_line1,
+        "primaryRecipient.address.address2": address_line2,
+        "primaryRecipient.address.city": city,
+        "primaryRecipient.address.zip": zip_code,
+        "primaryRecipient.address.country": "US",
+        "primaryRecipient.address.region": state,
+        "primaryRecipient.personalDetails.email": safe_get('customer.email'),
+        "primaryRecipient.phone[].phone": safe_get('customer.phone'),
+
+        # Total Amount
+        "totalAmount.amountLocalCurrency": "",
+        "totalAmount.amountUSD": get_final_amount(order_line.order_charge),
+        "totalAmount.currency": 'USD'
+    }
+
+    return data
+
+
+def baseline_order_line_to_row(order_line, checkout_time_path='order.created_time'):
+    data = baseline_order_line_to_dict(order_line, checkout_time_path)
+    return [data[column] for column in csv_columns]
+
+
+def sample_order_lines(count, items_per_order=4):
+    """与 order_lines / build_page_lines 相同: 同一订单的各明细行共用订单级对象"""
+    lines = []
+    methods = ['CREDIT_CARD', 'APPLE_PAY', 'GOOGLE_PAY']
+    for n in range((count + items_per_order - 1) // items_per_order):
+        order = Order(
+            id=f"order-{n}",
+            user_id=f"user-{n // 3}",
+            order_channel='BA_APP' if n % 2 else 'BA_WEB',
+            dining_option='DELIVERY',
+            created_time=datetime(2025, 8, 11, 12, 0, n % 60),
+            status='CANCELED' if n % 10 == 0 else 'COMPLETE'
+        )
+        method = methods[n % 3]
+        payment = OrderPayment(id=f"payment-{n}", payment_method=method, credit_card_id=f"card-{n}",
+                               account_number='4242', brand='visa')
+        order_payments = [payment]
+        intents = [] if method == 'CREDIT_CARD' else [StripePaymentIntent(payment.id, f"pm_{n}")]
+        customer = Customer(order.user_id, f"{order.user_id}@example.com", '5550100', 'First', 'Last',
+                            datetime(2020, 1, 1))
+        order_flags = [OrderFlag(order.id, 'BO_CANCEL', 'customer-service-site')] if n % 20 == 0 else []
+        order_charge = OrderCharge(Decimal('51.96'))
+        order_address = OrderAddress('1 Main St', 'Apt 2', 'New York', 'NY', '10001') if n % 5 else None
+        for i in range(n * items_per_order, min((n + 1) * items_per_order, count)):
+            lines.append(OrderLine(
+                order=order,
+                customer=customer,
+                order_flags=order_flags,
+                order_item=OrderItem(f"item-{i}", f"Meal kit {i % 7}", 1 + i % 3, 'restaurant'),
+                order_charge_item=OrderChargeItem(f"item-{i}", Decimal('12.99'), Decimal(0), Decimal(0), Decimal(0),
+                                                  Decimal(0), Decimal(0)),
+                order_charge=order_charge,
+                order_payments=order_payments,
+                stripe_payment_intents=intents,
+                order_address=order_address
+            ))
+    return lines
+
+
+def rows_per_second(mapper, lines):
+    start = time.perf_counter()
+    for line in lines:
+        mapper(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    items_per_order = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    lines = sample_order_lines(count, items_per_order)
+
+    for line in lines[:1000]:
+        if list(order_line_to_row(line)) != baseline_order_line_to_row(line):
+            raise AssertionError(f"row mismatch for {line.order.id}")
+
+    before = rows_per_second(baseline_order_line_to_row, lines)
+    after = rows_per_second(order_line_to_row, lines)
+    print(f"rows: {count}, items per order: {items_per_order}")
+    print(f"safe_get order_line_to_dict: {before:,.0f} rows/sec")
+    print(f"compiled row mapper:         {after:,.0f} rows/sec")
+    print(f"speedup: {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# customer_cache.py
+import threading
+from collections import OrderedDict
+
+
+class CustomerCache:
+    """
+    进程内共享的客户 LRU 缓存, 按 user_id 索引, 所有日期线程共用一个实例
+    超过 max_size 时淘汰最久未使用的客户
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._customers = OrderedDict()
+
+    def get_many(self, user_ids):
+        """返回 (已缓存的 {user_id: Customer}, 未命中的 user_id 列表)"""
+        found = {}
+        missing = []
+        with self._lock:
+            for user_id in user_ids:
+                customer = self._customers.get(user_id)
+                if customer is None:
+                    missing.append(user_id)
+                else:
+                    self._customers.move_to_end(user_id)
+                    found[user_id] = customer
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, customers):
+        with self._lock:
+            for customer in customers:
+                self._customers[customer.user_id] = customer
+                self._customers.move_to_end(customer.user_id)
+            while len(self._customers) > self.max_size:
+                self._customers.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            hit_rate = self.hits / total if total else 0
+            return f"size={len(self._customers)} hits={self.hits} misses={self.misses} hit_rate={hit_rate:.2%}"
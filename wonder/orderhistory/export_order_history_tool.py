@@ -3,18 +3,37 @@ import os
 import logging
 import sys
 import time as totalTime
+from itertools import groupby, islice
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime, time, timedelta
+from datetime import datetime, timedelta, timezone
+
+import random
 
 import mysql.connector
-import pandas as pd
-import pytz
 
+# 公共模块在上一级目录的 exportcommon 包中 (镜像里与工具同在 /app 下, 不需要这一步)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exportcommon.archive import ResultArchive, check_archive_path
+from exportcommon.autotune import calibrate, max_pool_size
+from exportcommon.checkpoint import CheckpointManifest, load_watermark, resume_key, save_watermark
+from exportcommon.dead_letters import DeadLetterLog
+from exportcommon.metrics import StageMetrics
+from exportcommon.pipeline import ExportPipeline
+from exportcommon.preflight import preflight_query, run_preflight
+from exportcommon.replicas import ReplicaRouter, parse_hosts
+from exportcommon.retry import RetryPolicy, is_connection_error, is_transient, reconnect
+from exportcommon.slice_planner import ExportSlice, day_range_utc, plan_export_slices
+from exportcommon.transform_pool import TransformStage, resolve_transform_processes, write_transformed
+from exportcommon.writers import ShardedWriter, concat_segment_shards, open_writer, segment_max_bytes
+
+from customer_cache import CustomerCache
 from models import (
     Order, Customer, OrderItem, OrderChargeItem, OrderCharge,
     OrderPayment, StripePaymentIntent,
     OrderAddress, OrderLine, OrderFlag
 )
+from row_mapper import csv_columns, join_row_to_row, order_document, order_line_to_row, parquet_column_types
 
 logging.basicConfig(
     level=logging.INFO,
@@ -28,85 +47,600 @@ db_config = {
     'user': os.getenv('DB_USER'),
     'password': os.getenv('DB_PASSWORD'),
     'pool_name': 'custom_connection_pool',
-    'pool_size': 10
+    # AUTOTUNE=off 时的连接数; 否则按校准结果重新设置, 并发时间片数随之调整
+    'pool_size': 16
 }
 
+# 逗号分隔的只读副本 (host 或 host:port), 每个副本一个连接池, 时间片按负载分到各副本; 为空时只用 DB_HOST
+# 副本的分页查询延迟超过其他副本最低延迟的 REPLICA_EJECT_FACTOR 倍时, 摘除 REPLICA_EJECT_SECONDS 秒
+replicas = ReplicaRouter(parse_hosts(os.getenv('DB_HOSTS', ''), db_config['host']), db_config['pool_name'],
+                         float(os.getenv('REPLICA_EJECT_FACTOR', '3')), float(os.getenv('REPLICA_EJECT_SECONDS', '60')))
+
+# 导出的日期范围 (纽约时间, 含两端)
+export_start_date = datetime(2025, 8, 11)
+export_end_date = datetime(2025, 9, 30)
+
+# 每个副本同时导出的时间片数上限; 每片占用 1 条连接, stream 模式 2 条, 实际并发不超过连接池能容纳的数量
+slice_workers = int(os.getenv('SLICE_WORKERS', '7'))
+
+# 启动时探测从库在不同并发下的吞吐和延迟, 取拐点作为连接池大小, 结果写入 OUTPUT_DIR/autotune.json
+# auto: 沿用 AUTOTUNE_MAX_AGE_HOURS 小时内同一数据库的结果, 否则重新探测; force: 每次探测; off: 使用 pool_size
+autotune_mode = os.getenv('AUTOTUNE', 'auto')
+autotune_max_age_hours = float(os.getenv('AUTOTUNE_MAX_AGE_HOURS', '24'))
+autotune_probe_seconds = float(os.getenv('AUTOTUNE_PROBE_SECONDS', '2'))
+
+# 开始导出前在每个副本上 EXPLAIN 将要执行的查询, 报告用到的索引和估计行数
+# warn: 有全表扫描 / filesort 时只记录警告; strict: 拒绝开始导出; off: 跳过
+preflight_mode = os.getenv('PREFLIGHT', 'warn')
+
 output_dir = os.getenv('OUTPUT_DIR', '/app/export_results')
 
+# service: 导出完成后 sleep, 等待 kubectl exec tar / kubectl cp 取走结果
+# job: 每完成一天就把当天的分片和分片清单追加进 ARCHIVE_PATH (tar), 结束后封口并退出, 全部成功时退出码为 0, 否则为 1
+run_mode = os.getenv('RUN_MODE', 'service')
+# ARCHIVE_PATH 必须在单独挂载的持久卷上 (不能在 OUTPUT_DIR 下), 例如 /app/archive/order_history_results.tar
+archive_path = os.getenv('ARCHIVE_PATH', '')
+# job 模式的结果归档, main() 中创建
+result_archive = None
+
+# csv | parquet | ndjson (每个订单一行嵌套的 JSON 文档, 含 cartItems / payment 数组)
+output_format = os.getenv('OUTPUT_FORMAT', 'csv')
+# 空 | gzip | zstd, 写文件时直接压缩
+output_compression = os.getenv('OUTPUT_COMPRESSION', '')
+# 每天的输出按行数 / 字节数滚动成 orders_<日期>_p{n} 分片, 并写 orders_<日期>.manifest.json
+# (每个分片的行数 / 字节数 / 首末 orderId / sha256); 都为 0 时每天一个文件
+shard_max_rows = int(os.getenv('SHARD_MAX_ROWS', '0'))
+shard_max_bytes = int(os.getenv('SHARD_MAX_BYTES', '0'))
+order_id_index = csv_columns.index('orderId')
+
+# batch: 整页订单的子表各用一条 IN (...) 查询加载; per_order: 逐单查询
+# join: 每个时间片一条 JOIN 语句直接返回明细行, 不再分页扫描订单
+hydration_mode = os.getenv('HYDRATION_MODE', 'batch')
+join_slice_minutes = int(os.getenv('JOIN_SLICE_MINUTES', '60'))
+
+# backfill: 按 created_time 导出固定日期范围
+# delta: 只导出上次高水位之后本身或子表有变更的订单, 输出按 orderId 覆盖的增量文件
+export_mode = os.getenv('EXPORT_MODE', 'backfill')
+# 第一次增量导出的起点 (UTC, ISO 格式), 之后从 OUTPUT_DIR/watermark.json 继续
+delta_since = os.getenv('DELTA_SINCE', '')
+# 增量上界比当前时间早一段, 避免漏掉还没提交的事务
+delta_lag_seconds = int(os.getenv('DELTA_LAG_SECONDS', '300'))
+
+# 按小时订单数把日期切成约 SLICE_TARGET_ORDERS 单的时间片并发导出, 结果仍按天写文件; 0 表示每天一个单元
+slice_target_orders = int(os.getenv('SLICE_TARGET_ORDERS', '5000'))
+
+# OUTPUT_DIR/manifest.json 记录已完成的日期和时间片, 重启后跳过已完成的部分
+# keyset 扫描时每 CHECKPOINT_PAGES 页提交一个分段文件并记录续读位置, 时间片中断后从该位置继续
+checkpoint_pages = int(os.getenv('CHECKPOINT_PAGES', '50'))
+
+# 行映射和 CSV 编码在进程池中执行; auto 按容器 CPU 限额决定进程数, 0 表示在取数线程内转换
+transform_stage = TransformStage(resolve_transform_processes(os.getenv('TRANSFORM_PROCESSES', 'auto')))
+
+# 取数 / 转换 / 写文件三段之间的队列长度 (批), 队列满时上游阻塞, 取数不会把整天的数据堆在内存里
+pipeline_queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', '4'))
+# 每个导出单元同时在转换的批数, 0 表示与转换进程数相同
+pipeline_map_workers = int(os.getenv('PIPELINE_MAP_WORKERS', '0')) or max(1, transform_stage.processes)
+
+# 各阶段耗时 (订单分页查询 / 子表查询 / 对象构造 / 行映射 / 写文件) 按阶段和日期汇总
+# 每 METRICS_INTERVAL_SECONDS 秒写一次 OUTPUT_DIR/order_history_export.prom (Prometheus textfile) 和 .json, 0 表示只在结束时写
+metrics = StageMetrics('order_history_export')
+metrics_interval_seconds = int(os.getenv('METRICS_INTERVAL_SECONDS', '30'))
+
+# 暂时性 MySQL 错误 (连接断开 / 锁等待超时 / 死锁 / 连接池耗尽) 只重试出错的那一步: 取连接 / 一次订单分页查询 / 一页订单的子表加载,
+# 各自最多尝试 RETRY_ATTEMPTS 次, 间隔从 RETRY_BASE_SECONDS 秒起指数增长, 不超过 RETRY_MAX_SECONDS 秒
+retry_policy = RetryPolicy(int(os.getenv('RETRY_ATTEMPTS', '5')), float(os.getenv('RETRY_BASE_SECONDS', '0.5')),
+                           float(os.getenv('RETRY_MAX_SECONDS', '30')))
+# 重试用尽的整页订单和组装失败的单个订单记入 OUTPUT_DIR/dead_letters.jsonl, 当天其余订单照常导出
+# 带 --redo-dead-letters 启动时只重新导出死信中的订单
+dead_letters = DeadLetterLog(os.path.join(output_dir, 'dead_letters.jsonl'))
+redo_dead_letters_mode = '--redo-dead-letters' in sys.argv[1:]
+
+# 订阅用户几乎每周下单, 客户信息跨日期缓存
+customer_cache = CustomerCache(int(os.getenv('CUSTOMER_CACHE_SIZE', '200000')))
+
+# keyset: 按 (created_time, id) 续读分页; offset: LIMIT/OFFSET 分页
+# stream: 一条无缓冲查询扫描整天, 按 page_size 分批取行
+order_scan_mode = os.getenv('ORDER_SCAN_MODE', 'keyset')
+page_size = 100
+
+searchOrderSql = """
+    SELECT id, user_id, order_channel, dining_option, created_time, status, remake_ref_order_id
+    FROM `order`.orders
+    WHERE created_time >= %s AND created_time < %s
+    AND brand_category = 'BLUE_APRON'
+    AND order_channel IN ('BA_APP', 'BA_WEB')
+    AND status in ('CANCELED', 'COMPLETE')
+"""
+
+# 按 (created_time, id) 续读的分页查询: 第一页 / 之后各页; offset 模式用 LIMIT / OFFSET
+firstOrderPageSql = searchOrderSql + """
+    ORDER BY created_time, id
+    LIMIT %s
+"""
+
+nextOrderPageSql = searchOrderSql + """
+    AND (created_time > %s OR (created_time = %s AND id > %s))
+    ORDER BY created_time, id
+    LIMIT %s
+"""
+
+offsetOrderPageSql = searchOrderSql + """
+    LIMIT %s OFFSET %s
+"""
+
+countOrdersByHourSql = """
+    SELECT DATE_FORMAT(created_time, '%Y-%m-%d %H:00:00') AS hour_start, COUNT(*) AS order_count
+    FROM `order`.orders
+    WHERE created_time >= %s AND created_time < %s
+    AND brand_category = 'BLUE_APRON'
+    AND order_channel IN ('BA_APP', 'BA_WEB')
+    AND status in ('CANCELED', 'COMPLETE')
+    GROUP BY hour_start
+"""
+
+# 整页批量加载的子表查询, {placeholders} 为 IN 列表
+customersInSql = """
+    SELECT user_id, email, phone, first_name, last_name, created_time
+    FROM customer.customers
+    WHERE user_id IN ({placeholders})
+"""
+
+orderItemsInSql = """
+    SELECT order_id, id, menu_item_name, order_quantity, restaurant_id
+    FROM order.order_items
+    WHERE order_id IN ({placeholders}) AND NOT deleted
+"""
+
+orderChargeItemsInSql = """
+    SELECT order_id, order_item_id, subtotal, adjust_subtotal, discount, promotion, membership_subtotal,
+           subscription_save_discount
+    FROM order.order_charge_items
+    WHERE order_id IN ({placeholders})
+"""
+
+orderChargesInSql = """
+    SELECT order_id, final_amount
+    FROM order.order_charges
+    WHERE order_id IN ({placeholders})
+"""
+
+orderPaymentsInSql = """
+    SELECT order_id, id, payment_method, credit_card_id, account_number, brand, revised_auth_amount,
+           capture_amount, refund_amount
+    FROM order.order_payments
+    WHERE order_id IN ({placeholders})
+"""
+
+stripePaymentIntentsInSql = """
+    SELECT payment_id, stripe_payment_method_id
+    FROM payment.stripe_payment_intents
+    WHERE payment_id IN ({placeholders})
+"""
+
+orderAddressesInSql = """
+    SELECT order_id, address_line, unit_number_or_company, city, state, zip_code
+    FROM order.order_addresses
+    WHERE order_id IN ({placeholders})
+"""
+
+orderFlagsInSql = """
+    SELECT order_id, action, created_by
+    FROM order.order_flags
+    WHERE order_id IN ({placeholders}) AND action = 'BO_CANCEL'
+"""
+
+# 增量模式检查的表: (表, 变更时间列, 订单 id 列); order_flags 只会新增, 用 created_time
+deltaSourceTables = [
+    ('`order`.orders', 'updated_time', 'id'),
+    ('`order`.order_items', 'updated_time', 'order_id'),
+    ('`order`.order_charges', 'updated_time', 'order_id'),
+    ('`order`.order_payments', 'updated_time', 'order_id'),
+    ('`order`.order_flags', 'created_time', 'order_id'),
+]
+
+changedOrderIdsSql = """
+    SELECT DISTINCT {id_column} AS order_id
+    FROM {table}
+    WHERE {time_column} >= %s AND {time_column} < %s
+"""
+
+# 不限制状态: 变更后不再是 CANCELED / COMPLETE 的订单也要写进 keys 文件, 让下游删掉旧行
+deltaOrdersSql = """
+    SELECT id, user_id, order_channel, dining_option, created_time, status, remake_ref_order_id
+    FROM `order`.orders
+    WHERE id IN ({placeholders})
+    AND brand_category = 'BLUE_APRON'
+    AND order_channel IN ('BA_APP', 'BA_WEB')
+"""
+
+# 与 order_lines 的逐表查询等价: 订单 x 明细 x 明细费用 x 订单费用 x 客户 x 地址, 支付方式在服务端透视
+# 每种支付方式取 id 最小的一笔 (逐表查询按索引顺序取到的第一笔), 卡号从同一行取; stripe token 同样取 id 最小的一条
+# 客户 / 明细 / 订单费用 / 明细费用都用 LEFT JOIN, 缺失的订单由 reject_incomplete_orders 整单跳过并记入死信,
+# 没有明细的订单只有一行 (明细列为 NULL), 检查后丢弃, 与逐页组装一致
+# 时间片按 [start, end) 划分, 行顺序与 keyset 扫描 + order_lines 的输出一致
+joinOrderLinesSql = """
+    SELECT o.id, o.user_id, o.order_channel, o.dining_option, o.created_time, o.status, o.remake_ref_order_id,
+           c.user_id AS customer_user_id, c.email, c.phone, c.first_name, c.last_name,
+           c.created_time AS customer_created_time,
+           oi.id AS order_item_id, oi.menu_item_name, oi.order_quantity, oi.restaurant_id,
+           oci.order_item_id AS charge_order_item_id, oci.subtotal, oci.adjust_subtotal, oci.discount, oci.promotion,
+           oci.membership_subtotal, oci.subscription_save_discount,
+           oc.order_id AS charge_order_id, oc.final_amount,
+           oa.address_line, oa.unit_number_or_company, oa.city, oa.state, oa.zip_code,
+           pay.credit_card_payment_id, cc.credit_card_id, cc.account_number AS credit_card_account_number,
+           (SELECT spi.stripe_payment_method_id
+            FROM payment.stripe_payment_intents spi
+            WHERE spi.payment_id = pay.apple_pay_id
+            ORDER BY spi.id
+            LIMIT 1) AS apple_pay_token,
+           (SELECT spi.stripe_payment_method_id
+            FROM payment.stripe_payment_intents spi
+            WHERE spi.payment_id = pay.google_pay_id
+            ORDER BY spi.id
+            LIMIT 1) AS google_pay_token,
+           pay.apple_pay_id, pay.google_pay_id,
+           CASE WHEN o.status = 'CANCELED' AND EXISTS (
+               SELECT 1
+               FROM `order`.order_flags f
+               WHERE f.order_id = o.id AND f.action = 'BO_CANCEL' AND f.created_by = 'customer-service-site'
+           ) THEN 1 ELSE 0 END AS canceled_by_merchant
+    FROM `order`.orders o
+    LEFT JOIN customer.customers c ON c.user_id = o.user_id
+    LEFT JOIN `order`.order_items oi ON oi.order_id = o.id AND NOT oi.deleted
+    LEFT JOIN `order`.order_charge_items oci ON oci.order_id = o.id AND oci.order_item_id = oi.id
+    LEFT JOIN `order`.order_charges oc ON oc.order_id = o.id
+    LEFT JOIN `order`.order_addresses oa ON oa.order_id = o.id
+    LEFT JOIN (
+        SELECT op.order_id,
+               MIN(CASE WHEN op.payment_method = 'CREDIT_CARD' THEN op.id END) AS credit_card_payment_id,
+               MIN(CASE WHEN op.payment_method = 'APPLE_PAY' THEN op.id END) AS apple_pay_id,
+               MIN(CASE WHEN op.payment_method = 'GOOGLE_PAY' THEN op.id END) AS google_pay_id
+        FROM `order`.order_payments op
+        JOIN `order`.orders po ON po.id = op.order_id
+        WHERE po.created_time >= %s AND po.created_time < %s
+        GROUP BY op.order_id
+    ) pay ON pay.order_id = o.id
+    LEFT JOIN `order`.order_payments cc ON cc.id = pay.credit_card_payment_id
+    WHERE o.created_time >= %s AND o.created_time < %s
+    AND o.brand_category = 'BLUE_APRON'
+    AND o.order_channel IN ('BA_APP', 'BA_WEB')
+    AND o.status in ('CANCELED', 'COMPLETE')
+    ORDER BY o.created_time, o.id, oi.id
+"""
+
+
+def connect_with_retry(replica, label):
+    """从副本的连接池取连接, 连接池耗尽 / 连不上时退避重试"""
+    return retry_policy.call(lambda: replicas.connect(replica), f"{label} - 取连接")
+
+
+def log_day_result(current_date, row_count):
+    if row_count:
+        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 导出完成: {row_count} 条记录")
+    else:
+        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 无数据")
 
-def export_single_day(current_date):
-    logging.info(f"开始处理日期: {current_date.strftime('%Y-%m-%d')}")
+
+def export_slice(export_slice: ExportSlice, index, manifest):
+    day = export_slice.day.strftime('%Y-%m-%d')
+    label = (f"{day} [{export_slice.start_utc.strftime('%m-%d %H:%M:%S')}, "
+             f"{export_slice.end_utc.strftime('%m-%d %H:%M:%S')}) UTC")
+    s = totalTime.time()
 
     conn = None
-    try:
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 数据库连接已建立")
-        conn = mysql.connector.connect(pool_name='custom_connection_pool')
-        process_single_day(conn, current_date)
-    except mysql.connector.Error as err:
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 数据库连接失败: {err}")
-        return False
-    finally:
-        if conn:
-            conn.close()
+    hydrate_conn = None
+    with replicas.lease() as replica:
+        try:
+            conn = connect_with_retry(replica, label)
+            if order_scan_mode == 'stream':
+                # 扫描连接被无缓冲查询占用, 子表在第二条连接上加载
+                hydrate_conn = connect_with_retry(replica, label)
+            write_slice_segments(manifest, export_slice, index, conn, hydrate_conn or conn)
+            manifest.finish_slice(day, index)
+            e = totalTime.time()
+            logging.info(f"{label} - 时间片完成 (预估 {export_slice.order_count} 单, 副本 {replica.host}), "
+                         f"耗时: {e - s: .2f} 秒")
+            return True
+        except Exception as e:
+            logging.info(f"{label} - 时间片处理错误: {e}")
+            return False
+        finally:
+            if hydrate_conn:
+                hydrate_conn.close()
+            if conn:
+                conn.close()
+
+
+def write_slice_segments(manifest, export_slice: ExportSlice, index, conn, hydrate_conn):
+    """
+    时间片的输出写成若干分段文件, 每个分段落盘后登记到 manifest
+    只有 keyset 扫描有稳定的续读位置, 其他模式以整个时间片为一个分段, 中断后整片重做
+    """
+    day = export_slice.day.strftime('%Y-%m-%d')
+    state = manifest.slice_state(day, index)
+    segment = len(state['segments'])
+
+    if hydration_mode == 'join' or order_scan_mode != 'keyset':
+        with open_segment_writer(day, index, segment) as writer:
+            write_order_lines(writer, conn, hydrate_conn, export_slice.start_utc, export_slice.end_utc,
+                              export_slice.day)
+        manifest.commit_segments(day, index, segment_entries(writer), None)
+        return
+
+    after_key = resume_key(state)
+    if after_key:
+        logging.info(f"{day} - 时间片 {index} 从订单 {after_key[1]} ({after_key[0]}) 之后继续, 已提交 {state['rows']} 行")
+    pages = replicas.timed(conn, metrics.timed(
+        iter_order_pages(conn, export_slice.start_utc, export_slice.end_utc, after_key), 'order_page_query', day))
+    while True:
+        segment_pages = list(islice(pages, checkpoint_pages))
+        if not segment_pages:
+            return
+        with open_segment_writer(day, index, segment) as writer:
+            page_lines = (hydrate_order_page(rows, hydrate_conn, export_slice.day) for rows in segment_pages)
+            write_batches(writer, page_lines, order_line_to_row, day)
+        last_row = segment_pages[-1][-1]
+        manifest.commit_segments(day, index, segment_entries(writer), (last_row['created_time'], last_row['id']))
+        segment = len(manifest.slice_state(day, index)['segments'])
+
+
+def segment_entries(writer):
+    """分段写出的文件 (超过 SHARD_MAX_ROWS / SHARD_MAX_BYTES 时切成多个) 及其行数和首末 orderId, 拼接成分片时写进分片清单"""
+    segment_dir = os.path.dirname(writer.base_path)
+    return [{'path': os.path.join(segment_dir, shard['file']), 'rows': shard['rows'],
+             'first_order_id': shard['first_order_id'], 'last_order_id': shard['last_order_id']}
+            for shard in writer.shards]
+
+
+def open_segment_writer(day, index, segment):
+    """分段按与最终分片相同的阈值切开, 拼接时整段合并即可满足阈值"""
+    segment_dir = os.path.join(output_dir, '.segments', day)
+    os.makedirs(segment_dir, exist_ok=True)
+    base_path = os.path.join(segment_dir, f"s{index:04d}_{segment:04d}")
+    return ShardedWriter(output_format, base_path, csv_columns, parquet_column_types, output_compression,
+                         order_id_index, shard_max_rows,
+                         segment_max_bytes(output_format, csv_columns, shard_max_bytes, output_compression),
+                         write_manifest=False, document=order_document, header=False, checksum=False)
+
+
+def assemble_day(manifest, current_date):
+    """按时间片顺序把当天的所有分段拼接成分片, 登记完成后删除分段文件"""
+    day = current_date.strftime('%Y-%m-%d')
+    state = manifest.day_state(day)
+    segments = [segment for slice_state in state['slices'] for segment in slice_state['segments']]
+    rows = sum(slice_state['rows'] for slice_state in state['slices'])
+
+    with metrics.timer('file_assemble', day):
+        shards = concat_segment_shards(output_format, os.path.join(output_dir, f"orders_{day}"), csv_columns,
+                                       segments, output_compression, shard_max_rows, shard_max_bytes)
+    manifest.finish_day(day, [os.path.join(output_dir, shard['file']) for shard in shards], rows)
+    for path in (segment['path'] for segment in segments):
+        if os.path.exists(path):
+            os.remove(path)
+    remove_empty_dirs(os.path.join(output_dir, '.segments', day), os.path.join(output_dir, '.segments'))
+    return rows
+
+
+def remove_empty_dirs(*paths):
+    for path in paths:
+        if os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+
+
+def write_order_lines(writer, conn, hydrate_conn, start_time_utc, end_time_utc, current_date):
+    if hydration_mode == 'join':
+        write_joined_order_lines(writer, conn, start_time_utc, end_time_utc, current_date.strftime('%Y-%m-%d'))
+    else:
+        write_paged_order_lines(writer, conn, hydrate_conn, start_time_utc, end_time_utc, current_date)
 
 
-def process_single_day(conn, current_date):
-    s = totalTime.time()
-    try:
+def write_paged_order_lines(writer, conn, hydrate_conn, start_time_utc, end_time_utc, current_date):
+    pages = iter_page_order_lines(conn, hydrate_conn, start_time_utc, end_time_utc, current_date)
+    write_batches(writer, pages, order_line_to_row, current_date.strftime('%Y-%m-%d'))
 
-        timezone = pytz.timezone('America/New_York')
-        start_of_day_ny = timezone.localize(
-            datetime.combine(current_date, time.min)
-        )
-        end_of_day_ny = timezone.localize(
-            datetime.combine(current_date, time.max)
-        )
 
-        start_of_day_utc = start_of_day_ny.astimezone(pytz.UTC)
-        end_of_day_utc = end_of_day_ny.astimezone(pytz.UTC)
-        totalLines = []
-        skip = 0
+def write_batches(writer, batches, map_row, day):
+    """
+    batches 在取数线程中迭代 (分页查询 + 组装), 经转换进程映射后由当前线程写入 writer
+    三段通过有界队列并发执行, 见 pipeline.ExportPipeline
+    """
+    def write_result(result):
+        # 记录行映射 (转换进程内的耗时) 和写文件的耗时
+        metrics.observe('row_mapping', day, result.seconds)
+        with metrics.timer('file_write', day):
+            write_transformed(writer, result)
 
-        while True:
-            with conn.cursor(dictionary=True) as cursor:
-                searchOrderSql = """
-                                    SELECT id, user_id, order_channel, dining_option, created_time, status, remake_ref_order_id
-                                        FROM `order`.orders
-                                        WHERE created_time >= %s AND created_time <= %s
-                                        AND brand_category = 'BLUE_APRON'
-                                        AND order_channel IN ('BA_APP', 'BA_WEB')
-                                        AND status in ('CANCELED', 'COMPLETE')
-                                        LIMIT 100 OFFSET %s
-                                    """
-                cursor.execute(searchOrderSql, (start_of_day_utc, end_of_day_utc, skip))
-                rows = cursor.fetchall()
-                if len(rows) == 0:
-                    break
+    pipeline = ExportPipeline(transform_stage, pipeline_map_workers, pipeline_queue_size, metrics, day)
+    pipeline.run(batches, map_row, output_format == 'csv', write_result, order_id_index)
 
-                for row in rows:
-                    try:
-                        lines = order_lines(Order(**row), cursor)
-                        totalLines.extend(lines)
-                    except Exception as e:
-                        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 处理订单错误: {e}")
 
-                skip += 100
+def iter_page_order_lines(conn, hydrate_conn, start_time_utc, end_time_utc, current_date):
+    pages = iter_order_pages(conn, start_time_utc, end_time_utc)
+    for rows in replicas.timed(conn, metrics.timed(pages, 'order_page_query', current_date.strftime('%Y-%m-%d'))):
+        yield hydrate_order_page(rows, hydrate_conn, current_date)
 
-        if totalLines:
-            filename = f"orders_{current_date.strftime('%Y-%m-%d')}.csv"
-            filepath = os.path.join(output_dir, filename)
-            export_to_excel(totalLines, filepath)
-            logging.info(f"{current_date.strftime('%Y-%m-%d')} - 导出完成: {len(totalLines)} 条记录")
-        else:
-            logging.info(f"{current_date.strftime('%Y-%m-%d')} - 无数据")
 
-        e = totalTime.time()
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 处理完成, 耗时: {e - s: .2f} 秒")
-        return True
+def hydrate_order_page(rows, hydrate_conn, current_date):
+    return retry_page(rows, hydrate_conn, current_date.strftime('%Y-%m-%d'),
+                      lambda rejected: load_order_page(rows, hydrate_conn, current_date, rejected))
+
+
+def retry_page(rows, conn, day, load):
+    """
+    load(rejected) 加载一页订单的明细行, 组装失败的订单以 (order_id, error) 追加到 rejected
+    暂时性错误时重连 conn 后重做整页, rejected 每次重做前清空, 只有最后一次成功的结果记入死信
+    锁等待 / 死锁重试用尽后整页订单记入死信, 返回空页, 继续下一页;
+    连接级错误重试用尽 (数据库不可用) 和其他错误照常抛出, 时间片失败
+    """
+    label = f"{day} - 订单页 {rows[0]['id']} 起 {len(rows)} 单"
+    rejected = []
+
+    def attempt():
+        rejected.clear()
+        return load(rejected)
 
+    try:
+        lines = retry_policy.call(attempt, label, reset=lambda: reconnect(conn))
     except Exception as e:
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 处理过程中发生错误: {e}")
-        return False
+        if not is_transient(e):
+            raise
+        if is_connection_error(e):
+            logging.info(f"{label} 重试用尽, 数据库连接不可用, 时间片失败: {e}")
+            raise
+        for row in rows:
+            dead_letters.record(day, row['id'], e)
+        logging.info(f"{label} 重试用尽, 已记入死信: {e}")
+        return []
+    for order_id, error in rejected:
+        dead_letters.record(day, order_id, error)
+    return lines
+
+
+def load_order_page(rows, hydrate_conn, current_date, rejected):
+    day = current_date.strftime('%Y-%m-%d')
+    with hydrate_conn.cursor(dictionary=True) as cursor:
+        if hydration_mode == 'batch':
+            with metrics.timer('build_orders', day):
+                orders = [Order(**row) for row in rows]
+            return order_lines_for_page(orders, cursor, current_date, rejected)
+
+        page_lines = []
+        for row in rows:
+            try:
+                # 逐单模式下查询和组装交织在一起, 整单计入一个阶段
+                with metrics.timer('hydrate_per_order', day):
+                    lines = order_lines(Order(**row), cursor)
+                page_lines.extend(lines)
+            except Exception as e:
+                if is_transient(e):
+                    # 连接已经断开, 交给整页重试
+                    raise
+                rejected.append((row['id'], e))
+                logging.info(f"{day} - 处理订单错误, 跳过该订单: {row['id']} {e!r}")
+        return page_lines
+
+
+def write_joined_order_lines(writer, conn, start_time_utc, end_time_utc, day):
+    batches = replicas.timed(conn, metrics.timed(iter_joined_rows(conn, start_time_utc, end_time_utc), 'join_query', day))
+    write_batches(writer, reject_incomplete_orders(batches, day), join_row_to_row, day)
+
+
+def reject_incomplete_orders(batches, day):
+    """
+    JOIN 结果中缺 customer / order_charge, 或任一明细缺 order_charge_item 的订单整单跳过并记入死信, 与 build_page_lines 一致;
+    没有明细的订单不输出
+    同一订单的行相邻, 批次末尾的订单可能延续到下一批, 留到下一批一起判断
+    """
+    carry = []
+    for rows in batches:
+        rows = carry + rows
+        split = len(rows)
+        while split and rows[split - 1]['id'] == rows[-1]['id']:
+            split -= 1
+        carry = rows[split:]
+        yield complete_order_rows(rows[:split], day)
+    if carry:
+        yield complete_order_rows(carry, day)
+
+
+def complete_order_rows(rows, day):
+    result = []
+    for order_id, order_rows in groupby(rows, key=lambda row: row['id']):
+        order_rows = list(order_rows)
+        first = order_rows[0]
+        if first['customer_user_id'] is None:
+            error = ValueError(f"customer {first['user_id']} not found")
+        elif first['charge_order_id'] is None:
+            error = ValueError(f"order_charge for order {order_id} not found")
+        elif any(row['order_item_id'] is not None and row['charge_order_item_id'] is None for row in order_rows):
+            error = ValueError(f"order_charge_item for order {order_id} not found")
+        else:
+            result.extend(row for row in order_rows if row['order_item_id'] is not None)
+            continue
+        dead_letters.record(day, order_id, error)
+        logging.info(f"{day} - 处理订单错误, 已记入死信: {order_id} {error!r}")
+    return result
+
+
+def iter_joined_rows(conn, start_time_utc, end_time_utc):
+    slice_start = start_time_utc
+    while slice_start < end_time_utc:
+        slice_end = min(slice_start + timedelta(minutes=join_slice_minutes), end_time_utc)
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        try:
+            cursor.execute(joinOrderLinesSql, (slice_start, slice_end, slice_start, slice_end))
+            while True:
+                rows = cursor.fetchmany(page_size * 10)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            try:
+                cursor.close()
+            except mysql.connector.Error as err:
+                logging.info(f"关闭明细查询游标失败: {err}")
+        slice_start = slice_end
+
+
+def iter_order_pages(conn, start_time_utc, end_time_utc, after_key=None):
+    """
+    按页返回时间范围内的订单行
+    keyset 模式按 (created_time, id) 排序并从上一页最后一条续读, 避免 OFFSET 重复扫描已读行
+    after_key: keyset 模式下从断点 (created_time, id) 之后开始
+    """
+    if order_scan_mode == 'stream':
+        yield from stream_order_pages(conn, start_time_utc, end_time_utc)
+        return
+
+    last_key = after_key
+    skip = 0
+    label = f"订单分页查询 [{start_time_utc.strftime('%m-%d %H:%M:%S')}, {end_time_utc.strftime('%m-%d %H:%M:%S')})"
+
+    def fetch_page():
+        with conn.cursor(dictionary=True) as cursor:
+            if order_scan_mode == 'offset':
+                cursor.execute(offsetOrderPageSql, (start_time_utc, end_time_utc, page_size, skip))
+            elif last_key is None:
+                cursor.execute(firstOrderPageSql, (start_time_utc, end_time_utc, page_size))
+            else:
+                last_created_time, last_id = last_key
+                cursor.execute(nextOrderPageSql, (start_time_utc, end_time_utc, last_created_time, last_created_time,
+                                                  last_id, page_size))
+            return cursor.fetchall()
+
+    while True:
+        # 每页是一条独立的查询, 断线后重连重查这一页即可, 已经读过的页不受影响
+        rows = retry_policy.call(fetch_page, label, reset=lambda: reconnect(conn))
+
+        if not rows:
+            return
+
+        yield rows
+
+        if len(rows) < page_size:
+            return
+        last_key = (rows[-1]['created_time'], rows[-1]['id'])
+        skip += page_size
+
+
+def stream_order_pages(conn, start_time_utc, end_time_utc):
+    """
+    无缓冲 (服务端) 游标扫描整个时间范围, 行从 MySQL 边读边返回, 不会重复执行分页查询
+    扫描期间该连接不能执行其他查询, 子表加载需使用另一条连接
+    """
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(searchOrderSql, (start_time_utc, end_time_utc))
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        try:
+            cursor.close()
+        except mysql.connector.Error as err:
+            logging.info(f"关闭订单扫描游标失败: {err}")
 
 
 def export_with_threadpool():
@@ -114,38 +648,91 @@ def export_with_threadpool():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    start_date = datetime(2025, 8, 11)
-    end_date = datetime(2025, 9, 30)
-
     dates_to_process = []
-    current_date = start_date
-    while current_date <= end_date:
+    current_date = export_start_date
+    while current_date <= export_end_date:
         dates_to_process.append(current_date)
         current_date += timedelta(days=1)
 
     logging.info(f"开始处理 {len(dates_to_process)} 天的数据")
 
-    max_workers = min(7, len(dates_to_process))
+    if metrics_interval_seconds > 0:
+        metrics.start_periodic_write(output_dir, metrics_interval_seconds)
+
+    manifest = CheckpointManifest(os.path.join(output_dir, 'manifest.json'))
+    pending_dates = []
     successful_days = 0
-    failed_days = 0
+    for date in dates_to_process:
+        state = manifest.day_state(date.strftime('%Y-%m-%d'))
+        if state and state['done']:
+            logging.info(f"{date.strftime('%Y-%m-%d')} - 已完成 ({state['rows']} 条记录), 跳过")
+            archive_day(date)
+            successful_days += 1
+        else:
+            pending_dates.append(date)
 
+    # 已经开始过的日期沿用 manifest 中的划分, 不再重新统计
+    unplanned_dates = [date for date in pending_dates if manifest.day_state(date.strftime('%Y-%m-%d')) is None]
+    conn = replicas.connect()
+    try:
+        planned = plan_export_slices(conn, countOrdersByHourSql, unplanned_dates, slice_target_orders)
+    finally:
+        conn.close()
+
+    slices = []
+    for date in pending_dates:
+        day_slices = manifest.plan_day(date, [sl for sl in planned if sl.day == date])
+        slices.extend((date, index, export_slice_) for index, export_slice_ in enumerate(day_slices))
+    todo = [(date, index, export_slice_) for date, index, export_slice_ in slices
+            if not manifest.slice_state(date.strftime('%Y-%m-%d'), index)['done']]
+    logging.info(f"共 {len(slices)} 个时间片, 待处理 {len(todo)} 个, 目标每片 {slice_target_orders} 单, "
+                 f"转换进程数: {transform_stage.processes}, 每片同时转换 {pipeline_map_workers} 批, "
+                 f"队列长度 {pipeline_queue_size}")
+
+    pending_slices = {date: 0 for date in pending_dates}
+    failed_dates = set()
+    for date, _, _ in todo:
+        pending_slices[date] += 1
+
+    def finish_day(date):
+        if date in failed_dates:
+            logging.info(f"{date.strftime('%Y-%m-%d')} - 存在失败的时间片, 已完成的部分保留到下次继续")
+            return False
+        try:
+            log_day_result(date, assemble_day(manifest, date))
+            archive_day(date)
+            return True
+        except Exception as e:
+            logging.info(f"{date.strftime('%Y-%m-%d')} - 合并分段失败: {e}")
+            return False
+
+    # 所有时间片都已完成, 只差合并的日期
+    for date in pending_dates:
+        if pending_slices[date] == 0:
+            successful_days += 1 if finish_day(date) else 0
+
+    max_workers = min(slice_workers * len(replicas.replicas), len(todo)) or 1
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_date = {
-            executor.submit(export_single_day, date): date
-            for date in dates_to_process
+        future_to_slice = {
+            executor.submit(export_slice, export_slice_, index, manifest): date
+            for date, index, export_slice_ in todo
         }
 
-        for future in as_completed(future_to_date):
-            date = future_to_date[future]
+        for future in as_completed(future_to_slice):
+            date = future_to_slice[future]
             try:
                 result = future.result()
-                if result:
-                    successful_days += 1
-                else:
-                    failed_days += 1
             except Exception as e:
                 logging.info(f"{date.strftime('%Y-%m-%d')} - 线程执行异常: {e}")
-                failed_days += 1
+                result = False
+
+            if not result:
+                failed_dates.add(date)
+            pending_slices[date] -= 1
+            if pending_slices[date] == 0 and finish_day(date):
+                successful_days += 1
+
+    failed_days = len(dates_to_process) - successful_days
 
     end = totalTime.time()
     logging.info(f"\n=== 处理完成 ===")
@@ -153,17 +740,171 @@ def export_with_threadpool():
     logging.info(f"成功: {successful_days} 天")
     logging.info(f"失败: {failed_days} 天")
     logging.info(f"总耗时: {end - start: .2f} 秒")
+    logging.info(f"客户缓存: {customer_cache.stats()}")
+    log_dead_letters()
+    snapshot = metrics.snapshot()
+    logging.info(f"阶段耗时: {snapshot['stages']}")
+    logging.info(f"队列深度: {snapshot['queues']}")
+    replicas.log_summary()
+    metrics.stop(output_dir)
+    transform_stage.shutdown()
+    return failed_days == 0
+
+
+def log_dead_letters():
+    if dead_letters.recorded:
+        logging.info(f"死信订单: {len(dead_letters.recorded)} 个, 见 {dead_letters.path}, 可用 --redo-dead-letters 重新导出")
+
+
+def archive_day(current_date):
+    """job 模式: 把当天的分片和分片清单加入结果归档"""
+    if result_archive is not None:
+        result_archive.add_shards(os.path.join(output_dir, f"orders_{current_date.strftime('%Y-%m-%d')}"))
+
+
+def export_delta():
+    """
+    增量导出 [上次高水位, 现在 - DELTA_LAG_SECONDS) 内有变更的订单:
+    orders_delta_<区间>_keys 列出所有变更订单的 orderId, orders_delta_<区间> 是这些订单当前的全部明细行
+    下游按 keys 删除旧行再插入明细行; 两个文件都写完后才推进高水位
+    """
+    start = totalTime.time()
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    watermark_path = os.path.join(output_dir, 'watermark.json')
+    since = load_watermark(watermark_path)
+    if since is None:
+        if not delta_since:
+            raise ValueError("第一次增量导出需要设置 DELTA_SINCE")
+        since = datetime.fromisoformat(delta_since).replace(tzinfo=timezone.utc)
+    until = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(seconds=delta_lag_seconds)
+    if until <= since:
+        logging.info(f"增量区间为空: {since.isoformat()} 之后还没有可导出的变更")
+        return True
+
+    tag = f"{since.strftime('%Y%m%dT%H%M%S')}_{until.strftime('%Y%m%dT%H%M%S')}"
+    day = until.strftime('%Y-%m-%d')
+    conn = retry_policy.call(replicas.connect, "增量导出 - 取连接")
+    try:
+        with metrics.timer('delta_changed_ids', day):
+            order_ids = retry_policy.call(lambda: changed_order_ids(conn, since, until), "增量导出 - 查询变更订单",
+                                          reset=lambda: reconnect(conn))
+        with metrics.timer('order_page_query', day):
+            orders = retry_policy.call(lambda: load_orders_by_id(conn, order_ids), "增量导出 - 查询订单",
+                                       reset=lambda: reconnect(conn))
+        exported = [row for row in orders if row['status'] in ('CANCELED', 'COMPLETE')]
+        logging.info(f"增量 {since.isoformat()} ~ {until.isoformat()}: {len(order_ids)} 个变更订单, "
+                     f"其中 {len(orders)} 个属于导出范围, {len(exported)} 个需要导出明细")
+
+        base_path = os.path.join(output_dir, f"orders_delta_{tag}")
+        with open_writer(output_format, base_path + '_keys', ['orderId'], None, output_compression) as keys_writer, \
+                ShardedWriter(output_format, base_path, csv_columns, parquet_column_types, output_compression,
+                              order_id_index, shard_max_rows, shard_max_bytes, document=order_document) as writer:
+            keys_writer.write_rows((row['id'],) for row in orders)
+            pages = (delta_page_lines(conn, exported[i:i + page_size], until) for i in range(0, len(exported), page_size))
+            write_batches(writer, pages, order_line_to_row, day)
+    finally:
+        conn.close()
+
+    if result_archive is not None:
+        if keys_writer.filepath:
+            result_archive.add(keys_writer.filepath)
+        result_archive.add_shards(base_path)
+    save_watermark(watermark_path, until)
+    end = totalTime.time()
+    logging.info(f"增量导出完成: {keys_writer.row_count} 个订单, {writer.row_count} 条记录, 耗时: {end - start: .2f} 秒")
+    log_dead_letters()
+    metrics.stop(output_dir)
+    transform_stage.shutdown()
+    return True
+
+
+def redo_dead_letters():
+    """
+    --redo-dead-letters: 只重新导出 dead_letters.jsonl 中的订单, 写入 orders_redo_<时间>, 与增量文件一样由下游按 orderId 覆盖
+    已不在导出范围内 (状态变化) 的订单直接移出死信; 这次仍然失败的订单留在死信文件中
+    """
+    start = totalTime.time()
+    entries = dead_letters.entries()
+    if not entries:
+        logging.info(f"没有死信订单: {dead_letters.path}")
+        return True
+
+    order_ids = sorted({entry['order_id'] for entry in entries})
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    day = now.strftime('%Y-%m-%d')
+    base_path = os.path.join(output_dir, f"orders_redo_{now.strftime('%Y%m%dT%H%M%S')}")
+    conn = retry_policy.call(replicas.connect, "重做死信 - 取连接")
+    try:
+        orders = retry_policy.call(lambda: load_orders_by_id(conn, order_ids), "重做死信 - 查询订单",
+                                   reset=lambda: reconnect(conn))
+        exported = [row for row in orders if row['status'] in ('CANCELED', 'COMPLETE')]
+        logging.info(f"重做死信: {len(order_ids)} 个订单, 其中 {len(exported)} 个仍需导出")
+        with ShardedWriter(output_format, base_path, csv_columns, parquet_column_types, output_compression,
+                           order_id_index, shard_max_rows, shard_max_bytes, document=order_document) as writer:
+            pages = (delta_page_lines(conn, exported[i:i + page_size], now) for i in range(0, len(exported), page_size))
+            write_batches(writer, pages, order_line_to_row, day)
+    finally:
+        conn.close()
+
+    dead_letters.keep_recorded()
+    if result_archive is not None:
+        result_archive.add_shards(base_path)
+    end = totalTime.time()
+    logging.info(f"重做死信完成: {writer.row_count} 条记录, 耗时: {end - start: .2f} 秒")
+    log_dead_letters()
+    metrics.stop(output_dir)
+    transform_stage.shutdown()
+    return not dead_letters.recorded
+
+
+def changed_order_ids(conn, since, until):
+    order_ids = set()
+    with conn.cursor(dictionary=True) as cursor:
+        for table, time_column, id_column in deltaSourceTables:
+            cursor.execute(changedOrderIdsSql.format(table=table, time_column=time_column, id_column=id_column),
+                           (since, until))
+            order_ids.update(row['order_id'] for row in cursor.fetchall())
+    return sorted(order_ids)
+
+
+def load_orders_by_id(conn, order_ids, batch_size=1000):
+    """按 id 分批查订单, 结果按 (created_time, id) 排序, 与按天导出的顺序一致"""
+    orders = []
+    with conn.cursor(dictionary=True) as cursor:
+        for i in range(0, len(order_ids), batch_size):
+            orders.extend(fetch_rows_in(cursor, deltaOrdersSql, order_ids[i:i + batch_size]))
+    orders.sort(key=lambda row: (row['created_time'], row['id']))
+    return orders
+
+
+def delta_page_lines(conn, rows, current_date):
+    def load(rejected):
+        with conn.cursor(dictionary=True) as cursor:
+            return order_lines_for_page([Order(**row) for row in rows], cursor, current_date, rejected)
+
+    return retry_page(rows, conn, current_date.strftime('%Y-%m-%d'), load)
+
+
+def load_customers(user_ids, cursor):
+    """先查共享缓存, 未命中的 user_id 用一条 IN 查询补齐并写回缓存"""
+    customers, missing = customer_cache.get_many(user_ids)
+    if missing:
+        loaded = [
+            Customer(**row)
+            for row in fetch_rows_in(cursor, customersInSql, missing)
+        ]
+        customer_cache.put_many(loaded)
+        customers.update((customer.user_id, customer) for customer in loaded)
+    return customers
 
 
 def order_lines(order: Order, cursor):
     # customer
-    cursor.execute("""
-        SELECT user_id, email, phone, first_name, last_name, created_time
-        FROM customer.customers
-        WHERE user_id=%s
-    """, (order.user_id,))
-    customer_data = cursor.fetchone()
-    customer = Customer(**customer_data)
+    customer = load_customers([order.user_id], cursor).get(order.user_id)
+    if customer is None:
+        raise ValueError(f"customer {order.user_id} not found")
 
     # order_items
     cursor.execute("""
@@ -247,257 +988,276 @@ def order_lines(order: Order, cursor):
     return result
 
 
-def order_line_to_dict(order_line):
-    def safe_get(attr_path, default=""):
-        try:
-            value = order_line
-            for attr in attr_path.split('.'):
-                if value is None:
-                    return default
-                value = getattr(value, attr, None)
-            return default if value is None else value
-        except (AttributeError, IndexError, TypeError):
-            return default
-
-    def refundable_subtotal(charge_item):
-        if not charge_item:
-            return ""
-        return str(charge_item.subtotal) if charge_item.subtotal is not None else ""
-
-    def find_payment(method):
-        for payment in (order_line.order_payments or []):
-            if payment.payment_method == method:
-                return payment
-        return None
-
-    def find_stripe_token(payment_id):
-        for stripe_payment in (order_line.stripe_payment_intents or []):
-            if stripe_payment.payment_id == payment_id:
-                return stripe_payment.stripe_payment_method_id
-        return ""
-
-    google_pay = find_payment("GOOGLE_PAY")
-    apple_pay = find_payment("APPLE_PAY")
-    credit_card = find_payment("CREDIT_CARD")
-
-    google_pay_token = find_stripe_token(google_pay.id) if google_pay else ""
-    apple_pay_token = find_stripe_token(apple_pay.id) if apple_pay else ""
-
-    address_line1 = safe_get('order_address.address_line') or ''
-    address_line2 = safe_get('order_address.unit_number_or_company') or ''
-    city = safe_get('order_address.city') or ''
-    state = safe_get('order_address.state') or ''
-    zip_code = safe_get('order_address.zip_code') or ''
-
-    data = {
-        "accountOwner.accountId": safe_get('customer.user_id'),
-        "accountOwner.created": str(int(safe_get('customer.created_time').timestamp())) if safe_get(
-            'customer.created_time') else "",
-        "accountOwner.email": safe_get('customer.email'),
-        "accountOwner.firstName": safe_get('customer.first_name'),
-        "accountOwner.fullName": "",
-        "accountOwner.lastName": safe_get('customer.last_name'),
-
-        "cartItems[].basicItemData.name": safe_get('order_item.menu_item_name'),
-        "cartItems[].basicItemData.quantity": str(safe_get('order_item.order_quantity')) if safe_get(
-            'order_item.order_quantity') else "",
-        "cartItems[].basicItemData.category": "",
-        "cartItems[].basicItemData.price.amountLocalCurrency": "",
-        "cartItems[].basicItemData.price.amountUSD": refundable_subtotal(order_line.order_charge_item),
-        "cartItems[].basicItemData.price.currency": "",
-
-        "cartItems[].beneficiaries[].personalDetails.email": "",
-        "cartItems[].beneficiaries[].personalDetails.firstName": "",
-        "cartItems[].beneficiaries[].personalDetails.fullName": "",
-        "cartItems[].beneficiaries[].personalDetails.lastName": "",
-        "cartItems[].beneficiaries[].phone[].phone": "",
-
-        "cartItems[].itemSpecificData.food.restaurantAddress.address1": '',
-        "cartItems[].itemSpecificData.food.restaurantAddress.address2": '',
-        "cartItems[].itemSpecificData.food.restaurantAddress.city": '',
-        "cartItems[].itemSpecificData.food.restaurantAddress.country": "US",
-        "cartItems[].itemSpecificData.food.restaurantAddress.region": "",
-        "cartItems[].itemSpecificData.food.restaurantAddress.zip": "",
-        "cartItems[].itemSpecificData.food.restaurantId": "Blue Apron",
-        "cartItems[].itemSpecificData.food.restaurantName": "Blue Apron",
-
-        "checkoutTime": str(int(safe_get('order.created_time').timestamp())) if safe_get('order.created_time') else "",
-        "connectionInformation.customerIP": '127.0.0.1',
-        "historicalData.fraud": "",
-        "historicalData.orderStatus": get_historical_order_status(order_line.order, order_line.order_flags),
-        "orderId": safe_get('order.id'),
-        "orderType": get_order_type(order_line.order),
-
-        # Android Pay (Google Pay)
-        "payment[].androidPay.bin": "",
-        "payment[].androidPay.expirationMonth": "",
-        "payment[].androidPay.expirationYear": "",
-        "payment[].androidPay.lastFourDigits": "",
-        "payment[].androidPay.nameOnCard": "",
-        "payment[].androidPay.token": google_pay_token,
-
-        # Apple Pay
-        "payment[].applePay.bin": "",
-        "payment[].applePay.expirationMonth": "",
-        "payment[].applePay.expirationYear": "",
-        "payment[].applePay.lastFourDigits": "",
-        "payment[].applePay.nameOnCard": "",
-        "payment[].applePay.token": apple_pay_token,
-
-        # Billing Details
-        "payment[].billingDetails.address.address1": "",
-        "payment[].billingDetails.address.address2": "",
-        "payment[].billingDetails.address.city": "",
-        "payment[].billingDetails.address.country": "",
-        "payment[].billingDetails.address.region": "",
-        "payment[].billingDetails.address.zip": "",
-        "payment[].billingDetails.personalDetails.email": "",
-        "payment[].billingDetails.phone[].phone": "",
-        "payment[].billingDetails.personalDetails.fullName": "",
-        "payment[].billingDetails.personalDetails.firstName": "",
-        "payment[].billingDetails.personalDetails.lastName": "",
-
-        # Credit Card
-        "payment[].creditCard.bin": "",
-        "payment[].creditCard.expirationMonth": "",
-        "payment[].creditCard.expirationYear": "",
-        "payment[].creditCard.lastFourDigits": "",
-        "payment[].creditCard.nameOnCard": "",
-        "payment[].creditCard.verificationResults.processorResponseCode": "",
-        "payment[].creditCard.verificationResults.processorResponseText": "",
-
-        # Tokenized Card
-        "payment[].tokenizedCard.bin": "",
-        "payment[].tokenizedCard.expirationMonth": "",
-        "payment[].tokenizedCard.expirationYear": "",
-        "payment[].tokenizedCard.lastFourDigits": credit_card.account_number if credit_card else "",
-        "payment[].tokenizedCard.verificationResults.processorResponseCode": "",
-        "payment[].tokenizedCard.verificationResults.processorResponseText": "",
-        "payment[].tokenizedCard.verificationResults.eciValue": "",
-        "payment[].tokenizedCard.token": credit_card.credit_card_id if credit_card else "",
-
-        # Delivery Details
-        "primaryDeliveryDetails.deliveryMethod": safe_get('order.dining_option'),
-        "primaryDeliveryDetails.deliveryType": "PHYSICAL",
-
-        # Recipient Details
-        "primaryRecipient.address.address1": address_line1,
-        "primaryRecipient.address.address2": address_line2,
-        "primaryRecipient.address.city": city,
-        "primaryRecipient.address.zip": zip_code,
-        "primaryRecipient.address.country": "US",
-        "primaryRecipient.address.region": state,
-        "primaryRecipient.personalDetails.email": safe_get('customer.email'),
-        "primaryRecipient.phone[].phone": safe_get('customer.phone'),
-
-        # Total Amount
-        "totalAmount.amountLocalCurrency": "",
-        "totalAmount.amountUSD": get_final_amount(order_line.order_charge),
-        "totalAmount.currency": 'USD'
-    }
-
-    return data
+def fetch_rows_in(cursor, sql_template, values):
+    if not values:
+        return []
+    format_strings = ','.join(['%s'] * len(values))
+    cursor.execute(sql_template.format(placeholders=format_strings), tuple(values))
+    return cursor.fetchall()
 
 
-def get_final_amount(orderCharge: OrderCharge):
-    if orderCharge is None or orderCharge.final_amount is None:
-        return "0"
-    return str(orderCharge.final_amount)
+def group_by_order_id(rows):
+    grouped = {}
+    for row in rows:
+        order_id = row.pop('order_id')
+        grouped.setdefault(order_id, []).append(row)
+    return grouped
 
 
-def get_order_type(order: Order):
-    if order.order_channel == 'BA_WEB' or order.order_channel == 'WEB':
-        return 'WEB'
-    elif order.order_channel == 'BA_APP' or order.order_channel == 'APP':
-        return 'MOBILE'
+def order_lines_for_page(orders, cursor, current_date, rejected):
+    """
+    整页订单批量加载: 每张子表一条 IN (...) 查询, 再在内存中按 order_id 组装 OrderLine
+    结果与逐单调用 order_lines 一致, 单个订单组装失败时只跳过该订单, 追加到 rejected
+    """
+    order_ids = [order.id for order in orders]
+    user_ids = list({order.user_id for order in orders})
+    canceled_order_ids = [order.id for order in orders if order.status == 'CANCELED']
+    day = current_date.strftime('%Y-%m-%d')
 
-    return "UNKNOWN"
+    # customer
+    with metrics.timer('query_customers', day):
+        customers = load_customers(user_ids, cursor)
 
+    # order_items
+    with metrics.timer('query_order_items', day):
+        order_items_by_order = group_by_order_id(fetch_rows_in(cursor, orderItemsInSql, order_ids))
 
-def get_historical_order_status(order: Order, order_flags: list) -> str:
-    if order.status == 'COMPLETE':
-        return 'COMPLETE'
+    # order_charge_items
+    with metrics.timer('query_order_charge_items', day):
+        charge_items_by_order = group_by_order_id(fetch_rows_in(cursor, orderChargeItemsInSql, order_ids))
 
-    elif order.status == 'CANCELED':
-        for flag in order_flags:
-            if flag.created_by == 'customer-service-site':
-                return 'CANCELED_BY_MERCHANT'
+    # order_charge
+    with metrics.timer('query_order_charges', day):
+        charges_by_order = group_by_order_id(fetch_rows_in(cursor, orderChargesInSql, order_ids))
 
-        return 'CANCELED_BY_CUSTOMER'
+    # order_payments
+    with metrics.timer('query_order_payments', day):
+        payments_by_order = group_by_order_id(fetch_rows_in(cursor, orderPaymentsInSql, order_ids))
+    payments_by_order = {
+        order_id: [OrderPayment(**row) for row in rows]
+        for order_id, rows in payments_by_order.items()
+    }
 
-    else:
-        return ''
-
-
-def export_to_excel(lines, filename=None):
-    data = [order_line_to_dict(line) for line in lines]
-    csv_columns = [
-        'accountOwner.accountId', 'accountOwner.created', 'accountOwner.email',
-        'accountOwner.firstName', 'accountOwner.fullName', 'accountOwner.lastName',
-        'cartItems[].basicItemData.name', 'cartItems[].basicItemData.quantity',
-        'cartItems[].basicItemData.category', 'cartItems[].basicItemData.price.amountLocalCurrency',
-        'cartItems[].basicItemData.price.amountUSD', 'cartItems[].basicItemData.price.currency',
-        'cartItems[].beneficiaries[].personalDetails.email',
-        'cartItems[].beneficiaries[].personalDetails.firstName',
-        'cartItems[].beneficiaries[].personalDetails.fullName',
-        'cartItems[].beneficiaries[].personalDetails.lastName',
-        'cartItems[].beneficiaries[].phone[].phone', 'cartItems[].itemSpecificData.food.restaurantAddress.address1',
-        'cartItems[].itemSpecificData.food.restaurantAddress.address2',
-        'cartItems[].itemSpecificData.food.restaurantAddress.city',
-        'cartItems[].itemSpecificData.food.restaurantAddress.country',
-        'cartItems[].itemSpecificData.food.restaurantAddress.region',
-        'cartItems[].itemSpecificData.food.restaurantAddress.zip', 'cartItems[].itemSpecificData.food.restaurantId',
-        'cartItems[].itemSpecificData.food.restaurantName', 'checkoutTime', 'connectionInformation.customerIP',
-        'historicalData.fraud', 'historicalData.orderStatus', 'orderId', 'orderType',
-        'payment[].androidPay.bin', 'payment[].androidPay.expirationMonth', 'payment[].androidPay.expirationYear',
-        'payment[].androidPay.lastFourDigits', 'payment[].androidPay.nameOnCard', 'payment[].androidPay.token',
-        'payment[].applePay.bin',
-        'payment[].applePay.expirationMonth', 'payment[].applePay.expirationYear',
-        'payment[].applePay.lastFourDigits',
-        'payment[].applePay.nameOnCard', 'payment[].applePay.token', 'payment[].billingDetails.address.address1',
-        'payment[].billingDetails.address.address2',
-        'payment[].billingDetails.address.city', 'payment[].billingDetails.address.country',
-        'payment[].billingDetails.address.region',
-        'payment[].billingDetails.address.zip', 'payment[].billingDetails.personalDetails.email',
-        'payment[].billingDetails.phone[].phone',
-        'payment[].billingDetails.personalDetails.fullName', 'payment[].billingDetails.personalDetails.firstName',
-        'payment[].billingDetails.personalDetails.lastName', 'payment[].creditCard.bin',
-        'payment[].creditCard.expirationMonth',
-        'payment[].creditCard.expirationYear', 'payment[].creditCard.lastFourDigits',
-        'payment[].creditCard.nameOnCard',
-        'payment[].creditCard.verificationResults.processorResponseCode',
-        'payment[].creditCard.verificationResults.processorResponseText',
-        'payment[].tokenizedCard.bin', 'payment[].tokenizedCard.expirationMonth',
-        'payment[].tokenizedCard.expirationYear',
-        'payment[].tokenizedCard.lastFourDigits',
-        'payment[].tokenizedCard.verificationResults.processorResponseCode',
-        'payment[].tokenizedCard.verificationResults.processorResponseText',
-        'payment[].tokenizedCard.verificationResults.eciValue',
-        'payment[].tokenizedCard.token', 'primaryDeliveryDetails.deliveryMethod',
-        'primaryDeliveryDetails.deliveryType',
-        'primaryRecipient.address.address1', 'primaryRecipient.address.address2', 'primaryRecipient.address.city',
-        'primaryRecipient.address.zip', 'primaryRecipient.address.country', 'primaryRecipient.address.region',
-        'primaryRecipient.personalDetails.email', 'primaryRecipient.phone[].phone',
-        'totalAmount.amountLocalCurrency',
-        'totalAmount.amountUSD', 'totalAmount.currency'
+    # stripe_payment_intents
+    psp_payment_ids = [
+        p.id
+        for payments in payments_by_order.values()
+        for p in payments
+        if p.payment_method in ('APPLE_PAY', 'GOOGLE_PAY')
     ]
+    with metrics.timer('query_stripe_payment_intents', day):
+        stripe_intent_rows = fetch_rows_in(cursor, stripePaymentIntentsInSql, psp_payment_ids)
+    stripe_intents_by_payment = {}
+    for row in stripe_intent_rows:
+        stripe_intents_by_payment.setdefault(row['payment_id'], []).append(StripePaymentIntent(**row))
 
-    if data:
-        df = pd.DataFrame(data, columns=csv_columns)
-    else:
-        df = pd.DataFrame(columns=csv_columns)
+    # order_address
+    with metrics.timer('query_order_addresses', day):
+        addresses_by_order = group_by_order_id(fetch_rows_in(cursor, orderAddressesInSql, order_ids))
+
+    # order_flags
+    with metrics.timer('query_order_flags', day):
+        flag_rows = fetch_rows_in(cursor, orderFlagsInSql, canceled_order_ids)
+    flags_by_order = {}
+    for row in flag_rows:
+        flags_by_order.setdefault(row['order_id'], []).append(OrderFlag(**row))
+
+    with metrics.timer('build_order_lines', day):
+        return build_page_lines(orders, customers, order_items_by_order, charge_items_by_order, charges_by_order,
+                                payments_by_order, stripe_intents_by_payment, addresses_by_order, flags_by_order,
+                                day, rejected)
+
+
+def build_page_lines(orders, customers, order_items_by_order, charge_items_by_order, charges_by_order,
+                     payments_by_order, stripe_intents_by_payment, addresses_by_order, flags_by_order, day,
+                     rejected):
+    result = []
+    for order in orders:
+        try:
+            customer = customers.get(order.user_id)
+            if customer is None:
+                raise ValueError(f"customer {order.user_id} not found")
+            charge_rows = charges_by_order.get(order.id)
+            if not charge_rows:
+                raise ValueError(f"order_charge for order {order.id} not found")
+            order_charge = OrderCharge(**charge_rows[0])
+
+            order_payments = payments_by_order.get(order.id, [])
+            stripe_payment_intents = [
+                intent
+                for p in order_payments
+                if p.payment_method in ('APPLE_PAY', 'GOOGLE_PAY')
+                for intent in stripe_intents_by_payment.get(p.id, [])
+            ]
+            addr_rows = addresses_by_order.get(order.id)
+            order_address = OrderAddress(**addr_rows[0]) if addr_rows else None
+            order_flags = flags_by_order.get(order.id, [])
+            order_charge_items = [OrderChargeItem(**row) for row in charge_items_by_order.get(order.id, [])]
+
+            lines = []
+            for item_row in order_items_by_order.get(order.id, []):
+                item = OrderItem(**item_row)
+                charge_item = next(oci for oci in order_charge_items if oci.order_item_id == item.id)
+                lines.append(OrderLine(
+                    order=order,
+                    customer=customer,
+                    order_item=item,
+                    order_charge_item=charge_item,
+                    order_charge=order_charge,
+                    order_payments=order_payments,
+                    stripe_payment_intents=stripe_payment_intents,
+                    order_address=order_address,
+                    order_flags=order_flags
+                ))
+            result.extend(lines)
+        except Exception as e:
+            rejected.append((order.id, e))
+            logging.info(f"{day} - 处理订单错误, 跳过该订单: {order.id} {e!r}")
+
+    return result
 
-    df.to_csv(filename, index=False, encoding='utf-8')
-    return filename
+
+def tune_workers():
+    """
+    在创建连接池之前校准, 按拐点并发设置连接池大小和并发时间片数, 两者保持一致, 避免连接池耗尽
+    多个副本时只探测第一个, 假定各副本规格相同; 结果是单个副本的连接池大小和并发时间片数
+    """
+    global slice_workers
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    probe_start, probe_end = day_range_utc(export_start_date)
+    replica = replicas.replicas[0]
+
+    def connect():
+        return mysql.connector.connect(host=replica.address, port=replica.port, user=db_config['user'],
+                                       password=db_config['password'])
+
+    def run_query(conn):
+        # 与导出相同的分页查询, 起点在第一天内随机, 避免一直命中同一批页
+        start = probe_start + timedelta(minutes=random.randrange(24 * 60))
+        with conn.cursor(dictionary=True) as cursor:
+            cursor.execute(firstOrderPageSql, (start, probe_end, page_size))
+            cursor.fetchall()
+
+    calibration = calibrate(os.path.join(output_dir, 'autotune.json'), autotune_mode, replica.host,
+                            autotune_max_age_hours, connect, run_query, autotune_probe_seconds)
+    connections = min(calibration['concurrency'] if calibration else db_config['pool_size'], max_pool_size)
+    connections_per_slice = 2 if order_scan_mode == 'stream' else 1
+    if calibration:
+        slice_workers = max(1, connections // connections_per_slice)
+    else:
+        slice_workers = max(1, min(slice_workers, connections // connections_per_slice))
+    db_config['pool_size'] = slice_workers * connections_per_slice
+    logging.info(f"连接池 {db_config['pool_size']} 条, 并发时间片 {slice_workers} 个 (每片 {connections_per_slice} 条连接), "
+                 f"来源: {'校准' if calibration else 'pool_size'}")
+
+
+def preflight_queries(conn):
+    """
+    按当前的导出模式列出会执行的查询, 参数取第一天的时间范围和当天的一个真实订单
+    子表只检查批量加载的 IN 模板: 单个值的 IN 与 per_order 模式的 order_id = %s 走同一个索引
+    """
+    day_start, day_end = day_range_utc(export_start_date)
+    with conn.cursor(dictionary=True) as cursor:
+        cursor.execute(firstOrderPageSql, (day_start, day_end, 1))
+        sample = (cursor.fetchall() or [{}])[0]
+        payments = fetch_rows_in(cursor, orderPaymentsInSql, [sample['id']]) if sample else []
+    order_id = sample.get('id', '')
+    user_id = sample.get('user_id', '')
+    payment_id = payments[0]['id'] if payments else ''
+
+    queries = []
+    if export_mode == 'delta':
+        since = day_start
+        for table, time_column, id_column in deltaSourceTables:
+            queries.append(preflight_query(
+                f"delta_changed_ids {table}",
+                changedOrderIdsSql.format(table=table, time_column=time_column, id_column=id_column),
+                (since, since + timedelta(hours=1)), '小时'))
+        queries.append(preflight_query('delta_orders', deltaOrdersSql.format(placeholders='%s'), (order_id,), '单'))
+    elif hydration_mode == 'join':
+        slice_end = day_start + timedelta(minutes=join_slice_minutes)
+        queries.append(preflight_query('join_query', joinOrderLinesSql, (day_start, slice_end, day_start, slice_end),
+                                       f"{join_slice_minutes}分钟"))
+    else:
+        scan_queries = {
+            'keyset': (nextOrderPageSql, (day_start, day_end, day_start, day_start, '', page_size)),
+            'offset': (offsetOrderPageSql, (day_start, day_end, page_size, 0)),
+            'stream': (searchOrderSql, (day_start, day_end)),
+        }
+        sql, params = scan_queries[order_scan_mode]
+        queries.append(preflight_query('order_page_query', sql, params, '天'))
+    if export_mode != 'delta':
+        queries.append(preflight_query('count_orders_by_hour', countOrdersByHourSql, (day_start, day_end), '天',
+                                       allow_filesort=True))
+
+    if hydration_mode != 'join' or export_mode == 'delta':
+        for name, template, value in (
+                ('query_customers', customersInSql, user_id),
+                ('query_order_items', orderItemsInSql, order_id),
+                ('query_order_charge_items', orderChargeItemsInSql, order_id),
+                ('query_order_charges', orderChargesInSql, order_id),
+                ('query_order_payments', orderPaymentsInSql, order_id),
+                ('query_stripe_payment_intents', stripePaymentIntentsInSql, payment_id),
+                ('query_order_addresses', orderAddressesInSql, order_id),
+                ('query_order_flags', orderFlagsInSql, order_id)):
+            queries.append(preflight_query(name, template.format(placeholders='%s'), (value,), '单'))
+    return queries
+
+
+def preflight():
+    """每个副本都检查一遍: 缺索引的往往只是其中一个副本"""
+    if preflight_mode == 'off':
+        return
+    for replica in replicas.replicas:
+        conn = replicas.connect(replica)
+        try:
+            run_preflight(conn, preflight_queries(conn), preflight_mode, replica.host)
+        finally:
+            conn.close()
 
 
 def main():
+    global result_archive
     logging.info("开始数据导出任务...")
-    mysql.connector.connect(**db_config)
-    export_with_threadpool()
+    if run_mode == 'job':
+        result_archive = ResultArchive(check_archive_path(archive_path, output_dir))
+    if redo_dead_letters_mode:
+        replicas.create_pools(db_config, slice_workers)
+        succeeded = redo_dead_letters()
+    elif export_mode == 'delta':
+        replicas.create_pools(db_config, slice_workers)
+        preflight()
+        succeeded = export_delta()
+    else:
+        tune_workers()
+        replicas.create_pools(db_config, slice_workers)
+        preflight()
+        succeeded = export_with_threadpool()
     logging.info("数据导出完成")
+    if run_mode == 'job':
+        seal_archive(succeeded)
+        return 0 if succeeded else 1
     totalTime.sleep(36000)
+    return 0
+
+
+def seal_archive(succeeded):
+    """阶段耗时快照也放进归档, 然后封口"""
+    metrics_path = os.path.join(output_dir, f"{metrics.prefix}.json")
+    if os.path.exists(metrics_path):
+        result_archive.add(metrics_path)
+    if os.path.exists(dead_letters.path):
+        result_archive.add(dead_letters.path)
+    result_archive.seal({
+        'export_mode': 'redo_dead_letters' if redo_dead_letters_mode else export_mode,
+        'start_date': export_start_date.strftime('%Y-%m-%d'),
+        'end_date': export_end_date.strftime('%Y-%m-%d'),
+        'succeeded': succeeded,
+        'dead_letters': len(dead_letters.recorded),
+    })
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
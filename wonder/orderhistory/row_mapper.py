@@ -0,0 +1,139 @@
+# row_mapper.py
+from operator import itemgetter
+
+from exportcommon.row_mapper import (
+    compile_document, compile_row_mapper, epoch_seconds, order_line_columns, parquet_column_types
+)
+from models import (
+    Order, Customer, OrderItem, OrderChargeItem, OrderCharge,
+    OrderPayment, StripePaymentIntent,
+    OrderAddress, OrderLine, OrderFlag
+)
+
+# 订单的 checkoutTime 取 created_time
+forter_columns = order_line_columns(epoch_seconds('order.created_time'))
+
+csv_columns = [column for column, _ in forter_columns]
+
+map_order_line = compile_row_mapper(forter_columns)
+
+
+def order_line_to_row(order_line):
+    # 模块级函数, 可以按名字 pickle 传给转换进程
+    return map_order_line(order_line)
+
+
+def order_line_to_dict(order_line):
+    return dict(zip(csv_columns, order_line_to_row(order_line)))
+
+
+order_document = compile_document(csv_columns, parquet_column_types)
+
+
+# joinOrderLinesSql 中订单级的列; 同一订单的行相邻, 这些列与上一行完全相同时复用上一行的订单级对象,
+# order 是同一个对象, 行映射就只补明细列
+join_order_key = itemgetter(
+    'id', 'user_id', 'order_channel', 'dining_option', 'created_time', 'status', 'remake_ref_order_id',
+    'email', 'phone', 'first_name', 'last_name', 'customer_created_time', 'final_amount', 'credit_card_payment_id',
+    'credit_card_id', 'credit_card_account_number', 'apple_pay_id', 'apple_pay_token', 'google_pay_id',
+    'google_pay_token', 'address_line', 'unit_number_or_company', 'city', 'state', 'zip_code', 'canceled_by_merchant'
+)
+# (订单级的列, 订单级对象), 整体替换
+last_join_order = [(None, None)]
+
+
+def join_row_to_order_line(row):
+    """把 joinOrderLinesSql 的一行还原成 OrderLine, 与 order_lines 共用同一套列映射"""
+    key = join_order_key(row)
+    cached_key, order_fields = last_join_order[0]
+    if order_fields is None or cached_key != key:
+        order_fields = join_row_order_fields(row)
+        last_join_order[0] = (key, order_fields)
+
+    return OrderLine(
+        order_item=OrderItem(
+            id=row['order_item_id'],
+            menu_item_name=row['menu_item_name'],
+            order_quantity=row['order_quantity'],
+            restaurant_id=row['restaurant_id']
+        ),
+        order_charge_item=OrderChargeItem(
+            order_item_id=row['order_item_id'],
+            subtotal=row['subtotal'],
+            adjust_subtotal=row['adjust_subtotal'],
+            discount=row['discount'],
+            promotion=row['promotion'],
+            membership_subtotal=row['membership_subtotal'],
+            subscription_save_discount=row['subscription_save_discount']
+        ),
+        **order_fields
+    )
+
+
+def join_row_order_fields(row):
+    """
+    OrderLine 中订单级的字段
+    支付只保留导出用到的字段: 信用卡 id/卡号, Apple Pay / Google Pay 的 stripe token
+    """
+    order = Order(
+        id=row['id'],
+        user_id=row['user_id'],
+        order_channel=row['order_channel'],
+        dining_option=row['dining_option'],
+        created_time=row['created_time'],
+        status=row['status'],
+        remake_ref_order_id=row['remake_ref_order_id']
+    )
+    customer = Customer(
+        user_id=row['user_id'],
+        email=row['email'],
+        phone=row['phone'],
+        first_name=row['first_name'],
+        last_name=row['last_name'],
+        created_time=row['customer_created_time']
+    )
+
+    order_payments = []
+    stripe_payment_intents = []
+    if row['credit_card_payment_id'] is not None:
+        order_payments.append(OrderPayment(
+            id=row['credit_card_payment_id'],
+            payment_method='CREDIT_CARD',
+            credit_card_id=row['credit_card_id'],
+            account_number=row['credit_card_account_number']
+        ))
+    for method, payment_id, token in (
+            ('APPLE_PAY', row['apple_pay_id'], row['apple_pay_token']),
+            ('GOOGLE_PAY', row['google_pay_id'], row['google_pay_token'])):
+        if payment_id is not None:
+            order_payments.append(OrderPayment(id=payment_id, payment_method=method))
+            if token is not None:
+                stripe_payment_intents.append(StripePaymentIntent(payment_id=payment_id, stripe_payment_method_id=token))
+
+    order_address = None
+    if row['address_line'] is not None:
+        order_address = OrderAddress(
+            address_line=row['address_line'],
+            unit_number_or_company=row['unit_number_or_company'],
+            city=row['city'],
+            state=row['state'],
+            zip_code=row['zip_code']
+        )
+
+    order_flags = []
+    if row['canceled_by_merchant']:
+        order_flags = [OrderFlag(order_id=order.id, action='BO_CANCEL', created_by='customer-service-site')]
+
+    return {
+        'order': order,
+        'customer': customer,
+        'order_charge': OrderCharge(final_amount=row['final_amount']),
+        'order_payments': order_payments,
+        'stripe_payment_intents': stripe_payment_intents,
+        'order_address': order_address,
+        'order_flags': order_flags,
+    }
+
+
+def join_row_to_row(row):
+    return order_line_to_row(join_row_to_order_line(row))
@@ -0,0 +1,104 @@
+# test_archive.py
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# 公共模块在上一级目录的 exportcommon 包中
+sys.path.append(os.path.dirname(here))
+
+from exportcommon.archive import ResultArchive, check_archive_path
+from exportcommon.writers import ShardedWriter
+
+
+class CheckArchivePathTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='archive_test_')
+        self.output_dir = os.path.join(self.work_dir, 'output')
+        os.makedirs(self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_rejects_path_under_output_dir(self):
+        for path in (os.path.join(self.output_dir, 'results.tar'),
+                     os.path.join(self.output_dir, 'archive', 'results.tar'),
+                     os.path.join(self.work_dir, 'archive', '..', 'output', 'results.tar')):
+            with self.subTest(path=path):
+                with self.assertRaisesRegex(ValueError, 'OUTPUT_DIR'):
+                    check_archive_path(path, self.output_dir)
+
+    def test_rejects_symlink_into_output_dir(self):
+        """通过软链接指向 OUTPUT_DIR 也不行"""
+        link = os.path.join(self.work_dir, 'archive')
+        os.symlink(self.output_dir, link)
+        with self.assertRaisesRegex(ValueError, 'OUTPUT_DIR'):
+            check_archive_path(os.path.join(link, 'results.tar'), self.output_dir)
+
+    def test_requires_path(self):
+        with self.assertRaisesRegex(ValueError, 'ARCHIVE_PATH'):
+            check_archive_path('', self.output_dir)
+
+    def test_accepts_separate_volume(self):
+        """与 OUTPUT_DIR 同名前缀的兄弟目录不算在 OUTPUT_DIR 下"""
+        for path in (os.path.join(self.work_dir, 'archive', 'results.tar'),
+                     os.path.join(self.work_dir, 'output-archive', 'results.tar')):
+            with self.subTest(path=path):
+                self.assertEqual(check_archive_path(path, self.output_dir), path)
+
+
+class ResultArchiveTest(unittest.TestCase):
+    """封口前只有 .partial; 封口后的 tar 依次是各天的分片、分片清单和 archive.json, 字节数 / sha256 与成员一致"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='archive_test_')
+        self.output_dir = os.path.join(self.work_dir, 'output')
+        os.makedirs(self.output_dir)
+        self.path = os.path.join(self.work_dir, 'archive', 'results.tar')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write_day(self, day, order_count):
+        base_path = os.path.join(self.output_dir, f"orders_{day}")
+        rows = [(f"order-{n:03d}", f"item-{k}") for n in range(order_count) for k in range(2)]
+        with ShardedWriter('csv', base_path, ['orderId', 'item'], key_index=0, max_rows=10) as writer:
+            writer.write_rows(rows)
+        return base_path
+
+    def test_sealed_contents(self):
+        archive = ResultArchive(self.path)
+        first = self.write_day('2025-08-11', 12)
+        second = self.write_day('2025-08-12', 3)
+        self.assertTrue(archive.add_shards(first))
+        self.assertTrue(archive.add_shards(second))
+        self.assertFalse(archive.add_shards(os.path.join(self.output_dir, 'orders_2025-08-13')))
+        archive.add_shards(first)
+        self.assertTrue(os.path.exists(f"{self.path}.partial"))
+        self.assertFalse(os.path.exists(self.path))
+
+        self.assertEqual(archive.seal({'succeeded': True, 'dead_letters': 0}), self.path)
+        self.assertFalse(os.path.exists(f"{self.path}.partial"))
+        expected = (['orders_2025-08-11_p1.csv', 'orders_2025-08-11_p2.csv', 'orders_2025-08-11_p3.csv',
+                     'orders_2025-08-11.manifest.json', 'orders_2025-08-12_p1.csv', 'orders_2025-08-12.manifest.json'])
+        with tarfile.open(self.path) as tar:
+            self.assertEqual(tar.getnames(), expected + ['archive.json'])
+            index = json.load(tar.extractfile('archive.json'))
+            contents = {name: tar.extractfile(name).read() for name in expected}
+        self.assertEqual(index['summary'], {'succeeded': True, 'dead_letters': 0})
+        self.assertEqual([member['file'] for member in index['members']], expected)
+        for member in index['members']:
+            with self.subTest(file=member['file']):
+                with open(os.path.join(self.output_dir, member['file']), 'rb') as f:
+                    self.assertEqual(contents[member['file']], f.read())
+                self.assertEqual(member['bytes'], len(contents[member['file']]))
+                self.assertEqual(member['sha256'], hashlib.sha256(contents[member['file']]).hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# test_autotune.py
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+here = os.path.dirname(os.path.abspath(__file__))
+# 公共模块在上一级目录的 exportcommon 包中
+sys.path.append(os.path.dirname(here))
+
+from exportcommon import autotune
+from exportcommon.autotune import calibrate, pick_knee, probe_concurrency
+
+
+def level(concurrency, qps, p95_ms):
+    return {'concurrency': concurrency, 'qps': qps, 'p50_ms': p95_ms / 2, 'p95_ms': p95_ms}
+
+
+class PickKneeTest(unittest.TestCase):
+    """翻倍后吞吐提升不足 15% 或 p95 超过单连接 3 倍时取前一级, 一直在涨就取最后一级"""
+
+    def test_throughput_flattens(self):
+        results = [level(1, 100, 10), level(2, 190, 10), level(4, 360, 11), level(8, 400, 20), level(16, 410, 40)]
+        self.assertEqual(pick_knee(results), 4)
+
+    def test_gain_threshold(self):
+        self.assertEqual(pick_knee([level(1, 100, 10), level(2, 115, 10)]), 2)
+        self.assertEqual(pick_knee([level(1, 100, 10), level(2, 114, 10)]), 1)
+
+    def test_latency_limit(self):
+        results = [level(1, 100, 10), level(2, 200, 20), level(4, 400, 31)]
+        self.assertEqual(pick_knee(results), 2)
+        self.assertEqual(pick_knee(results[:2] + [level(4, 400, 30)]), 4)
+
+    def test_still_scaling(self):
+        results = [level(c, 100 * c, 10) for c in (1, 2, 4, 8, 16, 32)]
+        self.assertEqual(pick_knee(results), 32)
+        self.assertEqual(pick_knee(results[:1]), 1)
+
+
+class ProbeConcurrencyTest(unittest.TestCase):
+    def test_stops_after_knee(self):
+        """过了拐点就不再加并发"""
+        curve = {1: level(1, 100, 10), 2: level(2, 190, 10), 4: level(4, 360, 11), 8: level(8, 380, 25),
+                 16: level(16, 390, 60), 32: level(32, 395, 120)}
+        probed = []
+
+        def probe_level(connect, run_query, concurrency, duration_seconds):
+            probed.append(concurrency)
+            return curve[concurrency]
+
+        with mock.patch.object(autotune, 'probe_level', probe_level):
+            concurrency, results = probe_concurrency(None, None, 0.1)
+        self.assertEqual(concurrency, 4)
+        self.assertEqual(probed, [1, 2, 4, 8])
+        self.assertEqual(results, [curve[c] for c in probed])
+
+    def test_probe_level(self):
+        """真实线程: 每条连接各自循环, 结束后全部关闭"""
+        closed = []
+
+        class Connection:
+            def close(self):
+                closed.append(self)
+
+        result = autotune.probe_level(Connection, lambda conn: None, 3, 0.05)
+        self.assertEqual(result['concurrency'], 3)
+        self.assertGreater(result['qps'], 0)
+        self.assertEqual(len(closed), 3)
+
+
+class CalibrateTest(unittest.TestCase):
+    """auto 复用同一主机、未过期的结果, 否则重新探测并保存; force 总是探测; off 或探测失败返回 None"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='autotune_test_')
+        self.path = os.path.join(self.work_dir, 'autotune.json')
+        self.probes = 0
+        patcher = mock.patch.object(autotune, 'probe_concurrency', self.probe_concurrency)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def probe_concurrency(self, connect, run_query, duration_seconds):
+        self.probes += 1
+        return 8, [level(1, 100, 10)]
+
+    def calibrate(self, mode, host='db-a', max_age_hours=24):
+        return calibrate(self.path, mode, host, max_age_hours, None, None, 0.1)
+
+    def save(self, host, age_hours, concurrency=4):
+        calibrated_at = datetime.now(timezone.utc) - timedelta(hours=age_hours)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({'host': host, 'calibrated_at': calibrated_at.isoformat(), 'concurrency': concurrency}, f)
+
+    def test_off(self):
+        self.save('db-a', 1)
+        self.assertIsNone(self.calibrate('off'))
+        self.assertEqual(self.probes, 0)
+
+    def test_auto_reuses_fresh_result(self):
+        self.save('db-a', 23)
+        self.assertEqual(self.calibrate('auto')['concurrency'], 4)
+        self.assertEqual(self.probes, 0)
+
+    def test_auto_probes_again(self):
+        for host, age_hours in (('db-a', 25), ('db-b', 1)):
+            with self.subTest(host=host, age_hours=age_hours):
+                self.save(host, age_hours)
+                calibration = self.calibrate('auto')
+                self.assertEqual(calibration['concurrency'], 8)
+                with open(self.path, encoding='utf-8') as f:
+                    self.assertEqual(json.load(f), calibration)
+        self.assertEqual(self.probes, 2)
+        self.assertEqual(os.listdir(self.work_dir), ['autotune.json'])
+
+    def test_force(self):
+        self.save('db-a', 0)
+        self.assertEqual(self.calibrate('force')['concurrency'], 8)
+        self.assertEqual(self.probes, 1)
+
+    def test_probe_failure(self):
+        def failing(connect, run_query, duration_seconds):
+            raise OSError('connection refused')
+
+        with mock.patch.object(autotune, 'probe_concurrency', failing):
+            self.assertIsNone(self.calibrate('auto'))
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
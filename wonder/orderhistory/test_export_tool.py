@@ -0,0 +1,416 @@
+# test_export_tool.py
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+from datetime import datetime, timezone
+from operator import itemgetter
+
+import zstandard
+
+here = os.path.dirname(os.path.abspath(__file__))
+if here not in sys.path:
+    sys.path.insert(0, here)
+# 公共模块在上一级目录的 exportcommon 包中
+sys.path.append(os.path.dirname(here))
+
+import benchmark_exporter
+from row_mapper import csv_columns, order_document
+
+export_date = '2025-08-11'
+order_id_index = csv_columns.index('orderId')
+
+
+def zstd_decompress(data):
+    """表头和各数据块是分开的 zstd 帧, 要读完所有帧"""
+    return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True).read()
+
+
+def load_tool(db_dir):
+    """子进程中执行: 换上 SQLite 适配层后导入导出工具, 只导出 export_date 一天"""
+    benchmark_exporter.install_adapter(db_dir)
+    import export_order_history_tool as tool
+    tool.export_start_date = tool.export_end_date = datetime.strptime(export_date, '%Y-%m-%d')
+    tool.replicas.create_pools(tool.db_config, tool.slice_workers)
+    return tool
+
+
+def export_days(db_dir, kill_after_pages=None):
+    """子进程中执行: export_with_threadpool; kill_after_pages 时加载完这么多页后直接结束进程, 模拟导出中途被杀"""
+    tool = load_tool(db_dir)
+    if kill_after_pages is not None:
+        hydrate_order_page = tool.hydrate_order_page
+        pages = itertools.count(1)
+
+        def killed(*args, **kwargs):
+            if next(pages) > kill_after_pages:
+                os._exit(9)
+            return hydrate_order_page(*args, **kwargs)
+
+        tool.hydrate_order_page = killed
+    sys.exit(0 if tool.export_with_threadpool() else 1)
+
+
+def export_with_fault(db_dir, order_id, errno, times=None):
+    """
+    子进程中执行: export_with_threadpool, 子表的 IN 查询中含有 order_id 时抛出 OperationalError(errno),
+    共 times 次, None 为一直失败
+    """
+    adapter = benchmark_exporter.install_adapter(db_dir)
+    execute = benchmark_exporter.SqliteCursor.execute
+    failures = itertools.count(1)
+
+    def failing_execute(cursor, sql, params=()):
+        if 'order_id IN' in sql and order_id in params and (times is None or next(failures) <= times):
+            raise adapter.errors.OperationalError(msg=f"injected error {errno}", errno=errno)
+        return execute(cursor, sql, params)
+
+    benchmark_exporter.SqliteCursor.execute = failing_execute
+    export_days(db_dir)
+
+
+def export_delta(db_dir):
+    """子进程中执行: 与 EXPORT_MODE=delta 启动相同"""
+    tool = load_tool(db_dir)
+    sys.exit(0 if tool.export_delta() else 1)
+
+
+def export_refund_delta(db_dir):
+    """子进程中执行: 退款导出的 EXPORT_MODE=delta; 退款工具有自己的 models, 换掉本目录已导入的同名模块"""
+    benchmark_exporter.install_adapter(db_dir)
+    sys.path.insert(0, os.path.join(os.path.dirname(here), 'refundhistory'))
+    sys.modules.pop('models', None)
+    import export_refund_history_tool as tool
+    tool.replicas.create_pools(tool.db_config, tool.day_workers)
+    sys.exit(0 if tool.export_delta() else 1)
+
+
+def run_job(db_dir):
+    """子进程中执行: RUN_MODE=job 的 main(), 退出码与导出结果一致"""
+    tool = load_tool(db_dir)
+    sys.exit(tool.main())
+
+
+def tune_workers(db_dir):
+    """子进程中执行: 校准并设置连接池和并发时间片数, 输出设置结果"""
+    tool = load_tool(db_dir)
+    tool.tune_workers()
+    print(json.dumps({'pool_size': tool.db_config['pool_size'], 'slice_workers': tool.slice_workers}))
+
+
+def redo_dead_letters(db_dir):
+    """子进程中执行: 与带 --redo-dead-letters 启动相同"""
+    tool = load_tool(db_dir)
+    sys.exit(0 if tool.redo_dead_letters() else 1)
+
+
+class ExportToolTest(unittest.TestCase):
+    """
+    在 benchmark_exporter 的 SQLite 造数上运行导出工具本身 (export_with_threadpool 等)
+    每次运行在子进程中: 适配层替换 mysql.connector, 导出工具在导入时读取环境变量
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp(prefix='order_export_tool_test_')
+        cls.db_dir = os.path.join(cls.work_dir, 'db')
+        os.makedirs(cls.db_dir)
+        benchmark_exporter.create_database(cls.db_dir, 600, datetime.strptime(export_date, '%Y-%m-%d'), 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def run_tool(self, function, output_dir, *args, db_dir=None, **env):
+        """在子进程中调用本模块的 function(db_dir, *args), 返回子进程结果"""
+        code = f"import test_export_tool; test_export_tool.{function}({db_dir or self.db_dir!r}, *{args!r})"
+        return subprocess.run(
+            [sys.executable, '-c', code], cwd=here,
+            env={**os.environ, 'OUTPUT_DIR': output_dir, 'METRICS_INTERVAL_SECONDS': '0', 'TRANSFORM_PROCESSES': '0',
+                 'PREFLIGHT': 'off', 'AUTOTUNE': 'off', 'RETRY_BASE_SECONDS': '0', **env},
+            capture_output=True, text=True, timeout=300)
+
+    def output_files(self, output_dir):
+        """导出结果: 数据文件和分片清单, 不含断点 / 指标 / 死信"""
+        files = {}
+        for filename in sorted(os.listdir(output_dir)):
+            if filename.startswith('orders_'):
+                with open(os.path.join(output_dir, filename), 'rb') as f:
+                    files[filename] = f.read()
+        return files
+
+    def export_rows(self, output_dir, prefix='orders_'):
+        """CSV 数据文件中的全部行 (不含表头); 增量导出的 keys 文件不算数据文件"""
+        rows = []
+        for filename in sorted(os.listdir(output_dir)):
+            if filename.startswith(prefix) and filename.endswith('.csv') and not filename.endswith('_keys.csv'):
+                with open(os.path.join(output_dir, filename), newline='', encoding='utf-8') as f:
+                    rows.extend(tuple(row) for row in itertools.islice(csv.reader(f), 1, None))
+        return rows
+
+    def dead_letters(self, output_dir):
+        path = os.path.join(output_dir, 'dead_letters.jsonl')
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding='utf-8') as f:
+            return {entry['order_id']: entry for entry in map(json.loads, f)}
+
+    def clean_export(self):
+        """无故障的一次导出, 返回 (输出目录, 数据文件)"""
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        result = self.run_tool('export_days', output_dir)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return output_dir, self.output_files(output_dir)
+
+    def test_resume_after_kill(self):
+        """导出中途进程被杀, 再次运行从断点继续, 结果与一次跑完逐字节相同"""
+        for env in ({}, {'SHARD_MAX_ROWS': '300'}):
+            with self.subTest(**env):
+                env = dict(env, SLICE_TARGET_ORDERS='150', CHECKPOINT_PAGES='1', SLICE_WORKERS='2')
+                clean_dir = tempfile.mkdtemp(dir=self.work_dir)
+                result = self.run_tool('export_days', clean_dir, **env)
+                self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+                expected = self.output_files(clean_dir)
+                self.assertTrue(expected)
+
+                resumed_dir = tempfile.mkdtemp(dir=self.work_dir)
+                killed = self.run_tool('export_days', resumed_dir, 3, **env)
+                self.assertEqual(killed.returncode, 9, killed.stdout + killed.stderr)
+                self.assertTrue(os.path.exists(os.path.join(resumed_dir, 'manifest.json')))
+                self.assertFalse(self.output_files(resumed_dir))
+
+                result = self.run_tool('export_days', resumed_dir, **env)
+                self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+                self.assertIn('之后继续', result.stdout)
+                self.assertEqual(self.output_files(resumed_dir), expected)
+                self.assertFalse(os.path.exists(os.path.join(resumed_dir, '.segments')))
+
+    def test_transient_error_retried(self):
+        """连接断开 / 锁等待超时几次后恢复: 重连重做整页, 输出与无故障时相同, 不产生额外的死信"""
+        clean_dir, expected = self.clean_export()
+        order_id = self.export_rows(clean_dir)[len(self.export_rows(clean_dir)) // 2][order_id_index]
+        for errno in (2013, 1205):
+            with self.subTest(errno=errno):
+                output_dir = tempfile.mkdtemp(dir=self.work_dir)
+                result = self.run_tool('export_with_fault', output_dir, order_id, errno, 2)
+                self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+                self.assertIn('暂时性错误', result.stdout)
+                self.assertEqual(self.output_files(output_dir), expected)
+                self.assertEqual(self.dead_letters(output_dir).keys(), self.dead_letters(clean_dir).keys())
+
+    def test_dead_letter_and_redo(self):
+        """
+        锁等待一直超时: 这一页的订单记入死信, 当天其余订单照常导出;
+        --redo-dead-letters 在故障消失后导出这些订单并移出死信, 仍然失败的 (造数中缺客户 / 缺费用的订单) 留在死信中
+        """
+        clean_dir, _ = self.clean_export()
+        clean_rows = self.export_rows(clean_dir)
+        rejected = self.dead_letters(clean_dir)
+        self.assertTrue(rejected)
+        order_id = clean_rows[len(clean_rows) // 2][order_id_index]
+
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        result = self.run_tool('export_with_fault', output_dir, order_id, 1205, None, RETRY_ATTEMPTS='3')
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        dead = self.dead_letters(output_dir)
+        self.assertIn(order_id, dead)
+        self.assertIn('1205', dead[order_id]['error'])
+        page_orders = set(dead) - set(rejected)
+        rows = self.export_rows(output_dir)
+        self.assertEqual(rows, [row for row in clean_rows if row[order_id_index] not in page_orders])
+
+        result = self.run_tool('redo_dead_letters', output_dir)
+        self.assertEqual(result.returncode, 1, result.stdout + result.stderr)
+        self.assertEqual(self.dead_letters(output_dir).keys(), rejected.keys())
+        redone = self.export_rows(output_dir, 'orders_redo_')
+        self.assertEqual(sorted(redone),
+                         sorted(row for row in clean_rows if row[order_id_index] in page_orders))
+
+    def test_connection_lost_fails_day(self):
+        """连接一直断开: 重试用尽后时间片失败, 不把整页记入死信, 当天不生成输出, 退出码非 0"""
+        clean_dir, _ = self.clean_export()
+        clean_rows = self.export_rows(clean_dir)
+        order_id = clean_rows[len(clean_rows) // 2][order_id_index]
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        result = self.run_tool('export_with_fault', output_dir, order_id, 2013, None, RETRY_ATTEMPTS='2')
+        self.assertEqual(result.returncode, 1, result.stdout + result.stderr)
+        self.assertIn('数据库连接不可用', result.stdout)
+        self.assertNotIn(order_id, self.dead_letters(output_dir))
+        self.assertFalse(self.output_files(output_dir))
+
+    def test_job_archive(self):
+        """RUN_MODE=job: 封口后的归档包含当天的全部数据文件和分片清单 (与输出目录逐字节相同)、指标快照和 archive.json"""
+        _, clean_files = self.clean_export()
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        archive_path = os.path.join(self.work_dir, 'archive', 'results.tar')
+        result = self.run_tool('run_job', output_dir, RUN_MODE='job', ARCHIVE_PATH=archive_path,
+                               SHARD_MAX_ROWS='300')
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertFalse(os.path.exists(f"{archive_path}.partial"))
+        with tarfile.open(archive_path) as tar:
+            names = tar.getnames()
+            contents = {name: tar.extractfile(name).read() for name in names}
+        index = json.loads(contents.pop('archive.json'))
+        self.assertEqual(names[-1], 'archive.json')
+        self.assertEqual(index['summary']['succeeded'], True)
+        self.assertEqual(index['summary']['start_date'], export_date)
+        self.assertEqual([member['file'] for member in index['members']], names[:-1])
+        archived = {name: data for name, data in contents.items() if name.startswith('orders_')}
+        self.assertEqual(archived, self.output_files(output_dir))
+        self.assertGreater(len(archived), 2)
+        self.assertEqual(self.export_rows(output_dir), [
+            tuple(row) for filename, data in sorted(clean_files.items()) if filename.endswith('.csv')
+            for row in itertools.islice(csv.reader(data.decode('utf-8').splitlines()), 1, None)])
+        self.assertIn('order_history_export.json', contents)
+
+        # ARCHIVE_PATH 在 OUTPUT_DIR 下时拒绝启动
+        result = self.run_tool('run_job', output_dir, RUN_MODE='job',
+                               ARCHIVE_PATH=os.path.join(output_dir, 'results.tar'))
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('ARCHIVE_PATH 不能在 OUTPUT_DIR', result.stderr)
+
+    def test_autotune_selection(self):
+        """沿用 OUTPUT_DIR/autotune.json 的拐点并发; stream 模式每片两条连接; 没有校准结果时不超过 pool_size"""
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        with open(os.path.join(output_dir, 'autotune.json'), 'w', encoding='utf-8') as f:
+            json.dump({'host': 'db-a', 'calibrated_at': datetime.now(timezone.utc).isoformat(), 'concurrency': 12}, f)
+        for env, expected in (({'AUTOTUNE': 'auto'}, {'pool_size': 12, 'slice_workers': 12}),
+                              ({'AUTOTUNE': 'auto', 'ORDER_SCAN_MODE': 'stream'}, {'pool_size': 12, 'slice_workers': 6}),
+                              ({'AUTOTUNE': 'off', 'SLICE_WORKERS': '20'}, {'pool_size': 16, 'slice_workers': 16}),
+                              ({'AUTOTUNE': 'off', 'SLICE_WORKERS': '5'}, {'pool_size': 5, 'slice_workers': 5})):
+            with self.subTest(**env):
+                result = self.run_tool('tune_workers', output_dir, DB_HOST='db-a', **env)
+                self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+                self.assertEqual(json.loads(result.stdout.splitlines()[-1]), expected)
+
+    def test_compressed_output(self):
+        """OUTPUT_COMPRESSION: 解压后的数据文件与不压缩时逐字节相同"""
+        _, clean_files = self.clean_export()
+        for compression, suffix, decompress in (('gzip', '.gz', gzip.decompress), ('zstd', '.zst', zstd_decompress)):
+            with self.subTest(compression=compression):
+                output_dir = tempfile.mkdtemp(dir=self.work_dir)
+                result = self.run_tool('export_days', output_dir, OUTPUT_COMPRESSION=compression)
+                self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+                files = self.output_files(output_dir)
+                data_files = {name: data for name, data in files.items() if not name.endswith('.manifest.json')}
+                self.assertTrue(data_files)
+                for name, data in data_files.items():
+                    self.assertTrue(name.endswith(suffix))
+                    self.assertEqual(decompress(data), clean_files[name[:-len(suffix)]])
+
+    def test_ndjson_output(self):
+        """OUTPUT_FORMAT=ndjson: 每个订单一行文档, 顺序与 CSV 相同, 内容与由 CSV 各行合成的文档相同"""
+        _, clean_files = self.clean_export()
+        rows = [tuple(row) for name, data in sorted(clean_files.items()) if name.endswith('.csv')
+                for row in itertools.islice(csv.reader(data.decode('utf-8').splitlines()), 1, None)]
+        orders = [list(group) for _, group in itertools.groupby(rows, key=itemgetter(order_id_index))]
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        result = self.run_tool('export_days', output_dir, OUTPUT_FORMAT='ndjson')
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        with open(os.path.join(output_dir, f"orders_{export_date}.ndjson"), encoding='utf-8') as f:
+            documents = [json.loads(line) for line in f]
+        self.assertEqual(len(documents), len(orders))
+        for document, order_rows in zip(documents, orders):
+            with self.subTest(order=document['orderId']):
+                self.assertEqual(document, order_document(order_rows))
+
+    def changed_database(self, statements):
+        """复制一份造数并执行 statements (order 库上的 SQL), 不影响其他用例共用的造数"""
+        db_dir = os.path.join(tempfile.mkdtemp(dir=self.work_dir), 'db')
+        shutil.copytree(self.db_dir, db_dir)
+        conn = sqlite3.connect(os.path.join(db_dir, 'order.db'))
+        try:
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.commit()
+        finally:
+            conn.close()
+        return db_dir
+
+    def watermark(self, output_dir):
+        with open(os.path.join(output_dir, 'watermark.json'), encoding='utf-8') as f:
+            return json.load(f)['updated_time']
+
+    def test_delta(self):
+        """
+        只有一个订单的明细在高水位之后有变更: keys 文件和明细行文件都只有这个订单, 明细行与按天导出的相同;
+        写完后高水位推进到本次上界; 之后没有变更的区间不生成文件, 区间为空时高水位不动
+        """
+        clean_dir, _ = self.clean_export()
+        clean_rows = self.export_rows(clean_dir)
+        order_id = clean_rows[len(clean_rows) // 2][order_id_index]
+        db_dir = self.changed_database([
+            ("UPDATE order_items SET updated_time = '2025-09-15 00:00:00' WHERE order_id = ?", (order_id,)),
+        ])
+        env = dict(DELTA_SINCE='2025-09-01T00:00:00', DELTA_LAG_SECONDS='0')
+
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        result = self.run_tool('export_delta', output_dir, db_dir=db_dir, **env)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        keys_files = [f for f in os.listdir(output_dir) if f.startswith('orders_delta_') and f.endswith('_keys.csv')]
+        self.assertEqual(len(keys_files), 1)
+        with open(os.path.join(output_dir, keys_files[0]), newline='', encoding='utf-8') as f:
+            self.assertEqual(list(csv.reader(f)), [['orderId'], [order_id]])
+        self.assertEqual(self.export_rows(output_dir, 'orders_delta_'), [row for row in clean_rows if row[order_id_index] == order_id])
+        first_watermark = self.watermark(output_dir)
+        self.assertGreater(first_watermark, '2025-09-15')
+
+        # 之后没有变更: 不生成文件, 高水位继续推进
+        for filename in os.listdir(output_dir):
+            if filename.startswith('orders_delta_'):
+                os.remove(os.path.join(output_dir, filename))
+        time.sleep(1.1)
+        result = self.run_tool('export_delta', output_dir, db_dir=db_dir, **env)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertIn('0 个变更订单', result.stdout)
+        self.assertFalse([f for f in os.listdir(output_dir) if f.startswith('orders_delta_')])
+        self.assertGreater(self.watermark(output_dir), first_watermark)
+
+        # 上界早于高水位: 区间为空, 什么都不做
+        second_watermark = self.watermark(output_dir)
+        result = self.run_tool('export_delta', output_dir, db_dir=db_dir, DELTA_LAG_SECONDS='3600')
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        self.assertIn('增量区间为空', result.stdout)
+        self.assertEqual(self.watermark(output_dir), second_watermark)
+
+    def test_refund_delta(self):
+        """退款增量: 只有问题单明细变更的订单写入 keys (orderId, eventId) 和退款行"""
+        conn = sqlite3.connect(os.path.join(self.db_dir, 'order.db'))
+        try:
+            issue_id, order_id = conn.execute("""
+                SELECT i.id, i.order_id FROM order_issues_v2 i JOIN orders o ON o.id = i.order_id
+                WHERE o.status = 'COMPLETE' AND o.order_channel IN ('BA_APP', 'BA_WEB')
+                ORDER BY i.id LIMIT 1
+            """).fetchone()
+        finally:
+            conn.close()
+        db_dir = self.changed_database([
+            ("UPDATE order_issue_items SET updated_time = '2025-09-15 00:00:00' WHERE order_issue_id = ?",
+             (issue_id,)),
+        ])
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        result = self.run_tool('export_refund_delta', output_dir, db_dir=db_dir, DELTA_SINCE='2025-09-01T00:00:00',
+                               DELTA_LAG_SECONDS='0')
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        files = sorted(os.listdir(output_dir))
+        keys_file = next(f for f in files if f.startswith('refunds-delta-') and f.endswith('_keys.csv'))
+        with open(os.path.join(output_dir, keys_file), newline='', encoding='utf-8') as f:
+            self.assertEqual(list(csv.reader(f)), [['orderId', 'eventId'], [order_id, issue_id]])
+        refund_rows = self.export_rows(output_dir, 'refunds-delta-')
+        self.assertTrue(refund_rows)
+        self.assertEqual({(row[0], row[2]) for row in refund_rows}, {(order_id, issue_id)})
+        self.assertIn('updated_time', open(os.path.join(output_dir, 'watermark.json'), encoding='utf-8').read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# test_replicas.py
+import os
+import sys
+import unittest
+from unittest import mock
+
+here = os.path.dirname(os.path.abspath(__file__))
+# 公共模块在上一级目录的 exportcommon 包中
+sys.path.append(os.path.dirname(here))
+
+from exportcommon import replicas
+from exportcommon.replicas import ReplicaRouter, min_latency_samples, parse_hosts
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ReplicaRouterTest(unittest.TestCase):
+    """按 (在途单元数 + 1) * 延迟选副本; 延迟超过其他副本最低延迟 eject_factor 倍时摘除, 到期后清空延迟重新试用"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(replicas.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = ReplicaRouter(['db-a', 'db-b:3307', 'db-c'], 'order_pool', eject_factor=3.0, eject_seconds=60)
+        self.a, self.b, self.c = self.router.replicas
+
+    def observe(self, replica, seconds, times=min_latency_samples):
+        for _ in range(times):
+            self.router.observe(replica, seconds)
+
+    def test_hosts_and_pools(self):
+        self.assertEqual(parse_hosts(' db-a, db-b:3307 ,', 'db'), ['db-a', 'db-b:3307'])
+        self.assertEqual(parse_hosts('', 'db'), ['db'])
+        self.assertEqual((self.b.address, self.b.port, self.b.pool_name), ('db-b', 3307, 'order_pool_1'))
+        self.assertEqual(ReplicaRouter(['db'], 'order_pool').replicas[0].pool_name, 'order_pool')
+
+    def test_pick_by_load(self):
+        self.observe(self.a, 0.010)
+        self.observe(self.b, 0.015)
+        self.observe(self.c, 0.025)
+        # a: 0.010, 0.020, 0.030 ...; b: 0.015, 0.030 ...; c: 0.025 ...
+        picked = [self.router.acquire() for _ in range(5)]
+        self.assertEqual(picked, [self.a, self.b, self.a, self.c, self.b])
+        self.router.release(self.a)
+        self.assertEqual(self.a.inflight, 1)
+        self.assertEqual(self.a.units, 2)
+
+    def test_ejection_factor(self):
+        self.observe(self.a, 0.010)
+        self.observe(self.b, 0.012)
+        # 刚好 3 倍不摘除, 超过才摘除
+        self.observe(self.c, 0.030)
+        self.assertFalse(self.c.ejected_until)
+        self.observe(self.c, 0.031, times=30)
+        self.assertEqual(self.c.ejected_until, self.clock.now + 60)
+        self.assertNotIn(self.c, [self.router.acquire() for _ in range(6)])
+
+    def test_too_few_samples(self):
+        """采样不足 min_latency_samples 的副本既不会被摘除, 也不作为比较基准"""
+        self.observe(self.a, 0.010, times=min_latency_samples - 1)
+        self.observe(self.b, 1.0)
+        self.assertFalse(self.b.ejected_until)
+        self.observe(self.c, 1.0, times=min_latency_samples - 1)
+        self.assertFalse(self.c.ejected_until)
+
+    def test_ejection_expires(self):
+        self.router.eject(self.c, '建连失败')
+        self.observe(self.c, 1.0)
+        self.assertEqual(self.c.samples, min_latency_samples)
+        self.clock.now += 59
+        self.assertTrue(self.c.ejected_until)
+        self.router.acquire()
+        self.assertTrue(self.c.ejected_until)
+        self.clock.now += 1
+        self.router.acquire()
+        self.assertEqual((self.c.ejected_until, self.c.latency, self.c.samples), (0.0, None, 0))
+        # 清空延迟后负载按 0 计, 马上重新试用
+        self.assertIs(self.router.acquire(), self.c)
+
+    def test_last_replica_kept(self):
+        self.router.eject(self.a, 'x')
+        self.router.eject(self.b, 'x')
+        self.router.eject(self.c, 'x')
+        self.assertFalse(self.c.ejected_until)
+        self.assertIs(self.router.acquire(), self.c)
+
+    def test_capacity(self):
+        """每个副本最多 capacity 个在途单元; 被摘除的副本不算容量"""
+        self.router.capacity = 1
+        self.router.eject(self.c, 'x')
+        self.assertEqual({self.router.acquire(), self.router.acquire()}, {self.a, self.b})
+        self.assertIsNone(self.router._pick())
+        self.router.release(self.b)
+        self.assertIs(self.router.acquire(), self.b)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# test_retry.py
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mysql.connector import errorcode, errors
+
+here = os.path.dirname(os.path.abspath(__file__))
+# 公共模块在上一级目录的 exportcommon 包中
+sys.path.append(os.path.dirname(here))
+
+from exportcommon.dead_letters import DeadLetterLog
+from exportcommon.retry import RetryPolicy, is_connection_error, is_transient, reconnect
+
+
+class FakeConnection:
+    """前 failures 次 query() 抛出 error, 之后返回结果; 记录重连次数"""
+
+    def __init__(self, error, failures):
+        self.error = error
+        self.failures = failures
+        self.calls = 0
+        self.reconnects = 0
+
+    def query(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return ['row']
+
+    def reconnect(self, attempts=1, delay=0):
+        self.reconnects += 1
+
+
+class RetryPolicyTest(unittest.TestCase):
+    """暂时性 MySQL 错误重连后重试, 其他错误直接抛出; 重试用尽抛出最后一次的错误"""
+
+    policy = RetryPolicy(4, 0, 0)
+
+    def call(self, conn):
+        return self.policy.call(conn.query, '测试查询', reset=lambda: reconnect(conn))
+
+    def test_transient_errors_retried(self):
+        for error in (errors.OperationalError(msg='Lost connection', errno=errorcode.CR_SERVER_LOST),
+                      errors.DatabaseError(msg='Lock wait timeout', errno=errorcode.ER_LOCK_WAIT_TIMEOUT),
+                      errors.DatabaseError(msg='Deadlock', errno=errorcode.ER_LOCK_DEADLOCK),
+                      errors.PoolError(msg='pool exhausted')):
+            with self.subTest(error=error):
+                conn = FakeConnection(error, 3)
+                self.assertEqual(self.call(conn), ['row'])
+                self.assertEqual(conn.calls, 4)
+                self.assertEqual(conn.reconnects, 3)
+
+    def test_attempts_exhausted(self):
+        error = errors.DatabaseError(msg='Lock wait timeout', errno=errorcode.ER_LOCK_WAIT_TIMEOUT)
+        conn = FakeConnection(error, 10)
+        with self.assertRaises(errors.DatabaseError) as raised:
+            self.call(conn)
+        self.assertIs(raised.exception, error)
+        self.assertEqual(conn.calls, 4)
+
+    def test_other_errors_not_retried(self):
+        for error in (errors.ProgrammingError(msg='syntax error', errno=errorcode.ER_PARSE_ERROR),
+                      ValueError('bad row')):
+            with self.subTest(error=error):
+                conn = FakeConnection(error, 1)
+                with self.assertRaises(type(error)):
+                    self.call(conn)
+                self.assertEqual(conn.calls, 1)
+                self.assertEqual(conn.reconnects, 0)
+
+    def test_connection_errors(self):
+        """连接级错误重试用尽时时间片失败; 锁等待 / 死锁只让这一页 / 这一单记入死信"""
+        self.assertTrue(is_connection_error(errors.OperationalError(errno=errorcode.CR_SERVER_GONE_ERROR)))
+        self.assertTrue(is_connection_error(errors.PoolError(msg='pool exhausted')))
+        lock_wait = errors.DatabaseError(errno=errorcode.ER_LOCK_WAIT_TIMEOUT)
+        self.assertTrue(is_transient(lock_wait))
+        self.assertFalse(is_connection_error(lock_wait))
+
+
+class DeadLetterLogTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='dead_letters_test_')
+        self.path = os.path.join(self.work_dir, 'dead_letters.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_entries_keep_latest(self):
+        log = DeadLetterLog(self.path)
+        log.record('2025-08-11', 'o1', errors.DatabaseError(errno=errorcode.ER_LOCK_WAIT_TIMEOUT))
+        log.record('2025-08-11', 'o2', ValueError('missing customer'))
+        log.record('2025-08-12', 'o1', ValueError('missing charge'))
+        entries = {entry['order_id']: entry for entry in DeadLetterLog(self.path).entries()}
+        self.assertEqual(set(entries), {'o1', 'o2'})
+        self.assertEqual(entries['o1']['day'], '2025-08-12')
+        self.assertIn('missing charge', entries['o1']['error'])
+
+    def test_keep_recorded(self):
+        """重做死信: 只保留本次仍然失败的订单, 全部成功时删除文件"""
+        DeadLetterLog(self.path).record('2025-08-11', 'o1', ValueError('x'))
+        redo = DeadLetterLog(self.path)
+        redo.record('2025-08-11', 'o2', ValueError('y'))
+        redo.keep_recorded()
+        self.assertEqual([entry['order_id'] for entry in DeadLetterLog(self.path).entries()], ['o2'])
+        DeadLetterLog(self.path).keep_recorded()
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
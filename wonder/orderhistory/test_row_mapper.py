@@ -0,0 +1,131 @@
+# test_row_mapper.py
+import importlib.util
+import os
+import sys
+import unittest
+from datetime import datetime
+from decimal import Decimal
+
+here = os.path.dirname(os.path.abspath(__file__))
+if here not in sys.path:
+    sys.path.insert(0, here)
+
+from benchmark_row_mapper import baseline_order_line_to_row, sample_order_lines
+import models
+import row_mapper
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# 旧订单导出的 models / row_mapper 与本目录的同名, 按文件路径加载成另外的模块名
+legacy_dir = os.path.join(os.path.dirname(here), 'legacyorderv2')
+legacy_models = load_module('legacy_models', os.path.join(legacy_dir, 'models.py'))
+legacy_row_mapper = load_module('legacy_row_mapper', os.path.join(legacy_dir, 'row_mapper.py'))
+
+
+def edge_case_lines(m, **order_fields):
+    """
+    各种 NULL / 缺失: 没有客户 / 地址 / 订单费用 / 支付的订单, 明细和明细费用为 None 或字段为 NULL,
+    同一方式的多笔支付和多条 stripe token, 多明细订单的各行共用订单级对象 (与 order_lines 相同)
+    """
+    def order(order_id, created_time, status, channel='BA_APP'):
+        return m.Order(id=order_id, user_id=f"user-{order_id}", order_channel=channel, dining_option='DELIVERY',
+                       created_time=created_time, status=status, **order_fields)
+
+    def charge_item(item_id, subtotal=Decimal('12.99')):
+        return m.OrderChargeItem(item_id, subtotal, Decimal(0), Decimal(0), Decimal(0), Decimal(0), Decimal(0))
+
+    lines = []
+
+    # 三个明细的完整订单, 第二行数量为 NULL 且没有明细费用, 第三行菜名和小计为 NULL
+    full = order('full', datetime(2025, 8, 11, 12, 30), 'COMPLETE')
+    shared = dict(
+        order=full,
+        customer=m.Customer('user-full', 'full@example.com', '5550100', 'First', 'Last, Jr', datetime(2020, 1, 1)),
+        order_flags=[],
+        order_charge=m.OrderCharge(Decimal('51.96')),
+        order_payments=[m.OrderPayment('p1', 'CREDIT_CARD', 'card-1', '4242', 'visa')],
+        stripe_payment_intents=[],
+        order_address=m.OrderAddress('1 Main St', 'Apt 2', 'New York', 'NY', '10001'),
+    )
+    lines.append(m.OrderLine(order_item=m.OrderItem('i1', 'Meal kit', 2, 'r1'),
+                             order_charge_item=charge_item('i1'), **shared))
+    lines.append(m.OrderLine(order_item=m.OrderItem('i2', 'Wine', None, 'r1'), order_charge_item=None, **shared))
+    lines.append(m.OrderLine(order_item=m.OrderItem('i3', None, 1, 'r1'),
+                             order_charge_item=charge_item('i3', None), **shared))
+
+    # 客户 / 地址 / 订单费用 / 支付都缺失, 下单时间为 NULL, 状态和渠道不在映射表中
+    lines.append(m.OrderLine(
+        order=order('bare', None, 'IN_PROGRESS', channel='BA_LEGACY'),
+        customer=None, order_flags=None, order_item=None, order_charge_item=None, order_charge=None,
+        order_payments=None, stripe_payment_intents=None, order_address=None))
+
+    # 客户电话 / 注册时间为 NULL, 地址字段为 NULL, 订单金额为 NULL, 数量为 0;
+    # 同一方式的多笔支付取第一笔, Google Pay 没有 stripe token, Apple Pay 有两条 token; 客服取消
+    canceled = order('canceled', datetime(2025, 8, 11, 23, 59, 59), 'CANCELED', channel='BA_WEB')
+    shared = dict(
+        order=canceled,
+        customer=m.Customer('user-canceled', 'c@example.com', None, 'First', 'Last', None),
+        order_flags=[m.OrderFlag('canceled', 'BO_CANCEL', 'customer-app'),
+                     m.OrderFlag('canceled', 'BO_CANCEL', 'customer-service-site')],
+        order_charge=m.OrderCharge(None),
+        order_payments=[m.OrderPayment('p2', 'CREDIT_CARD', 'card-2', '1111'),
+                        m.OrderPayment('p3', 'CREDIT_CARD', 'card-3', '2222'),
+                        m.OrderPayment('p4', 'GOOGLE_PAY'),
+                        m.OrderPayment('p5', 'APPLE_PAY')],
+        stripe_payment_intents=[m.StripePaymentIntent('p5', 'pm_first'), m.StripePaymentIntent('p5', 'pm_second')],
+        order_address=m.OrderAddress('2 Main St', None, None, None, None),
+    )
+    lines.append(m.OrderLine(order_item=m.OrderItem('i4', 'Meal kit', 0, 'r2'),
+                             order_charge_item=charge_item('i4'), **shared))
+    lines.append(m.OrderLine(order_item=m.OrderItem('i5', 'Meal kit', 3, 'r2'),
+                             order_charge_item=charge_item('i5', Decimal('0.00')), **shared))
+
+    # 顾客自己取消
+    lines.append(m.OrderLine(
+        order=order('self-canceled', datetime(2025, 8, 12, 4, 0), 'CANCELED'),
+        customer=None, order_flags=[m.OrderFlag('self-canceled', 'BO_CANCEL', 'customer-app')],
+        order_item=m.OrderItem('i6', 'Meal kit', 1, 'r3'), order_charge_item=charge_item('i6'),
+        order_charge=m.OrderCharge(Decimal('9.99')), order_payments=[m.OrderPayment('p6', 'GOOGLE_PAY')],
+        stripe_payment_intents=[m.StripePaymentIntent('p6', 'pm_google')], order_address=None))
+    return lines
+
+
+class RowMapperTest(unittest.TestCase):
+    """编译后的行映射与旧的 safe_get 实现逐行相同, 订单导出和旧订单导出各自验证"""
+
+    def assert_same_rows(self, mapper, lines, checkout_time_path):
+        for line in lines:
+            with self.subTest(order=line.order.id, item=line.order_item and line.order_item.id):
+                self.assertEqual(list(mapper(line)), baseline_order_line_to_row(line, checkout_time_path))
+
+    def test_order_history_sample(self):
+        self.assert_same_rows(row_mapper.order_line_to_row, sample_order_lines(400, 3), 'order.created_time')
+
+    def test_order_history_null_fields(self):
+        self.assert_same_rows(row_mapper.order_line_to_row, edge_case_lines(models), 'order.created_time')
+
+    def test_legacy_null_fields(self):
+        """旧订单的 checkoutTime 取 order_date, 与 created_time 不同时也要对上"""
+        lines = edge_case_lines(legacy_models, order_date=datetime(2025, 8, 10))
+        lines.append(legacy_models.OrderLine(**dict(vars(lines[0]), order=legacy_models.Order(
+            id='no-date', user_id='u', order_channel='BA_APP', dining_option='PICKUP', order_date=None,
+            created_time=datetime(2025, 8, 11), status='COMPLETE'))))
+        self.assert_same_rows(legacy_row_mapper.order_line_to_row, lines, 'order.order_date')
+        checkout_time = legacy_row_mapper.csv_columns.index('checkoutTime')
+        self.assertEqual(legacy_row_mapper.order_line_to_row(lines[0])[checkout_time],
+                         str(int(datetime(2025, 8, 10).timestamp())))
+        self.assertEqual(legacy_row_mapper.order_line_to_row(lines[-1])[checkout_time], "")
+
+    def test_columns_match(self):
+        self.assertEqual(legacy_row_mapper.csv_columns, row_mapper.csv_columns)
+
+
+if __name__ == '__main__':
+    unittest.main()
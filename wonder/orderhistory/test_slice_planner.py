@@ -0,0 +1,95 @@
+# test_slice_planner.py
+import os
+import sys
+import unittest
+from datetime import date, datetime, timedelta
+
+import pytz
+
+here = os.path.dirname(os.path.abspath(__file__))
+# 公共模块在上一级目录的 exportcommon 包中
+sys.path.append(os.path.dirname(here))
+
+from exportcommon.slice_planner import day_range_utc, plan_day_slices, plan_export_slices
+
+
+def utc(*args):
+    return pytz.UTC.localize(datetime(*args))
+
+
+class DayRangeTest(unittest.TestCase):
+    """纽约时间一天对应的 UTC 区间: 夏令时开始的一天 23 小时, 结束的一天 25 小时, 相邻两天首尾相接"""
+
+    def test_dst_edges(self):
+        for day, start, end in ((date(2025, 3, 9), utc(2025, 3, 9, 5), utc(2025, 3, 10, 4)),
+                                (date(2025, 11, 2), utc(2025, 11, 2, 4), utc(2025, 11, 3, 5)),
+                                (date(2025, 8, 11), utc(2025, 8, 11, 4), utc(2025, 8, 12, 4)),
+                                (date(2025, 1, 15), utc(2025, 1, 15, 5), utc(2025, 1, 16, 5))):
+            with self.subTest(day=day):
+                self.assertEqual(day_range_utc(day), (start, end))
+
+    def test_consecutive_days(self):
+        day = date(2025, 3, 1)
+        while day < date(2025, 12, 1):
+            with self.subTest(day=day):
+                self.assertEqual(day_range_utc(day)[1], day_range_utc(day + timedelta(days=1))[0])
+            day += timedelta(days=1)
+
+
+class PlanDaySlicesTest(unittest.TestCase):
+    """时间片首尾相接、正好覆盖一天 (夏令时切换日也是), 订单数不丢; 超过目标的小时按秒等分"""
+
+    def check_cover(self, slices, start_utc, end_utc):
+        self.assertEqual(slices[0].start_utc, start_utc)
+        self.assertEqual(slices[-1].end_utc, end_utc)
+        for earlier, later in zip(slices, slices[1:]):
+            self.assertEqual(earlier.end_utc, later.start_utc)
+        for export_slice in slices:
+            self.assertLess(export_slice.start_utc, export_slice.end_utc)
+            self.assertEqual(export_slice.start_utc.microsecond, 0)
+
+    def test_dst_days(self):
+        for day, hours in ((date(2025, 3, 9), 23), (date(2025, 11, 2), 25)):
+            with self.subTest(day=day):
+                start_utc, end_utc = day_range_utc(day)
+                counts = {start_utc + timedelta(hours=h): 10 + h for h in range(hours)}
+                slices = plan_day_slices(day, start_utc, end_utc, counts, 50)
+                self.check_cover(slices, start_utc, end_utc)
+                self.assertEqual(sum(s.order_count for s in slices), sum(counts.values()))
+                # 只合并整小时, 最后一片之外都达到目标
+                self.assertTrue(all(s.order_count >= 50 for s in slices[:-1]))
+                self.assertTrue(all((s.start_utc - start_utc) % timedelta(hours=1) == timedelta(0) for s in slices))
+
+    def test_heavy_hours_split(self):
+        """夏令时结束日重复的 1 点 (UTC 5 点 / 6 点) 各自单独计数和切分"""
+        day = date(2025, 11, 2)
+        start_utc, end_utc = day_range_utc(day)
+        counts = {utc(2025, 11, 2, 5): 700, utc(2025, 11, 2, 6): 250, utc(2025, 11, 2, 10): 30}
+        slices = plan_day_slices(day, start_utc, end_utc, counts, 100)
+        self.check_cover(slices, start_utc, end_utc)
+        first_hour = [s for s in slices if utc(2025, 11, 2, 5) <= s.start_utc < utc(2025, 11, 2, 6)]
+        second_hour = [s for s in slices if utc(2025, 11, 2, 6) <= s.start_utc < utc(2025, 11, 2, 7)]
+        self.assertEqual(len(first_hour), 7)
+        self.assertEqual(len(second_hour), 3)
+        self.assertEqual([s.order_count for s in first_hour], [100] * 7)
+        # 3600 秒分 3 份正好整除; 分 7 份时前 6 份各 514 秒, 余下的归最后一份
+        self.assertEqual({s.end_utc - s.start_utc for s in second_hour}, {timedelta(seconds=1200)})
+        self.assertEqual([(s.end_utc - s.start_utc).total_seconds() for s in first_hour], [514] * 6 + [516])
+        # 超大小时之前累计的部分单独成片
+        self.assertEqual(slices[0].end_utc, utc(2025, 11, 2, 5))
+
+    def test_empty_day(self):
+        start_utc, end_utc = day_range_utc(date(2025, 3, 9))
+        slices = plan_day_slices(date(2025, 3, 9), start_utc, end_utc, {}, 100)
+        self.assertEqual([(s.start_utc, s.end_utc, s.order_count) for s in slices], [(start_utc, end_utc, 0)])
+
+    def test_no_target_one_slice_per_day(self):
+        """target_orders <= 0 时不查询, 每天一个时间片"""
+        days = [date(2025, 11, 1), date(2025, 11, 2), date(2025, 11, 3)]
+        slices = plan_export_slices(None, None, days, 0)
+        self.assertEqual([(s.day, s.start_utc, s.end_utc) for s in slices],
+                         [(day, *day_range_utc(day)) for day in days])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+# test_writers.py
+import csv
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+# 公共模块在上一级目录的 exportcommon 包中
+sys.path.append(os.path.dirname(here))
+
+from exportcommon.transform_pool import map_rows
+from exportcommon.writers import ShardedWriter
+
+columns = ['orderId', 'item', 'amount']
+
+
+def sample_rows(order_count, seed=7):
+    """每单 1 ~ 4 行, 行宽固定; orderId 按写入顺序递增"""
+    rows = []
+    for n in range(order_count):
+        for k in range((n * seed) % 4 + 1):
+            rows.append((f"order-{n:05d}", f"item-{k}", f"{(n * 31 + k) % 1000:04d}.00"))
+    return rows
+
+
+def read_csv(path, compression=''):
+    opener = gzip.open if compression == 'gzip' else open
+    with opener(path, 'rt', newline='', encoding='utf-8') as f:
+        return list(csv.reader(f))
+
+
+def sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ShardedWriterTest(unittest.TestCase):
+    """按行数 / 字节数滚动分片: 分片数、不拆开订单、分片清单的行数 / 首末 orderId / 字节数 / sha256 与磁盘上的文件一致"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='sharded_writer_test_')
+        self.base_path = os.path.join(self.work_dir, 'orders_2025-08-11')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write(self, rows, batch_orders=9, encoded=False, compression='', **limits):
+        """与导出时的页一样按整单分批写入"""
+        orders = [list(group) for _, group in itertools.groupby(rows, key=lambda row: row[0])]
+        with ShardedWriter('csv', self.base_path, columns, compression=compression, key_index=0,
+                           **limits) as writer:
+            for i in range(0, len(orders), batch_orders):
+                batch = [row for order in orders[i:i + batch_orders] for row in order]
+                if encoded:
+                    mapped = map_rows(tuple, batch, True, 0)
+                    writer.write_encoded(mapped.chunk, mapped.row_count, mapped.first_key, mapped.last_key,
+                                         mapped.order_offsets)
+                else:
+                    writer.write_rows(batch)
+        self.assertEqual(writer.row_count, len(rows))
+        with open(f"{self.base_path}.manifest.json", encoding='utf-8') as f:
+            return json.load(f)
+
+    def check_manifest(self, manifest, rows, compression=''):
+        """分片清单与磁盘上的文件一致, 依次拼起来就是写入的全部行, 同一订单只出现在一个分片中"""
+        written = []
+        shard_orders = []
+        for number, shard in enumerate(manifest['shards'], 1):
+            path = os.path.join(self.work_dir, shard['file'])
+            self.assertEqual(shard['file'], f"orders_2025-08-11_p{number}.csv{'.gz' if compression else ''}")
+            self.assertEqual(shard['bytes'], os.path.getsize(path))
+            self.assertEqual(shard['sha256'], sha256(path))
+            header, *shard_rows = read_csv(path, compression)
+            self.assertEqual(header, columns)
+            self.assertEqual(shard['rows'], len(shard_rows))
+            self.assertEqual(shard['first_order_id'], shard_rows[0][0])
+            self.assertEqual(shard['last_order_id'], shard_rows[-1][0])
+            written.extend(tuple(row) for row in shard_rows)
+            shard_orders.append({row[0] for row in shard_rows})
+        self.assertEqual(written, rows)
+        self.assertEqual(manifest['rows'], len(rows))
+        self.assertEqual(manifest['bytes'], sum(shard['bytes'] for shard in manifest['shards']))
+        for earlier, later in zip(shard_orders, shard_orders[1:]):
+            self.assertFalse(earlier & later)
+
+    def expected_row_shards(self, rows, max_rows):
+        """按订单贪心装箱的分片数"""
+        shards = 0
+        shard_rows = max_rows
+        for n in dict.fromkeys(row[0] for row in rows):
+            order_rows = sum(1 for row in rows if row[0] == n)
+            if shard_rows + order_rows > max_rows:
+                shards += 1
+                shard_rows = 0
+            shard_rows += order_rows
+        return shards
+
+    def test_max_rows(self):
+        rows = sample_rows(60)
+        manifest = self.write(rows, max_rows=10)
+        self.check_manifest(manifest, rows)
+        self.assertEqual(len(manifest['shards']), self.expected_row_shards(rows, 10))
+        self.assertTrue(all(shard['rows'] <= 10 for shard in manifest['shards']))
+
+    def test_max_rows_encoded(self):
+        """转换进程编码好的 CSV 文本按 order_offsets 在订单边界切开, 分片与逐行写入相同"""
+        rows = sample_rows(60)
+        manifest = self.write(rows, encoded=True, max_rows=10)
+        self.check_manifest(manifest, rows)
+        self.assertEqual(len(manifest['shards']), self.expected_row_shards(rows, 10))
+
+    def test_order_larger_than_max_rows(self):
+        """单个订单超过 max_rows 时独占一个分片, 不拆开"""
+        rows = sample_rows(3) + [('order-big', f"item-{k}", '1.00') for k in range(7)] + sample_rows(2)
+        manifest = self.write(rows, batch_orders=2, max_rows=5)
+        self.check_manifest(manifest, rows)
+        self.assertIn(7, [shard['rows'] for shard in manifest['shards']])
+
+    def test_max_bytes(self):
+        """行宽固定时分片不超过 max_bytes (含表头)"""
+        rows = sample_rows(80)
+        for encoded in (False, True):
+            with self.subTest(encoded=encoded):
+                manifest = self.write(rows, encoded=encoded, max_bytes=1000)
+                self.check_manifest(manifest, rows)
+                self.assertGreater(len(manifest['shards']), 1)
+                self.assertTrue(all(shard['bytes'] <= 1000 for shard in manifest['shards']))
+
+    def test_max_bytes_gzip(self):
+        """压缩输出按压缩后的字节数滚动, 还没落盘的部分不会让分片过早滚动"""
+        rng = random.Random(1)
+        rows = [(f"order-{n:05d}", f"item-{n % 3}", f"{rng.getrandbits(192):048x}") for n in range(600)]
+        manifest = self.write(rows, compression='gzip', max_bytes=8000)
+        self.check_manifest(manifest, rows, 'gzip')
+        sizes = [shard['bytes'] for shard in manifest['shards']]
+        self.assertGreater(len(sizes), 2)
+        self.assertGreater(min(sizes[:-1]), 8000 * 0.8)
+        self.assertLess(max(sizes), 8000 * 1.1)
+
+    def test_no_limits(self):
+        """不设阈值时不滚动, 输出文件与普通 writer 相同 (不带 _p{n})"""
+        rows = sample_rows(20)
+        with ShardedWriter('csv', self.base_path, columns, key_index=0) as writer:
+            writer.write_rows(rows)
+        self.assertEqual(writer.filepath, f"{self.base_path}.csv")
+        self.assertEqual([tuple(row) for row in read_csv(writer.filepath)[1:]], rows)
+
+    def test_abort_removes_shards(self):
+        rows = sample_rows(30)
+        with self.assertRaises(RuntimeError):
+            with ShardedWriter('csv', self.base_path, columns, key_index=0, max_rows=10) as writer:
+                writer.write_rows(rows)
+                raise RuntimeError('导出失败')
+        self.assertEqual(os.listdir(self.work_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
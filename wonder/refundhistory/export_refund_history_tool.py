@@ -4,14 +4,26 @@ import logging
 import sys
 import time as totalTime
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime, time, timedelta
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from typing import List, Dict, Any
 
 import mysql.connector
-import pandas as pd
 import pytz
 
+# 公共模块在上一级目录的 exportcommon 包中 (镜像里与工具同在 /app 下, 不需要这一步)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exportcommon.archive import ResultArchive, check_archive_path
+from exportcommon.checkpoint import load_watermark, save_watermark
+from exportcommon.dead_letters import DeadLetterLog
+from exportcommon.metrics import StageMetrics
+from exportcommon.preflight import preflight_query, run_preflight
+from exportcommon.replicas import ReplicaRouter, parse_hosts
+from exportcommon.retry import RetryPolicy, is_connection_error, reconnect
+from exportcommon.slice_planner import day_range_utc
+from exportcommon.writers import ShardedWriter, open_writer
+
 from models import Order, OrderIssue, OrderIssueItem, OrderItem, OrderChargeItem
 
 logging.basicConfig(
@@ -26,66 +38,354 @@ db_config = {
     'user': os.getenv('DB_USER'),
     'password': os.getenv('DB_PASSWORD'),
     'pool_name': 'custom_connection_pool',
-    'pool_size': 10
+    # stream 模式下每个日期线程占用两条连接
+    'pool_size': 16
 }
 
+# 逗号分隔的只读副本 (host 或 host:port), 每个副本一个连接池, 日期按负载分到各副本; 为空时只用 DB_HOST
+# 副本的分页查询延迟超过其他副本最低延迟的 REPLICA_EJECT_FACTOR 倍时, 摘除 REPLICA_EJECT_SECONDS 秒
+replicas = ReplicaRouter(parse_hosts(os.getenv('DB_HOSTS', ''), db_config['host']), db_config['pool_name'],
+                         float(os.getenv('REPLICA_EJECT_FACTOR', '3')), float(os.getenv('REPLICA_EJECT_SECONDS', '60')))
+# 每个副本同时导出的日期数
+day_workers = 7
+
 output_dir = os.getenv('OUTPUT_DIR', '/app/export_refund_history')
 
+# service: 导出完成后 sleep, 等待 kubectl exec tar / kubectl cp 取走结果
+# job: 每完成一天就把当天的分片和分片清单追加进 ARCHIVE_PATH (tar), 结束后封口并退出, 全部成功时退出码为 0, 否则为 1
+run_mode = os.getenv('RUN_MODE', 'service')
+# ARCHIVE_PATH 必须在单独挂载的持久卷上 (不能在 OUTPUT_DIR 下), 例如 /app/archive/refund_history_results.tar
+archive_path = os.getenv('ARCHIVE_PATH', '')
+# job 模式的结果归档, main() 中创建
+result_archive = None
+
+# csv | parquet
+output_format = os.getenv('OUTPUT_FORMAT', 'csv')
+# 空 | gzip | zstd, 写文件时直接压缩
+output_compression = os.getenv('OUTPUT_COMPRESSION', '')
+# 每天的输出按行数 / 字节数滚动成 refunds-<日期>_p{n} 分片, 并写 refunds-<日期>.manifest.json
+# (每个分片的行数 / 字节数 / 首末 orderId / sha256); 都为 0 时每天一个文件
+shard_max_rows = int(os.getenv('SHARD_MAX_ROWS', '0'))
+shard_max_bytes = int(os.getenv('SHARD_MAX_BYTES', '0'))
+
+# keyset: 按 (created_time, id) 续读分页; offset: LIMIT/OFFSET 分页
+# stream: 一条无缓冲查询扫描整天, 按 page_size 分批取行
+order_scan_mode = os.getenv('ORDER_SCAN_MODE', 'keyset')
+page_size = 100
+
+# 各阶段耗时 (订单分页查询 / 子表查询 / 对象构造 / 行映射 / 写文件) 按阶段和日期汇总
+# 每 METRICS_INTERVAL_SECONDS 秒写一次 OUTPUT_DIR/refund_history_export.prom (Prometheus textfile) 和 .json, 0 表示只在结束时写
+metrics = StageMetrics('refund_history_export')
+metrics_interval_seconds = int(os.getenv('METRICS_INTERVAL_SECONDS', '30'))
+
+# backfill: 按 created_time 导出固定日期范围
+# delta: 只导出上次高水位之后问题单 / 问题单明细有变更的订单, 输出按 eventId 覆盖的增量文件
+export_mode = os.getenv('EXPORT_MODE', 'backfill')
+# 第一次增量导出的起点 (UTC, ISO 格式), 之后从 OUTPUT_DIR/watermark.json 继续
+delta_since = os.getenv('DELTA_SINCE', '')
+# 增量上界比当前时间早一段, 避免漏掉还没提交的事务
+delta_lag_seconds = int(os.getenv('DELTA_LAG_SECONDS', '300'))
+
+# 开始导出前在每个副本上 EXPLAIN 将要执行的查询, 报告用到的索引和估计行数
+# warn: 有全表扫描 / filesort 时只记录警告; strict: 拒绝开始导出; off: 跳过
+preflight_mode = os.getenv('PREFLIGHT', 'warn')
+
+# 暂时性 MySQL 错误 (连接断开 / 锁等待超时 / 死锁 / 连接池耗尽) 只重试出错的那一步: 取连接 / 一次订单分页查询 / 一个订单的子表查询,
+# 各自最多尝试 RETRY_ATTEMPTS 次, 间隔从 RETRY_BASE_SECONDS 秒起指数增长, 不超过 RETRY_MAX_SECONDS 秒
+retry_policy = RetryPolicy(int(os.getenv('RETRY_ATTEMPTS', '5')), float(os.getenv('RETRY_BASE_SECONDS', '0.5')),
+                           float(os.getenv('RETRY_MAX_SECONDS', '30')))
+# 重试后仍然失败的订单记入 OUTPUT_DIR/dead_letters.jsonl, 当天其余订单照常导出
+# 带 --redo-dead-letters 启动时只重新导出死信中的订单
+dead_letters = DeadLetterLog(os.path.join(output_dir, 'dead_letters.jsonl'))
+redo_dead_letters_mode = '--redo-dead-letters' in sys.argv[1:]
+
+search_order_sql = """
+    SELECT id, user_id, order_channel, dining_option, created_time, status, remake_ref_order_id
+    FROM `order`.orders
+    WHERE created_time >= %s AND created_time < %s
+    AND brand_category = 'BLUE_APRON'
+    AND order_channel IN ('BA_APP', 'BA_WEB')
+    AND status in ('CANCELED', 'COMPLETE')
+"""
+
+# 按 (created_time, id) 续读的分页查询: 第一页 / 之后各页; offset 模式用 LIMIT / OFFSET
+first_order_page_sql = search_order_sql + """
+    ORDER BY created_time, id
+    LIMIT %s
+"""
+
+next_order_page_sql = search_order_sql + """
+    AND (created_time > %s OR (created_time = %s AND id > %s))
+    ORDER BY created_time, id
+    LIMIT %s
+"""
+
+offset_order_page_sql = search_order_sql + """
+    LIMIT %s OFFSET %s
+"""
+
+# 重做死信时按 id 查订单, {placeholders} 为 IN 列表
+orders_by_id_sql = """
+    SELECT id, user_id, order_channel, dining_option, created_time, status, remake_ref_order_id
+    FROM `order`.orders
+    WHERE id IN ({placeholders})
+    AND brand_category = 'BLUE_APRON'
+    AND order_channel IN ('BA_APP', 'BA_WEB')
+    AND status in ('CANCELED', 'COMPLETE')
+    ORDER BY created_time, id
+"""
+
+# 增量模式: 问题单 / 问题单明细按 updated_time 找出变更, 都换算成问题单所属的订单
+changed_issue_order_ids_sql = """
+    SELECT DISTINCT order_id
+    FROM order.order_issues_v2
+    WHERE updated_time >= %s AND updated_time < %s
+"""
+
+changed_issue_item_order_ids_sql = """
+    SELECT DISTINCT i.order_id
+    FROM order.order_issue_items ii
+    JOIN order.order_issues_v2 i ON i.id = ii.order_issue_id
+    WHERE ii.updated_time >= %s AND ii.updated_time < %s
+"""
+
+# 不限制状态: 变更后不再是 CANCELED / COMPLETE 的订单, 其问题单也要写进 keys 文件, 让下游删掉旧行
+delta_orders_sql = """
+    SELECT id, user_id, order_channel, dining_option, created_time, status, remake_ref_order_id
+    FROM `order`.orders
+    WHERE id IN ({placeholders})
+    AND brand_category = 'BLUE_APRON'
+    AND order_channel IN ('BA_APP', 'BA_WEB')
+"""
+
+# 不限制问题类型: 类型变更后不再导出的问题单同样要删掉旧行
+order_issue_ids_in_sql = """
+    SELECT id, order_id
+    FROM order.order_issues_v2
+    WHERE order_id IN ({placeholders})
+"""
+
+# 子表查询, 按订单 / 问题单逐个执行; *_in_sql 的 {placeholders} 为 IN 列表
+order_issues_sql = """
+    SELECT id, order_id, issue_type, created_time, discount, refund, additional_credit, concession_total
+    FROM order.order_issues_v2
+    WHERE order_id = %s AND issue_type IN ('COMPLAINTS', 'REMAKE')
+"""
+
+order_issue_items_sql = """
+    SELECT id, order_issue_id, issue_order_id, issue_order_item_id, issue_category, issue_quantity, reason_number, issue_source
+    FROM order.order_issue_items
+    WHERE order_issue_id = %s AND issue_category IN ('ORDER_ISSUE', 'ITEM_ISSUE') AND issue_source IN ('CUSTOMER', 'SOCIAL')
+"""
+
+order_items_sql = """
+    SELECT id, menu_item_name, order_quantity, restaurant_id
+    FROM order.order_items
+    WHERE order_id = %s AND NOT deleted
+"""
+
+order_items_in_sql = """
+    SELECT id, menu_item_name, order_quantity, restaurant_id
+    FROM order.order_items
+    WHERE order_id IN ({placeholders}) AND NOT deleted
+"""
+
+order_charge_items_sql = """
+    SELECT order_item_id, subtotal, adjust_subtotal, discount, promotion, membership_subtotal, subscription_save_discount
+    FROM order.order_charge_items
+    WHERE order_id = %s
+"""
+
+order_charge_items_in_sql = """
+    SELECT order_item_id, subtotal, adjust_subtotal, discount, promotion, membership_subtotal, subscription_save_discount
+    FROM order.order_charge_items
+    WHERE order_id IN ({placeholders})
+"""
+
+refund_columns = [
+    "orderId", "eventTime", "eventId",
+    "compensationStatus.itemStatus[].basicItemData.productId",
+    "compensationStatus.itemStatus[].basicItemData.name",
+    "compensationStatus.itemStatus[].basicItemData.quantity",
+    "compensationStatus.itemStatus[].basicItemData.category",
+    "compensationStatus.itemStatus[].basicItemData.type",
+    "compensationStatus.itemStatus[].basicItemData.price.amountUSD",
+    "compensationStatus.itemStatus[].basicItemData.price.amountLocalCurrency",
+    "compensationStatus.itemStatus[].basicItemData.price.currency",
+    "compensationStatus.itemStatus[].statusData.updatedStatus",
+    "compensationStatus.itemStatus[].statusData.compensationTypeGranted",
+    "compensationStatus.itemStatus[].statusData.reasonCategory",
+    "compensationStatus.itemStatus[].statusData.internalReasonCategory",
+    "compensationStatus.itemStatus[].statusData.returnMethodGranted",
+    "compensationStatus.itemStatus[].statusData.returnCondition",
+    "compensationStatus.itemStatus[].statusData.statusLog.shippedByCustomerTime",
+    "compensationStatus.itemStatus[].statusData.statusLog.arrivedToWarehouseTime",
+    "compensationStatus.totalGrantedAmount.amountUSD",
+    "compensationStatus.totalGrantedAmount.amountLocalCurrency",
+    "compensationStatus.totalGrantedAmount.currency",
+    "compensationStatus.replacementOrderId",
+    "compensationStatus.shippingRefundedAmount.amountUSD",
+    "compensationStatus.shippingRefundedAmount.amountLocalCurrency",
+    "compensationStatus.shippingRefundedAmount.currency",
+    "compensationStatus.hasProofOfPurchase"
+]
+
+# Parquet 输出的列类型, 其余列为字符串
+refund_parquet_column_types = {
+    "eventTime": 'int',
+    "compensationStatus.itemStatus[].basicItemData.quantity": 'int',
+    "compensationStatus.itemStatus[].basicItemData.type": 'dictionary',
+    "compensationStatus.itemStatus[].basicItemData.price.amountUSD": 'decimal',
+    "compensationStatus.itemStatus[].statusData.updatedStatus": 'dictionary',
+    "compensationStatus.itemStatus[].statusData.compensationTypeGranted": 'dictionary',
+    "compensationStatus.itemStatus[].statusData.reasonCategory": 'dictionary',
+    "compensationStatus.itemStatus[].statusData.internalReasonCategory": 'dictionary',
+    "compensationStatus.itemStatus[].statusData.returnMethodGranted": 'dictionary',
+    "compensationStatus.totalGrantedAmount.amountUSD": 'decimal',
+}
+
 
 def export_single_day(current_date: datetime):
     logging.info(f"开始处理日期: {current_date.strftime('%Y-%m-%d')}")
     conn = None
+    hydrate_conn = None
+    with replicas.lease() as replica:
+        try:
+            conn = connect_with_retry(replica, current_date.strftime('%Y-%m-%d'))
+            if order_scan_mode == 'stream':
+                # 扫描连接被无缓冲查询占用, 子表在第二条连接上加载
+                hydrate_conn = connect_with_retry(replica, current_date.strftime('%Y-%m-%d'))
+            return process_single_day(current_date, conn, hydrate_conn)
+        except mysql.connector.Error as err:
+            logging.info(f"{current_date.strftime('%Y-%m-%d')} - 数据库连接失败: {err}")
+            return False
+        finally:
+            if hydrate_conn:
+                hydrate_conn.close()
+            if conn:
+                conn.close()
+
+
+def connect_with_retry(replica, label):
+    """从副本的连接池取连接, 连接池耗尽 / 连不上时退避重试"""
+    return retry_policy.call(lambda: replicas.connect(replica), f"{label} - 取连接")
+
+
+def process_single_day(current_date: datetime, conn, hydrate_conn=None):
+    hydrate_conn = hydrate_conn or conn
+    start_of_day_utc, end_of_day_utc = day_range_utc(current_date)
+
+    day = current_date.strftime('%Y-%m-%d')
+    base_path = os.path.join(output_dir, f"refunds-{day}")
+
+    # 每页的退款行直接写入文件
+    with ShardedWriter(output_format, base_path, refund_columns, refund_parquet_column_types, output_compression,
+                       refund_columns.index('orderId'), shard_max_rows, shard_max_bytes) as writer:
+        pages = replicas.timed(conn, metrics.timed(iter_order_pages(conn, start_of_day_utc, end_of_day_utc),
+                                                   'order_page_query', day))
+        for rows in pages:
+            write_order_refunds(writer, rows, hydrate_conn, day)
+
+    if writer.row_count:
+        logging.info(f"退款数据已写入: {os.path.basename(writer.filepath)}")
+        if result_archive is not None:
+            result_archive.add_shards(base_path)
+    else:
+        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 无数据")
+
+    return True
+
+
+def write_order_refunds(writer, rows, conn, day):
+    with metrics.timer('build_orders', day):
+        orders = [Order(**row) for row in rows]
+    for order in orders:
+        lines = order_refund_lines(order, conn, day)
+        with metrics.timer('row_mapping', day):
+            mapped = [refund_line_to_row(line) for line in lines]
+        with metrics.timer('file_write', day):
+            writer.write_rows(mapped)
+
+
+def order_refund_lines(order: Order, conn, day) -> List[Dict[str, Any]]:
+    """
+    单个订单的退款行; 暂时性错误时重连后重做这个订单的全部子表查询
+    锁等待 / 死锁重试用尽或订单本身有问题时记入死信, 返回空列表, 当天继续处理其余订单;
+    连接级错误重试用尽说明数据库不可用, 照常抛出, 当天失败
+    """
+    def load():
+        with conn.cursor(dictionary=True) as cursor:
+            return refund_lines_for_order(order, cursor, day)
+
     try:
-        conn = mysql.connector.connect(pool_name='custom_connection_pool')
-        return process_single_day(current_date, conn)
-    except mysql.connector.Error as err:
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 数据库连接失败: {err}")
-        return False
-    finally:
-        if conn:
-            conn.close()
+        return retry_policy.call(load, f"{day} - 订单 {order.id}", reset=lambda: reconnect(conn))
+    except Exception as e:
+        if is_connection_error(e):
+            logging.info(f"{day} - 订单 {order.id} 重试用尽, 数据库连接不可用, 当天失败: {e}")
+            raise
+        dead_letters.record(day, order.id, e)
+        logging.info(f"{day} - 处理订单错误, 已记入死信: {order.id} {e!r}")
+        return []
 
 
-def process_single_day(current_date: datetime, conn):
-    timezone = pytz.timezone('America/New_York')
-    start_of_day_ny = timezone.localize(datetime.combine(current_date, time.min))
-    end_of_day_ny = timezone.localize(datetime.combine(current_date, time.max))
-    start_of_day_utc = start_of_day_ny.astimezone(pytz.UTC)
-    end_of_day_utc = end_of_day_ny.astimezone(pytz.UTC)
+def iter_order_pages(conn, start_time_utc: datetime, end_time_utc: datetime):
+    """
+    按页返回时间范围内的订单行
+    keyset 模式按 (created_time, id) 排序并从上一页最后一条续读, 避免 OFFSET 重复扫描已读行
+    """
+    if order_scan_mode == 'stream':
+        yield from stream_order_pages(conn, start_time_utc, end_time_utc)
+        return
 
+    last_key = None
     skip = 0
-    refund_lines = []
+    label = f"订单分页查询 [{start_time_utc.strftime('%m-%d %H:%M:%S')}, {end_time_utc.strftime('%m-%d %H:%M:%S')}]"
 
-    while True:
+    def fetch_page():
         with conn.cursor(dictionary=True) as cursor:
-            sql = """
-                SELECT id, user_id, order_channel, dining_option, created_time, status, remake_ref_order_id
-                FROM `order`.orders
-                WHERE created_time >= %s AND created_time <= %s
-                AND brand_category = 'BLUE_APRON'
-                AND order_channel IN ('BA_APP', 'BA_WEB')
-                AND status in ('CANCELED', 'COMPLETE')
-                LIMIT 100 OFFSET %s
-            """
-            cursor.execute(sql, (start_of_day_utc, end_of_day_utc, skip))
-            rows = cursor.fetchall()
+            if order_scan_mode == 'offset':
+                cursor.execute(offset_order_page_sql, (start_time_utc, end_time_utc, page_size, skip))
+            elif last_key is None:
+                cursor.execute(first_order_page_sql, (start_time_utc, end_time_utc, page_size))
+            else:
+                last_created_time, last_id = last_key
+                cursor.execute(next_order_page_sql, (start_time_utc, end_time_utc, last_created_time, last_created_time,
+                                                     last_id, page_size))
+            return cursor.fetchall()
 
-            if not rows:
-                break
+    while True:
+        # 每页是一条独立的查询, 断线后重连重查这一页即可, 已经读过的页不受影响
+        rows = retry_policy.call(fetch_page, label, reset=lambda: reconnect(conn))
 
-            orders = [Order(**row) for row in rows]
-            for order in orders:
-                lines = refund_lines_for_order(order, cursor)
-                refund_lines.extend(lines)
+        if not rows:
+            return
 
-            skip += 100
+        yield rows
 
-    if refund_lines:
-        write_refund_csv(refund_lines, current_date)
-    else:
-        logging.info(f"{current_date.strftime('%Y-%m-%d')} - 无数据")
+        if len(rows) < page_size:
+            return
+        last_key = (rows[-1]['created_time'], rows[-1]['id'])
+        skip += page_size
 
-    return True
+
+def stream_order_pages(conn, start_time_utc: datetime, end_time_utc: datetime):
+    """
+    无缓冲 (服务端) 游标扫描整个时间范围, 行从 MySQL 边读边返回, 不会重复执行分页查询
+    扫描期间该连接不能执行其他查询, 子表加载需使用另一条连接
+    """
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(search_order_sql, (start_time_utc, end_time_utc))
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        try:
+            cursor.close()
+        except mysql.connector.Error as err:
+            logging.info(f"关闭订单扫描游标失败: {err}")
 
 
 def order_refund_history_for_forter(start_date: datetime, end_date: datetime):
@@ -97,9 +397,11 @@ def order_refund_history_for_forter(start_date: datetime, end_date: datetime):
         dates_to_process.append(current_date)
         current_date += timedelta(days=1)
 
-    max_workers = min(7, len(dates_to_process))
+    max_workers = min(day_workers * len(replicas.replicas), len(dates_to_process))
     successful_days = 0
     failed_days = 0
+    if metrics_interval_seconds > 0:
+        metrics.start_periodic_write(output_dir, metrics_interval_seconds)
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_date = {
@@ -125,21 +427,161 @@ def order_refund_history_for_forter(start_date: datetime, end_date: datetime):
     logging.info(f"成功: {successful_days} 天")
     logging.info(f"失败: {failed_days} 天")
     logging.info(f"总耗时: {end - start: .2f} 秒")
+    log_dead_letters()
+    logging.info(f"阶段耗时: {metrics.snapshot()['stages']}")
+    replicas.log_summary()
+    metrics.stop(output_dir)
+    return failed_days == 0
+
+
+def log_dead_letters():
+    if dead_letters.recorded:
+        logging.info(f"死信订单: {len(dead_letters.recorded)} 个, 见 {dead_letters.path}, 可用 --redo-dead-letters 重新导出")
+
+
+def redo_dead_letters():
+    """
+    --redo-dead-letters: 只重新导出 dead_letters.jsonl 中的订单, 写入 refunds-redo-<时间>, 由下游按 orderId 覆盖
+    已不在导出范围内的订单直接移出死信; 这次仍然失败的订单留在死信文件中
+    """
+    start = totalTime.time()
+    entries = dead_letters.entries()
+    if not entries:
+        logging.info(f"没有死信订单: {dead_letters.path}")
+        return True
+
+    order_ids = sorted({entry['order_id'] for entry in entries})
+    now = datetime.now(pytz.UTC).replace(microsecond=0)
+    day = now.strftime('%Y-%m-%d')
+    base_path = os.path.join(output_dir, f"refunds-redo-{now.strftime('%Y%m%dT%H%M%S')}")
+    conn = retry_policy.call(replicas.connect, "重做死信 - 取连接")
+    try:
+        rows = retry_policy.call(lambda: get_orders_by_ids(order_ids, conn), "重做死信 - 查询订单",
+                                 reset=lambda: reconnect(conn))
+        logging.info(f"重做死信: {len(order_ids)} 个订单, 其中 {len(rows)} 个仍需导出")
+        with ShardedWriter(output_format, base_path, refund_columns, refund_parquet_column_types, output_compression,
+                           refund_columns.index('orderId'), shard_max_rows, shard_max_bytes) as writer:
+            for i in range(0, len(rows), page_size):
+                write_order_refunds(writer, rows[i:i + page_size], conn, day)
+    finally:
+        conn.close()
+
+    dead_letters.keep_recorded()
+    if result_archive is not None:
+        result_archive.add_shards(base_path)
+    end = totalTime.time()
+    logging.info(f"重做死信完成: {writer.row_count} 条记录, 耗时: {end - start: .2f} 秒")
+    log_dead_letters()
+    metrics.stop(output_dir)
+    return not dead_letters.recorded
 
 
-def refund_lines_for_order(order: Order, cursor) -> List[Dict[str, Any]]:
+def export_delta():
+    """
+    增量导出 [上次高水位, 现在 - DELTA_LAG_SECONDS) 内问题单 / 问题单明细有变更的订单:
+    refunds-delta-<区间>_keys 列出这些订单全部问题单的 (orderId, eventId), refunds-delta-<区间> 是这些订单当前的全部退款行
+    下游按 eventId 删除旧行再插入退款行; 两个文件都写完后才推进高水位
+    """
+    start = totalTime.time()
+    watermark_path = os.path.join(output_dir, 'watermark.json')
+    since = load_watermark(watermark_path)
+    if since is None:
+        if not delta_since:
+            raise ValueError("第一次增量导出需要设置 DELTA_SINCE")
+        since = datetime.fromisoformat(delta_since).replace(tzinfo=timezone.utc)
+    until = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(seconds=delta_lag_seconds)
+    if until <= since:
+        logging.info(f"增量区间为空: {since.isoformat()} 之后还没有可导出的变更")
+        return True
+
+    tag = f"{since.strftime('%Y%m%dT%H%M%S')}_{until.strftime('%Y%m%dT%H%M%S')}"
+    day = until.strftime('%Y-%m-%d')
+    base_path = os.path.join(output_dir, f"refunds-delta-{tag}")
+    conn = retry_policy.call(replicas.connect, "增量导出 - 取连接")
+    try:
+        order_ids = retry_policy.call(lambda: changed_order_ids(conn, since, until), "增量导出 - 查询变更订单",
+                                      reset=lambda: reconnect(conn))
+        orders = retry_policy.call(lambda: get_orders_by_ids(order_ids, conn, delta_orders_sql),
+                                   "增量导出 - 查询订单", reset=lambda: reconnect(conn))
+        issue_keys = retry_policy.call(lambda: order_issue_keys(orders, conn), "增量导出 - 查询问题单",
+                                       reset=lambda: reconnect(conn))
+        exported = [row for row in orders if row['status'] in ('CANCELED', 'COMPLETE')]
+        logging.info(f"增量 {since.isoformat()} ~ {until.isoformat()}: {len(order_ids)} 个变更订单, "
+                     f"其中 {len(orders)} 个属于导出范围, {len(exported)} 个需要导出退款行")
+
+        with open_writer(output_format, base_path + '_keys', ['orderId', 'eventId'], None,
+                         output_compression) as keys_writer, \
+                ShardedWriter(output_format, base_path, refund_columns, refund_parquet_column_types,
+                              output_compression, refund_columns.index('orderId'), shard_max_rows,
+                              shard_max_bytes) as writer:
+            keys_writer.write_rows(issue_keys)
+            for i in range(0, len(exported), page_size):
+                write_order_refunds(writer, exported[i:i + page_size], conn, day)
+    finally:
+        conn.close()
+
+    if result_archive is not None:
+        if keys_writer.filepath:
+            result_archive.add(keys_writer.filepath)
+        result_archive.add_shards(base_path)
+    save_watermark(watermark_path, until)
+    end = totalTime.time()
+    logging.info(f"增量导出完成: {keys_writer.row_count} 个问题单, {writer.row_count} 条记录, 耗时: {end - start: .2f} 秒")
+    log_dead_letters()
+    metrics.stop(output_dir)
+    return True
+
+
+def changed_order_ids(conn, since, until) -> List[str]:
+    order_ids = set()
+    with conn.cursor(dictionary=True) as cursor:
+        for sql in (changed_issue_order_ids_sql, changed_issue_item_order_ids_sql):
+            cursor.execute(sql, (since, until))
+            order_ids.update(row['order_id'] for row in cursor.fetchall())
+    return sorted(order_ids)
+
+
+def order_issue_keys(orders: List[Dict[str, Any]], conn, batch_size=1000) -> List[tuple]:
+    """订单全部问题单的 (orderId, eventId), orderId 与退款行一样取 remake 的原始订单, 按订单顺序排列"""
+    issue_ids = {}
+    with conn.cursor(dictionary=True) as cursor:
+        for i in range(0, len(orders), batch_size):
+            batch = [row['id'] for row in orders[i:i + batch_size]]
+            cursor.execute(order_issue_ids_in_sql.format(placeholders=','.join(['%s'] * len(batch))), tuple(batch))
+            for row in cursor.fetchall():
+                issue_ids.setdefault(row['order_id'], []).append(row['id'])
+    return [(row['remake_ref_order_id'] or row['id'], issue_id)
+            for row in orders for issue_id in sorted(issue_ids.get(row['id'], []))]
+
+
+def get_orders_by_ids(order_ids: List[str], conn, sql=orders_by_id_sql, batch_size=1000) -> List[Dict[str, Any]]:
+    rows = []
+    with conn.cursor(dictionary=True) as cursor:
+        for i in range(0, len(order_ids), batch_size):
+            batch = order_ids[i:i + batch_size]
+            cursor.execute(sql.format(placeholders=','.join(['%s'] * len(batch))), tuple(batch))
+            rows.extend(cursor.fetchall())
+    rows.sort(key=lambda row: (row['created_time'], row['id']))
+    return rows
+
+
+def refund_lines_for_order(order: Order, cursor, day) -> List[Dict[str, Any]]:
     root_order_id = order.remake_ref_order_id or order.id
-    order_issues = get_order_issues(order.id, cursor)
+    with metrics.timer('query_order_issues', day):
+        order_issues = get_order_issues(order.id, cursor)
     refund_lines = []
     for issue in order_issues:
-        issue_items = get_order_issue_items(issue.id, cursor)
+        with metrics.timer('query_order_issue_items', day):
+            issue_items = get_order_issue_items(issue.id, cursor)
 
         if not issue_items:
             continue
 
         if issue_items[0].issue_category == 'ORDER_ISSUE':
-            order_items = get_order_items(root_order_id, cursor)
-            order_charge_items = get_order_charge_items(root_order_id, cursor)
+            with metrics.timer('query_order_items', day):
+                order_items = get_order_items(root_order_id, cursor)
+            with metrics.timer('query_order_charge_items', day):
+                order_charge_items = get_order_charge_items(root_order_id, cursor)
 
             for item in order_items:
                 charge_item = next((ci for ci in order_charge_items if ci.order_item_id == item.id), None)
@@ -150,8 +592,10 @@ def refund_lines_for_order(order: Order, cursor) -> List[Dict[str, Any]]:
                     refund_lines.append(refund_line)
         else:
             issue_order_ids = list(set([item.issue_order_id for item in issue_items]))
-            order_items = get_order_items_by_ids(issue_order_ids, cursor)
-            order_charge_items = get_order_charge_items_by_ids(issue_order_ids, cursor)
+            with metrics.timer('query_order_items', day):
+                order_items = get_order_items_by_ids(issue_order_ids, cursor)
+            with metrics.timer('query_order_charge_items', day):
+                order_charge_items = get_order_charge_items_by_ids(issue_order_ids, cursor)
 
             for issue_item in issue_items:
                 if issue_item.issue_order_item_id:
@@ -169,37 +613,19 @@ def refund_lines_for_order(order: Order, cursor) -> List[Dict[str, Any]]:
 
 
 def get_order_issues(order_id: str, cursor) -> List[OrderIssue]:
-    sql = """
-    SELECT id, order_id, issue_type, created_time, discount, refund, additional_credit, concession_total
-    FROM order.order_issues_v2
-    WHERE order_id = %s AND issue_type IN ('COMPLAINTS', 'REMAKE')
-    """
-
-    cursor.execute(sql, (order_id,))
+    cursor.execute(order_issues_sql, (order_id,))
     rows = cursor.fetchall()
     return [OrderIssue(**row) for row in rows]
 
 
 def get_order_issue_items(order_issue_id: str, cursor) -> List[OrderIssueItem]:
-    sql = """
-    SELECT id, order_issue_id, issue_order_id, issue_order_item_id, issue_category, issue_quantity, reason_number, issue_source
-    FROM order.order_issue_items
-    WHERE order_issue_id = %s AND issue_category IN ('ORDER_ISSUE', 'ITEM_ISSUE') AND issue_source IN ('CUSTOMER', 'SOCIAL')
-    """
-
-    cursor.execute(sql, (order_issue_id,))
+    cursor.execute(order_issue_items_sql, (order_issue_id,))
     rows = cursor.fetchall()
     return [OrderIssueItem(**row) for row in rows]
 
 
 def get_order_items(order_id: str, cursor) -> List[OrderItem]:
-    sql = """
-    SELECT id, menu_item_name, order_quantity, restaurant_id
-    FROM order.order_items
-    WHERE order_id = %s AND NOT deleted
-    """
-
-    cursor.execute(sql, (order_id,))
+    cursor.execute(order_items_sql, (order_id,))
     rows = cursor.fetchall()
     return [OrderItem(**row) for row in rows]
 
@@ -209,25 +635,13 @@ def get_order_items_by_ids(order_ids: List[str], cursor) -> List[OrderItem]:
         return []
 
     placeholders = ','.join(['%s'] * len(order_ids))
-    sql = f"""
-    SELECT id, menu_item_name, order_quantity, restaurant_id
-    FROM order.order_items
-    WHERE order_id IN ({placeholders}) AND NOT deleted
-    """
-
-    cursor.execute(sql, tuple(order_ids))
+    cursor.execute(order_items_in_sql.format(placeholders=placeholders), tuple(order_ids))
     rows = cursor.fetchall()
     return [OrderItem(**row) for row in rows]
 
 
 def get_order_charge_items(order_id: str, cursor) -> List[OrderChargeItem]:
-    sql = """
-    SELECT order_item_id, subtotal, adjust_subtotal, discount, promotion, membership_subtotal, subscription_save_discount
-    FROM order.order_charge_items
-    WHERE order_id = %s
-    """
-
-    cursor.execute(sql, (order_id,))
+    cursor.execute(order_charge_items_sql, (order_id,))
     rows = cursor.fetchall()
     return [OrderChargeItem(**row) for row in rows]
 
@@ -237,13 +651,7 @@ def get_order_charge_items_by_ids(order_ids: List[str], cursor) -> List[OrderCha
         return []
 
     placeholders = ','.join(['%s'] * len(order_ids))
-    sql = f"""
-    SELECT order_item_id, subtotal, adjust_subtotal, discount, promotion, membership_subtotal, subscription_save_discount
-    FROM order.order_charge_items
-    WHERE order_id IN ({placeholders})
-    """
-
-    cursor.execute(sql, tuple(order_ids))
+    cursor.execute(order_charge_items_in_sql.format(placeholders=placeholders), tuple(order_ids))
     rows = cursor.fetchall()
     return [OrderChargeItem(**row) for row in rows]
 
@@ -260,7 +668,7 @@ def create_refund_line(root_order_id: str, issue: OrderIssue, issue_item: OrderI
         "eventId": issue.id,
         "compensationStatus.itemStatus[].basicItemData.productId": "",
         "compensationStatus.itemStatus[].basicItemData.name": order_item.menu_item_name,
-        "compensationStatus.itemStatus[].basicItemData.quantity": str(
+        "compensationStatus.itemStatus[].basicItemData.quantity": str_or_empty(
             issue_item.issue_quantity if issue_item.issue_category == "ITEM_ISSUE" else order_item.order_quantity
         ),
         "compensationStatus.itemStatus[].basicItemData.category": "",
@@ -276,7 +684,7 @@ def create_refund_line(root_order_id: str, issue: OrderIssue, issue_item: OrderI
         "compensationStatus.itemStatus[].statusData.returnCondition": "",
         "compensationStatus.itemStatus[].statusData.statusLog.shippedByCustomerTime": "",
         "compensationStatus.itemStatus[].statusData.statusLog.arrivedToWarehouseTime": "",
-        "compensationStatus.totalGrantedAmount.amountUSD": str(issue.concession_total),
+        "compensationStatus.totalGrantedAmount.amountUSD": str_or_empty(issue.concession_total),
         "compensationStatus.totalGrantedAmount.amountLocalCurrency": "",
         "compensationStatus.totalGrantedAmount.currency": "",
         "compensationStatus.replacementOrderId": issue.order_id if issue.issue_type == "REMAKE" else "",
@@ -287,6 +695,11 @@ def create_refund_line(root_order_id: str, issue: OrderIssue, issue_item: OrderI
     }
 
 
+def str_or_empty(value) -> str:
+    """NULL 输出为空串 (Parquet 中为 null), 不能写成 "None", 否则 int / decimal 列转换失败"""
+    return "" if value is None else str(value)
+
+
 def refundable_subtotal(charge_item: OrderChargeItem) -> Decimal:
     return (charge_item.subtotal - charge_item.adjust_subtotal - charge_item.discount -
             charge_item.promotion - charge_item.membership_subtotal - charge_item.subscription_save_discount)
@@ -414,59 +827,105 @@ def reason_category(reason_number: str) -> str:
     return reason_map.get(reason_number, "UNKNOWN")
 
 
-def write_refund_csv(refund_lines: List[Dict[str, Any]], date):
-    if not refund_lines:
-        return
-
-    columns = [
-        "orderId", "eventTime", "eventId",
-        "compensationStatus.itemStatus[].basicItemData.productId",
-        "compensationStatus.itemStatus[].basicItemData.name",
-        "compensationStatus.itemStatus[].basicItemData.quantity",
-        "compensationStatus.itemStatus[].basicItemData.category",
-        "compensationStatus.itemStatus[].basicItemData.type",
-        "compensationStatus.itemStatus[].basicItemData.price.amountUSD",
-        "compensationStatus.itemStatus[].basicItemData.price.amountLocalCurrency",
-        "compensationStatus.itemStatus[].basicItemData.price.currency",
-        "compensationStatus.itemStatus[].statusData.updatedStatus",
-        "compensationStatus.itemStatus[].statusData.compensationTypeGranted",
-        "compensationStatus.itemStatus[].statusData.reasonCategory",
-        "compensationStatus.itemStatus[].statusData.internalReasonCategory",
-        "compensationStatus.itemStatus[].statusData.returnMethodGranted",
-        "compensationStatus.itemStatus[].statusData.returnCondition",
-        "compensationStatus.itemStatus[].statusData.statusLog.shippedByCustomerTime",
-        "compensationStatus.itemStatus[].statusData.statusLog.arrivedToWarehouseTime",
-        "compensationStatus.totalGrantedAmount.amountUSD",
-        "compensationStatus.totalGrantedAmount.amountLocalCurrency",
-        "compensationStatus.totalGrantedAmount.currency",
-        "compensationStatus.replacementOrderId",
-        "compensationStatus.shippingRefundedAmount.amountUSD",
-        "compensationStatus.shippingRefundedAmount.amountLocalCurrency",
-        "compensationStatus.shippingRefundedAmount.currency",
-        "compensationStatus.hasProofOfPurchase"
+def refund_line_to_row(refund_line: Dict[str, Any]) -> tuple:
+    return tuple(refund_line[column] for column in refund_columns)
+
+
+def preflight_queries(conn, start_date: datetime):
+    """按当前的导出 / 扫描模式列出会执行的查询, 参数取第一天的时间范围和当天的一个真实订单 / 问题单"""
+    day_start, day_end = day_range_utc(start_date)
+    with conn.cursor(dictionary=True) as cursor:
+        cursor.execute(first_order_page_sql, (day_start, day_end, 1))
+        sample = (cursor.fetchall() or [{}])[0]
+        issues = get_order_issues(sample['id'], cursor) if sample else []
+    order_id = sample.get('id', '')
+    issue_id = issues[0].id if issues else ''
+
+    if export_mode == 'delta':
+        hour = (day_start, day_start + timedelta(hours=1))
+        queries = [
+            preflight_query('delta_changed_ids order_issues_v2', changed_issue_order_ids_sql, hour, '小时'),
+            preflight_query('delta_changed_ids order_issue_items', changed_issue_item_order_ids_sql, hour, '小时'),
+            preflight_query('delta_orders', delta_orders_sql.format(placeholders='%s'), (order_id,), '单'),
+            preflight_query('delta_order_issue_ids', order_issue_ids_in_sql.format(placeholders='%s'), (order_id,),
+                            '单'),
+        ]
+    else:
+        scan_queries = {
+            'keyset': (next_order_page_sql, (day_start, day_end, day_start, day_start, '', page_size)),
+            'offset': (offset_order_page_sql, (day_start, day_end, page_size, 0)),
+            'stream': (search_order_sql, (day_start, day_end)),
+        }
+        sql, params = scan_queries[order_scan_mode]
+        queries = [preflight_query('order_page_query', sql, params, '天')]
+    return queries + [
+        preflight_query('query_order_issues', order_issues_sql, (order_id,), '单'),
+        preflight_query('query_order_issue_items', order_issue_items_sql, (issue_id,), '问题单'),
+        preflight_query('query_order_items', order_items_sql, (order_id,), '单'),
+        preflight_query('query_order_items_by_ids', order_items_in_sql.format(placeholders='%s'), (order_id,), '单'),
+        preflight_query('query_order_charge_items', order_charge_items_sql, (order_id,), '单'),
+        preflight_query('query_order_charge_items_by_ids', order_charge_items_in_sql.format(placeholders='%s'),
+                        (order_id,), '单'),
     ]
 
-    df = pd.DataFrame(refund_lines, columns=columns)
-    filename = f"refunds-{date.strftime('%Y-%m-%d')}.csv"
-    filepath = os.path.join(output_dir, filename)
-    df.to_csv(filepath, index=False, encoding='utf-8')
-    logging.info(f"退款数据已写入: {filename}")
+
+def preflight(start_date: datetime):
+    """每个副本都检查一遍: 缺索引的往往只是其中一个副本"""
+    if preflight_mode == 'off':
+        return
+    for replica in replicas.replicas:
+        conn = replicas.connect(replica)
+        try:
+            run_preflight(conn, preflight_queries(conn, start_date), preflight_mode, replica.host)
+        finally:
+            conn.close()
 
 
 def main():
+    global result_archive
     logging.info("开始数据导出任务...")
+    if run_mode == 'job':
+        result_archive = ResultArchive(check_archive_path(archive_path, output_dir))
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     start = datetime(2025, 8, 11)
     end = datetime(2025, 9, 30)
 
-    mysql.connector.connect(**db_config)
-    order_refund_history_for_forter(start, end)
+    replicas.create_pools(db_config, day_workers)
+    if redo_dead_letters_mode:
+        succeeded = redo_dead_letters()
+    elif export_mode == 'delta':
+        preflight(start)
+        succeeded = export_delta()
+    else:
+        preflight(start)
+        succeeded = order_refund_history_for_forter(start, end)
     logging.info("数据导出完成")
+    if run_mode == 'job':
+        seal_archive(start, end, succeeded)
+        return 0 if succeeded else 1
 
     totalTime.sleep(36000)
+    return 0
+
+
+def seal_archive(start_date: datetime, end_date: datetime, succeeded):
+    """阶段耗时快照也放进归档, 然后封口"""
+    metrics_path = os.path.join(output_dir, f"{metrics.prefix}.json")
+    if os.path.exists(metrics_path):
+        result_archive.add(metrics_path)
+    if os.path.exists(dead_letters.path):
+        result_archive.add(dead_letters.path)
+    result_archive.seal({
+        'export_mode': export_mode,
+        'start_date': start_date.strftime('%Y-%m-%d'),
+        'end_date': end_date.strftime('%Y-%m-%d'),
+        'redo_dead_letters': redo_dead_letters_mode,
+        'succeeded': succeeded,
+        'dead_letters': len(dead_letters.recorded),
+    })
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())